@@ -0,0 +1,216 @@
+"""
+(c) 2014 Arts Alliance Media
+
+Registry of the calls that block the calling thread.
+
+Blocking calls are C functions (sleeps, lock acquisitions, select and poll,
+socket I/O, waits for child processes, ...) matched by identity when they
+are called.
+Python functions can be registered too: they are never matched on their
+own, instead when a blocking C call is made from one of them the call is
+reported as a call to the outermost registered Python function, made from
+its caller.
+This way a Queue.get is reported as such, from the line calling it, rather
+than as a lock acquisition in threading.py.
+"""
+
+import importlib
+from types import ModuleType
+
+
+# Blocking calls registered by default, as (module, attribute path) pairs.
+# Missing modules and attributes (e.g. epoll outside Linux) are skipped.
+_C_DEFAULTS = [
+    ("time", "sleep"),
+    ("_thread", "LockType.acquire"),
+    ("_thread", "RLock.acquire"),
+    ("_thread", "_ThreadHandle.join"),
+    ("_queue", "SimpleQueue.get"),
+    ("select", "select"),
+    ("select", "epoll.poll"),
+    ("select", "devpoll.poll"),
+    ("select", "kqueue.control"),
+    ("_socket", "socket.accept"),
+    ("_socket", "socket._accept"),
+    ("_socket", "socket.connect"),
+    ("_socket", "socket.recv"),
+    ("_socket", "socket.recv_into"),
+    ("_socket", "socket.recvfrom"),
+    ("_socket", "socket.recvfrom_into"),
+    ("_socket", "socket.send"),
+    ("_socket", "socket.sendall"),
+    ("_socket", "socket.sendto"),
+    ("os", "wait"),
+    ("os", "waitpid"),
+    ("os", "wait3"),
+    ("os", "wait4"),
+    ("os", "waitid")
+]
+# The private helpers between a public function and its blocking C call
+# are registered too, so that the public function is reported.
+_PYTHON_DEFAULTS = [
+    ("threading", "Condition.wait"),
+    ("threading", "Condition.wait_for"),
+    ("threading", "Semaphore.acquire"),
+    ("threading", "Event.wait"),
+    ("threading", "Barrier.wait"),
+    ("threading", "Thread.join"),
+    ("threading", "Thread._wait_for_tstate_lock"),
+    ("queue", "Queue.get"),
+    ("queue", "Queue.put"),
+    ("subprocess", "Popen.wait"),
+    ("subprocess", "Popen._wait"),
+    ("subprocess", "Popen._try_wait"),
+    ("subprocess", "Popen.communicate"),
+    ("socket", "socket.accept"),
+    ("socket", "create_connection"),
+    ("selectors", "SelectSelector.select"),
+    ("selectors", "PollSelector.select"),
+    ("selectors", "EpollSelector.select"),
+    ("selectors", "DevpollSelector.select"),
+    ("selectors", "KqueueSelector.select")
+]
+
+
+_UNDECIDED = object()
+
+
+def _resolve(module, attributes):
+    """Returns the object at a dotted attribute path, None if missing."""
+    try:
+        value = importlib.import_module(module)
+    except ImportError:
+        return None
+    for attribute in attributes.split("."):
+        value = getattr(value, attribute, None)
+        if value is None:
+            return None
+    return value
+
+
+def _pollType():
+    """Returns the type of the objects created by select.poll, if any."""
+    poll = _resolve("select", "poll")
+    return type(poll()) if poll is not None else None
+
+
+class BlockingRegistry(object):
+    """Matches the calls that block the calling thread.
+
+    Entries are (key, filename, line, name) tuples, where key identifies
+    the function as the profiler's symbols do.
+    C functions defined in modules are keyed by the function itself,
+    methods of C types by a (type, name) tuple and Python functions by
+    their code object.
+
+    Decisions are cached by function name, then by function (for C
+    functions defined in modules) or type of the bound object (for
+    methods): methods of subclasses (e.g. socket.socket.recv) match the
+    entry of their base class.
+    Most C calls are rejected on their name alone.
+    """
+    def __init__(self, defaults=True):
+        """Creates a registry.
+
+        Args:
+            defaults: register the standard library blocking calls.
+        """
+        self._functions = {}
+        self._wrappers = {}
+        self._decisions = {}
+        if defaults:
+            for (module, attributes) in _C_DEFAULTS + _PYTHON_DEFAULTS:
+                function = _resolve(module, attributes)
+                if function is not None:
+                    self.add(function)
+            # Python 2.7 poll objects have no poll method.
+            poll = getattr(_pollType(), "poll", None)
+            if poll is not None:
+                self.add(poll)
+
+    def _entry(self, function):
+        code = getattr(function, "__code__", None)
+        if code is not None:
+            name = getattr(function, "__qualname__", code.co_name)
+            return (code, code.co_filename, code.co_firstlineno, name)
+        name = function.__name__
+        owner = getattr(function, "__objclass__", None)
+        if owner is None:
+            owner = getattr(function, "__self__", None)
+            if owner is None or isinstance(owner, ModuleType):
+                return (function, function.__module__, 0, name)
+            owner = type(owner)
+        return ((owner, name), owner.__module__, 0,
+                "{0}.{1}".format(owner.__name__, name))
+
+    def _reset(self):
+        """Drops the cached decisions after the entries changed."""
+        self._decisions = dict((entry[3].rpartition(".")[2], {})
+                               for entry in self._functions.values())
+
+    def add(self, function):
+        """Registers a blocking function.
+
+        Args:
+            function: a C function, a method of a C type (e.g.
+                      socket.socket.recv), or a Python function or method.
+        """
+        entry = self._entry(function)
+        if hasattr(function, "__code__"):
+            self._wrappers[entry[0]] = entry
+        else:
+            self._functions[entry[0]] = entry
+            self._reset()
+
+    def remove(self, function):
+        """Unregisters a blocking function, registered or not."""
+        key = self._entry(function)[0]
+        self._wrappers.pop(key, None)
+        self._functions.pop(key, None)
+        self._reset()
+
+    def entries(self):
+        """Returns the "file:line:name" descriptions of the entries."""
+        return sorted("{1}:{2}:{3}".format(*entry) for entry in
+                      list(self._functions.values()) +
+                      list(self._wrappers.values()))
+
+    def _decide(self, decisions, key, name):
+        if isinstance(key, type):
+            entry = None
+            for base in key.__mro__:
+                entry = self._functions.get((base, name))
+                if entry is not None:
+                    break
+        else:
+            entry = self._functions.get(key)
+        decisions[key] = entry
+        return entry
+
+    def match(self, function):
+        """Matches a C function being called.
+
+        Args:
+            function: the builtin function or method, as passed to the
+                      profile function.
+
+        Returns:
+            The entry of the function, None if it does not block.
+        """
+        name = function.__name__
+        decisions = self._decisions.get(name)
+        if decisions is None:
+            return None
+        owner = function.__self__
+        if owner is None or type(owner) is ModuleType:
+            key = function
+        else:
+            key = type(owner)
+        entry = decisions.get(key, _UNDECIDED)
+        if entry is _UNDECIDED:
+            entry = self._decide(decisions, key, name)
+        return entry
+
+    def wrapper(self, code):
+        """Returns the entry of a registered Python function, or None."""
+        return self._wrappers.get(code)
@@ -0,0 +1,113 @@
+"""
+(c) 2014 Arts Alliance Media
+
+Selection of the functions to profile.
+"""
+
+import fnmatch
+import re
+
+
+def _compileGlobs(globs):
+    """Compiles shell-style patterns into a single regular expression."""
+    if not globs:
+        return None
+    return re.compile("|".join(
+        "(?:{0})".format(fnmatch.translate(glob)) for glob in globs))
+
+
+def _compileModules(modules):
+    """Compiles module names into a regular expression matching them
+    and their submodules."""
+    if not modules:
+        return None
+    return re.compile("|".join(
+        r"(?:{0}(?:\..*)?\Z)".format(re.escape(module)) for module in modules))
+
+
+class CallFilter(object):
+    """Decides which functions are profiled.
+
+    A function is profiled when it matches at least one of the include
+    rules (or no include rule is given) and does not match any of the
+    exclude rules.
+    Rules match the file name (shell-style patterns), the module name
+    (a module also matches its submodules) or the function name
+    (shell-style patterns).
+
+    For C functions the module name is used as the file name as well.
+    If c_modules is given it replaces the include rules for C functions:
+    only C functions from those modules (or patterns) are profiled.
+
+    Decisions are stored in the decisions dictionary, keyed by code object
+    (or (module, name) tuple for C functions), so each function is
+    matched against the rules only once.
+    The arguments of the filter are kept in the rules dictionary so that an
+    equivalent filter can be created in another process.
+    """
+    def __init__(self, files=None, modules=None, functions=None,
+                 exclude_files=None, exclude_modules=None,
+                 exclude_functions=None, c_modules=None):
+        self._files = _compileGlobs(files)
+        self._modules = _compileModules(modules)
+        self._functions = _compileGlobs(functions)
+        self._exclude_files = _compileGlobs(exclude_files)
+        self._exclude_modules = _compileModules(exclude_modules)
+        self._exclude_functions = _compileGlobs(exclude_functions)
+        self._c_modules = _compileGlobs(c_modules)
+        self.rules = {
+            "files": files,
+            "modules": modules,
+            "functions": functions,
+            "exclude_files": exclude_files,
+            "exclude_modules": exclude_modules,
+            "exclude_functions": exclude_functions,
+            "c_modules": c_modules
+        }
+        self._include = (self._files is not None or
+                         self._modules is not None or
+                         self._functions is not None)
+        self.decisions = {}
+
+    @classmethod
+    def fromPrefix(cls, prefix):
+        """Creates a filter accepting files starting with a prefix."""
+        if not prefix:
+            return cls()
+        return cls(files=[prefix.replace("[", "[[]") + "*"])
+
+    def _matches(self, filename, name, module, c_function):
+        filename = filename or ""
+        module = module or ""
+        if c_function and self._c_modules is not None:
+            if not self._c_modules.match(module):
+                return False
+        elif self._include:
+            if not ((self._files and self._files.match(filename)) or
+                    (self._modules and self._modules.match(module)) or
+                    (self._functions and self._functions.match(name))):
+                return False
+        if ((self._exclude_files and self._exclude_files.match(filename)) or
+                (self._exclude_modules and
+                 self._exclude_modules.match(module)) or
+                (self._exclude_functions and
+                 self._exclude_functions.match(name))):
+            return False
+        return True
+
+    def decide(self, code, filename, name, module):
+        """Matches a function against the rules and stores the decision.
+
+        Args:
+            code: The code object, or (module, name) tuple for C functions.
+            filename: The file containing the function.
+            name: The name of the function.
+            module: The name of the module containing the function.
+
+        Returns:
+            True if the function should be profiled.
+        """
+        accepted = self._matches(filename, name, module,
+                                 isinstance(code, tuple))
+        self.decisions[code] = accepted
+        return accepted
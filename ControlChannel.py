@@ -0,0 +1,194 @@
+"""
+(c) 2014 Arts Alliance Media
+
+Runtime control of a profiled process over a Unix domain socket.
+
+The server accepts connections on the socket and reads one command per
+line, answering each with a line starting with "ok" or "error".
+Commands:
+  * enable, disable: start or stop profiling.
+  * flush: write all pending events.
+  * filter [PREFIX]: profile only files starting with PREFIX (all if omitted).
+  * memory on|off, stack on|off, sleeps on|off, blocking on|off:
+    toggle tracking.
+  * interval SECONDS|none: sample the process memory every SECONDS.
+  * frequency N|none: sample the process memory every N events instead.
+  * status: report the current settings.
+
+Run this module to send commands to a process:
+    python ControlChannel.py /path/to/profile/data/PID/control status
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import socket
+import sys
+import threading
+
+
+def _parse_switch(value):
+    if value in ("on", "1", "true", "yes"):
+        return True
+    if value in ("off", "0", "false", "no"):
+        return False
+    raise ValueError("expected on or off, got {0}".format(value))
+
+
+class ControlServer(threading.Thread):
+    """Daemon thread serving commands for a ProcessProfile."""
+    def __init__(self, profile, address):
+        super(ControlServer, self).__init__(name="ThreadGraph control")
+        self.daemon = True
+        # Marks the thread so that it is never profiled.
+        self.profiler_thread = True
+        self._profile = profile
+        self._address = address
+        self._stopped = False
+        if os.path.exists(address):
+            os.remove(address)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(address)
+        self._socket.listen(1)
+        self._commands = {
+            "blocking": self._blocking,
+            "disable": self._disable,
+            "enable": self._enable,
+            "filter": self._filter,
+            "flush": self._flush,
+            "frequency": self._frequency,
+            "interval": self._interval,
+            "memory": self._memory,
+            "sleeps": self._sleeps,
+            "stack": self._stack,
+            "status": self._status
+        }
+
+    def _blocking(self, value):
+        self._profile.trackBlocking(_parse_switch(value))
+
+    def _disable(self):
+        self._profile.disable()
+
+    def _enable(self):
+        self._profile.enable()
+        # Enabling installs the profile function on the calling thread too.
+        sys.setprofile(None)
+
+    def _filter(self, prefix=None):
+        self._profile.setFilter(prefix)
+
+    def _flush(self):
+        self._profile.flush()
+
+    def _frequency(self, value):
+        self._profile.setProcessMemoryFrequence(
+            None if value == "none" else int(value))
+
+    def _interval(self, value):
+        self._profile.setProcessMemoryInterval(
+            None if value == "none" else float(value))
+
+    def _memory(self, value):
+        self._profile.trackMemory(_parse_switch(value))
+
+    def _sleeps(self, value):
+        self._profile.trackSleeps(_parse_switch(value))
+
+    def _stack(self, value):
+        self._profile.trackStack(_parse_switch(value))
+
+    def _status(self):
+        return " ".join("{0}={1}".format(key, value) for (key, value)
+                        in sorted(self._profile.status().items()))
+
+    def _execute(self, line):
+        words = line.split()
+        if not words:
+            return "error empty command"
+        command = self._commands.get(words[0])
+        if command is None:
+            return "error unknown command {0}".format(words[0])
+        try:
+            result = command(*words[1:])
+        except Exception as e:
+            return "error {0}".format(e)
+        return "ok {0}".format(result) if result else "ok"
+
+    def _serve(self, connection):
+        stream = connection.makefile("rw")
+        try:
+            for line in stream:
+                stream.write(self._execute(line) + "\n")
+                stream.flush()
+        finally:
+            stream.close()
+            connection.close()
+
+    def run(self):
+        # Never profile the profiler's own threads.
+        sys.setprofile(None)
+        while not self._stopped:
+            try:
+                (connection, _) = self._socket.accept()
+            except (IOError, OSError):
+                break
+            try:
+                self._serve(connection)
+            except (IOError, OSError):
+                pass
+
+    def close(self):
+        """Closes the socket without waiting for the thread.
+
+        Used in forked children, where the thread does not exist.
+        """
+        self._stopped = True
+        self._socket.close()
+
+    def stop(self):
+        """Stops serving and removes the socket."""
+        self._stopped = True
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except (IOError, OSError):
+            pass
+        self._socket.close()
+        if self is not threading.current_thread():
+            self.join()
+        try:
+            os.remove(self._address)
+        except OSError:
+            pass
+
+
+def send(address, command):
+    """Sends a command to a profiled process and returns the answer."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(address)
+        stream = client.makefile("rw")
+        stream.write(command + "\n")
+        stream.flush()
+        answer = stream.readline().rstrip("\n")
+        stream.close()
+        return answer
+    finally:
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Sends a command to a process profiled by ThreadGraph.")
+    parser.add_argument("address", help="The control socket of the process.")
+    parser.add_argument("command", nargs="+", help="The command to send.")
+    args = parser.parse_args()
+    answer = send(args.address, " ".join(args.command))
+    print(answer)
+    if not answer.startswith("ok"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,433 @@
+"""
+(c) 2014 Arts Alliance Media
+
+Writers and readers for the per-thread dump streams.
+
+Two formats are supported:
+  * text: the original, human readable, line based format.
+  * binary: a compact format made of fixed-size records.
+
+A binary dump starts with a header (MAGIC followed by a one byte stream kind)
+and is followed by RECORD entries with the fields
+(timestamp, depth, code id, memory delta).
+The first time a code id is used it is defined by a record with the depth
+set to SYMBOL_DEPTH, the memory delta set to the length of the symbol
+and the UTF-8 encoded "file:line:function" symbol following the record.
+Timestamps are NaN when timestamps collection is disabled.
+Memory dumps with durations use the KIND_MEMORY_TIMED kind and
+RECORD_TIMED entries, which add the wall and CPU time of the call in
+nanoseconds (-1 when not measured).
+In text dumps durations are appended to the memory delta as
+";WALL" or ";WALL;CPU".
+
+Blocking call dumps (".block", see ProcessProfile.trackBlocking) have one
+line per blocking call, "TIME#SITE=>BLOCKER;WALL;OFFCPU", where SITE is
+the "file:line:function" of the call site (line being the line of the
+call), BLOCKER the blocking function and WALL and OFFCPU the wall time of
+the call and the part of it not spent on the CPU, in nanoseconds.
+In binary dumps they use the KIND_BLOCK kind and RECORD_TIMED entries,
+with the code id of the call site, the code id of the blocking function
+in place of the memory delta, and the two durations.
+
+Memory dumps can also contain summary lines, "*TIME#NAME=>CALLS", counting
+the calls of a function that were not recorded one by one (see
+ProcessProfile.useThrottling).
+In binary dumps they are records with the depth set to SUMMARY_DEPTH and
+the memory delta set to the number of calls.
+
+When a process-wide SymbolTable is used the records of both formats only
+refer to functions by id ("@ID" in text dumps, no inline definitions in
+binary dumps) and the ids are resolved through the "symbols" file.
+Each line of the symbols file has the form ID<TAB>FILE<TAB>LINE<TAB>NAME.
+
+In aggregate mode no per-event dump is written, the profiler periodically
+writes a snapshot of per-function statistics instead.
+A snapshot starts with SNAPSHOT_HEADER followed by one line per function
+of the form FILE<TAB>LINE<TAB>NAME<TAB>CALLS<TAB>TOTAL<TAB>MIN<TAB>MAX<TAB>TIME
+where TOTAL, MIN and MAX are memory deltas in bytes and TIME is the
+inclusive wall time in seconds.
+
+The profiler also writes its own statistics to the "profiler.stats" file,
+one KEY<TAB>VALUE line per counter, and describes the process in the
+"process.info" file, in the same format: the pid, the pid of the profiled
+parent process (0 if none), the parent pid, how the process was started
+("main", "fork" or "spawn") and when.
+"""
+
+import struct
+import threading
+from time import time
+
+
+MAGIC = b"TGB1"
+HEADER = struct.Struct("<4sc")
+RECORD = struct.Struct("<dIiq")
+RECORD_TIMED = struct.Struct("<dIiqqq")
+SYMBOL_DEPTH = 0xFFFFFFFF
+SUMMARY_DEPTH = 0xFFFFFFFE
+
+KIND_MEMORY = b"m"
+KIND_STACK = b"s"
+KIND_MEMORY_TIMED = b"t"
+KIND_BLOCK = b"b"
+
+SNAPSHOT_HEADER = "#ThreadGraph aggregate snapshot v1\n"
+SUMMARY_PREFIX = "*"
+
+_NAN = float("nan")
+_READ_CHUNK = 64 * 1024
+
+
+def stack_indent(depth):
+    """Returns the indentation used by text stack dumps for a depth."""
+    return " " * (depth - 1) if depth > 1 else ""
+
+
+class SymbolTable(object):
+    """Assigns small integer ids to functions.
+
+    Functions are identified by their code object or, for C functions, by
+    a (module, name) tuple.
+    Call sites are identified by a (code, line) tuple and recorded with
+    their line.
+    Each id is written to the symbols stream the first time it is seen.
+    """
+    def __init__(self, stream):
+        self._stream = stream
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def getId(self, code, filename, name, line=None):
+        ident = self._ids.get(code)
+        if ident is None:
+            with self._lock:
+                ident = self._ids.get(code)
+                if ident is None:
+                    ident = len(self._ids)
+                    if line is None:
+                        line = getattr(code, "co_firstlineno", 0)
+                    self._stream.write("{0}\t{1}\t{2}\t{3}\n".format(
+                        ident, filename, line, name))
+                    self._stream.flush()
+                    self._ids[code] = ident
+        return ident
+
+
+def read_symbols(stream):
+    """Reads a symbols file.
+
+    Returns:
+        A dictionary from "@ID" references to "file:line:name" strings.
+    """
+    symbols = {}
+    for line in stream:
+        (ident, filename, lineno, name) = line.rstrip("\n").split("\t")
+        symbols["@" + ident] = "{0}:{1}:{2}".format(filename, lineno, name)
+    return symbols
+
+
+class _BufferedWriter(object):
+    """Accumulates data in memory and writes it to a stream in batches.
+
+    The buffer is written to the stream (and the stream flushed) when it
+    grows past buffer_size bytes or when more than flush_interval seconds
+    have passed since the last flush.
+    A buffer_size of 0 flushes at every event.
+    """
+    def __init__(self, stream, buffer_size=0, flush_interval=None):
+        self._stream = stream
+        self._buffer_size = buffer_size
+        self._flush_interval = flush_interval
+        self._last_flush = time()
+        self._parts = []
+        self._size = 0
+        self.written = 0
+
+    def _append(self, data):
+        self._parts.append(data)
+        self._size += len(data)
+        if self._size >= self._buffer_size:
+            self.flush()
+        elif (self._flush_interval is not None and
+              time() - self._last_flush >= self._flush_interval):
+            self.flush()
+
+    def _join(self, parts):
+        raise NotImplementedError()
+
+    def close(self):
+        self.flush()
+        self._stream.close()
+
+    def discard(self):
+        """Drops the buffered data without writing it.
+
+        Returns:
+            The stream.
+        """
+        self._parts = []
+        self._size = 0
+        return self._stream
+
+    def flush(self):
+        if self._parts:
+            data = self._join(self._parts)
+            self._stream.write(data)
+            self.written += len(data)
+            self._parts = []
+            self._size = 0
+        self._stream.flush()
+        self._last_flush = time()
+
+
+class TextWriter(_BufferedWriter):
+    """Writes events in the text format."""
+    def __init__(self, stream, buffer_size=0, flush_interval=None,
+                 symbols=None):
+        super(TextWriter, self).__init__(stream, buffer_size, flush_interval)
+        self._symbols = symbols
+
+    def _join(self, parts):
+        return "".join(parts)
+
+    def _symbol(self, code, filename, line, name):
+        if self._symbols is None:
+            return "{0}:{1}:{2}".format(filename, line, name)
+        return "@" + str(self._symbols.getId(code, filename, name))
+
+    def _site(self, code, filename, line, name):
+        if self._symbols is None:
+            return "{0}:{1}:{2}".format(filename, line, name)
+        return "@" + str(self._symbols.getId((code, line), filename, name,
+                                             line))
+
+    def writeCall(self, now, depth, code, filename, line, name):
+        stamp = str(now) + "#" if now is not None else ""
+        self._append("{0}{1}{2}\n".format(
+            stack_indent(depth), stamp,
+            self._symbol(code, filename, line, name)))
+
+    def writeReturn(self, now, depth, code, filename, line, name, delta,
+                    durations=None):
+        stamp = str(now) + "#" if now is not None else ""
+        if durations:
+            delta = "{0};{1}".format(
+                delta, ";".join(str(d) for d in durations))
+        self._append("{0}{1}=>{2}\n".format(
+            stamp, self._symbol(code, filename, line, name), delta))
+
+    def writeSummary(self, now, code, filename, line, name, calls):
+        stamp = str(now) + "#" if now is not None else ""
+        self._append("{0}{1}{2}=>{3}\n".format(
+            SUMMARY_PREFIX, stamp, self._symbol(code, filename, line, name),
+            calls))
+
+    def writeBlock(self, now, site, blocker, wall, off_cpu):
+        stamp = str(now) + "#" if now is not None else ""
+        self._append("{0}{1}=>{2};{3};{4}\n".format(
+            stamp, self._site(*site), self._symbol(*blocker), wall, off_cpu))
+
+
+class BinaryWriter(_BufferedWriter):
+    """Writes events in the binary format.
+
+    The stream must be opened in binary mode.
+    Without a SymbolTable, symbols are defined inline.
+    """
+    def __init__(self, stream, kind, buffer_size=0, flush_interval=None,
+                 symbols=None):
+        super(BinaryWriter, self).__init__(stream, buffer_size, flush_interval)
+        self._inline = {}
+        self._table = symbols
+        self._timed = kind in (KIND_MEMORY_TIMED, KIND_BLOCK)
+        self._stream.write(HEADER.pack(MAGIC, kind))
+
+    def _join(self, parts):
+        return b"".join(parts)
+
+    def _symbol(self, code, filename, line, name):
+        if self._table is not None:
+            return self._table.getId(code, filename, name)
+        key = (filename, line, name)
+        ident = self._inline.get(key)
+        if ident is None:
+            ident = len(self._inline)
+            self._inline[key] = ident
+            symbol = "{0}:{1}:{2}".format(filename, line, name).encode("utf-8")
+            self._append(self._pack(_NAN, SYMBOL_DEPTH, ident, len(symbol)) +
+                         symbol)
+        return ident
+
+    def _site(self, code, filename, line, name):
+        if self._table is not None:
+            return self._table.getId((code, line), filename, name, line)
+        return self._symbol(code, filename, line, name)
+
+    def _pack(self, now, depth, ident, value, durations=None):
+        if not self._timed:
+            return RECORD.pack(now, depth, ident, value)
+        wall = durations[0] if durations else -1
+        cpu = durations[1] if durations and len(durations) > 1 else -1
+        return RECORD_TIMED.pack(now, depth, ident, value, wall, cpu)
+
+    def writeCall(self, now, depth, code, filename, line, name):
+        ident = self._symbol(code, filename, line, name)
+        self._append(self._pack(
+            _NAN if now is None else now, depth, ident, 0))
+
+    def writeReturn(self, now, depth, code, filename, line, name, delta,
+                    durations=None):
+        ident = self._symbol(code, filename, line, name)
+        self._append(self._pack(
+            _NAN if now is None else now, depth, ident, delta, durations))
+
+    def writeSummary(self, now, code, filename, line, name, calls):
+        ident = self._symbol(code, filename, line, name)
+        self._append(self._pack(
+            _NAN if now is None else now, SUMMARY_DEPTH, ident, calls))
+
+    def writeBlock(self, now, site, blocker, wall, off_cpu):
+        site = self._site(*site)
+        blocker = self._symbol(*blocker)
+        self._append(RECORD_TIMED.pack(
+            _NAN if now is None else now, 0, site, blocker, wall, off_cpu))
+
+
+def is_summary(line):
+    """Checks if a line of a memory dump is a summary line."""
+    return line.startswith(SUMMARY_PREFIX)
+
+
+def is_binary(header):
+    """Checks if the first bytes of a dump identify a binary dump."""
+    return header[:len(MAGIC)] == MAGIC
+
+
+def read_binary(stream, timed=True):
+    """Converts a binary dump into the equivalent text lines.
+
+    Args:
+        stream: binary file object positioned at the start of the dump.
+        timed: include timestamps in the lines.
+
+    Returns:
+        A generator of text lines, newline included.
+    """
+    (_, kind) = HEADER.unpack(stream.read(HEADER.size))
+    record = (RECORD_TIMED if kind in (KIND_MEMORY_TIMED, KIND_BLOCK)
+              else RECORD)
+    symbols = {}
+    data = b""
+    offset = 0
+    while True:
+        if len(data) - offset < record.size:
+            chunk = stream.read(_READ_CHUNK)
+            if not chunk:
+                return
+            data = data[offset:] + chunk
+            offset = 0
+            continue
+        fields = record.unpack_from(data, offset)
+        (now, depth, code, value) = fields[:4]
+        offset += record.size
+        if depth == SYMBOL_DEPTH:
+            while len(data) - offset < value:
+                chunk = stream.read(_READ_CHUNK)
+                if not chunk:
+                    return
+                data = data[offset:] + chunk
+                offset = 0
+            symbols[code] = data[offset:offset + value].decode("utf-8")
+            offset += value
+            continue
+        stamp = str(now) + "#" if timed and now == now else ""
+        symbol = symbols.get(code)
+        if symbol is None:
+            symbol = "@" + str(code)
+        if depth == SUMMARY_DEPTH:
+            yield "{0}{1}{2}=>{3}\n".format(
+                SUMMARY_PREFIX, stamp, symbol, value)
+        elif kind == KIND_STACK:
+            yield "{0}{1}{2}\n".format(stack_indent(depth), stamp, symbol)
+        elif kind == KIND_BLOCK:
+            blocker = symbols.get(value)
+            if blocker is None:
+                blocker = "@" + str(value)
+            yield "{0}{1}=>{2};{3};{4}\n".format(
+                stamp, symbol, blocker, fields[4], fields[5])
+        elif kind == KIND_MEMORY_TIMED and fields[4] >= 0:
+            durations = [str(d) for d in fields[4:] if d >= 0]
+            yield "{0}{1}=>{2};{3}\n".format(
+                stamp, symbol, value, ";".join(durations))
+        else:
+            yield "{0}{1}=>{2}\n".format(stamp, symbol, value)
+
+
+def is_snapshot(header):
+    """Checks if the first bytes of a file identify an aggregate snapshot."""
+    return header[:len(SNAPSHOT_HEADER)] == SNAPSHOT_HEADER.encode("ascii")
+
+
+def write_snapshot(stream, stats):
+    """Writes aggregated statistics as a snapshot.
+
+    Args:
+        stream: text file object to write to.
+        stats: iterable of (filename, line, name, calls, total, min, max,
+               time) entries.
+    """
+    stream.write(SNAPSHOT_HEADER)
+    for entry in stats:
+        stream.write("\t".join(str(field) for field in entry) + "\n")
+
+
+def read_snapshot(stream):
+    """Reads a snapshot written by write_snapshot.
+
+    Returns:
+        A generator of ("file:line:name", calls, total, min, max, time)
+        tuples.
+    """
+    stream.readline()
+    for line in stream:
+        (filename, lineno, name, calls, total, low, high, elapsed) = (
+            line.rstrip("\n").split("\t"))
+        yield ("{0}:{1}:{2}".format(filename, lineno, name), int(calls),
+               int(total), int(low), int(high), float(elapsed))
+
+
+def write_stats(stream, stats):
+    """Writes the profiler statistics.
+
+    Args:
+        stream: text file object to write to.
+        stats: iterable of (key, value) pairs.
+    """
+    for (key, value) in stats:
+        stream.write("{0}\t{1}\n".format(key, value))
+
+
+def read_stats(stream):
+    """Reads statistics written by write_stats.
+
+    Returns:
+        A dictionary from keys to numeric values.
+    """
+    stats = {}
+    for line in stream:
+        (key, value) = line.rstrip("\n").rsplit("\t", 1)
+        stats[key] = float(value) if "." in value else int(value)
+    return stats
+
+
+def read_info(stream):
+    """Reads a "process.info" file.
+
+    Returns:
+        A dictionary from keys to the values, as strings.
+    """
+    info = {}
+    for line in stream:
+        (key, value) = line.rstrip("\n").split("\t", 1)
+        info[key] = value
+    return info
@@ -0,0 +1,274 @@
+"""
+(c) 2014 Arts Alliance Media
+
+Columnar store of parsed dumps.
+
+The import command of ProfilerGraph parses the dumps of a process once and
+writes them to a store, the other commands then read the columns they need
+from memory-mapped NumPy arrays instead of parsing the dumps again.
+
+A store has a directory per process, named after its pid, holding a
+directory per dump named after the dump (e.g. "Thread-1.mem"), a "symbols"
+file in the format read by DumpFormat.read_symbols and copies of the
+"process.info" and "profiler.stats" files.
+Functions are referred to by "@ID" references to the symbols file, as in
+dumps written with a SymbolTable.
+
+Each dump directory has a "kind" file, written last, and one .npy file per
+column, mirroring the fields of binary records:
+  * time: float64 timestamp, NaN when not recorded.
+  * depth: uint32 indentation of the lines of stack dumps, in spaces (one
+    less than the depth of binary records), SUMMARY_DEPTH for the summary
+    records of memory dumps and 0 otherwise.
+  * code: int32 symbol id of the function (of the call site in block dumps).
+  * value: int64 memory delta, number of calls of summary records, resident
+    set size in process dumps or symbol id of the blocking function in
+    block dumps.
+  * wall, cpu: int64 durations in nanoseconds, -1 when not measured
+    (the off-CPU time for cpu in block dumps).
+The columns of each kind of dump are listed in COLUMNS.
+"""
+
+from array import array
+import os
+import shutil
+
+from DumpFormat import SUMMARY_DEPTH
+from DumpFormat import SUMMARY_PREFIX
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+KIND_MEMORY = "m"
+KIND_MEMORY_TIMED = "t"
+KIND_STACK = "s"
+KIND_BLOCK = "b"
+KIND_PROCESS = "p"
+
+COLUMNS = {
+    KIND_MEMORY: ("time", "depth", "code", "value"),
+    KIND_MEMORY_TIMED: ("time", "depth", "code", "value", "wall", "cpu"),
+    KIND_STACK: ("time", "depth", "code"),
+    KIND_BLOCK: ("time", "depth", "code", "value", "wall", "cpu"),
+    KIND_PROCESS: ("time", "value")
+}
+
+# array module type codes and NumPy types of the columns.
+_TYPES = {
+    "time": ("d", "float64"),
+    "depth": ("I", "uint32"),
+    "code": ("i", "int32"),
+    "value": ("q", "int64"),
+    "wall": ("q", "int64"),
+    "cpu": ("q", "int64")
+}
+
+# Rows converted to Python objects at a time when iterating.
+_CHUNK_ROWS = 65536
+
+
+def _requireNumpy():
+    if numpy is None:
+        raise RuntimeError("numpy is not installed.")
+
+
+def is_store(path):
+    """Checks if a path is a dump of a store."""
+    return os.path.isfile(os.path.join(path, "kind"))
+
+
+class StoreWriter(object):
+    """Writes the dumps of a process to a store directory."""
+    def __init__(self, directory):
+        _requireNumpy()
+        self._directory = directory
+        self._ids = {}
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def symbol(self, name):
+        """Returns the id of a "file:line:name" function name."""
+        ident = self._ids.get(name)
+        if ident is None:
+            ident = len(self._ids)
+            self._ids[name] = ident
+        return ident
+
+    def writeDump(self, name, kind, rows):
+        """Writes a dump.
+
+        Args:
+            name: the name of the dump, e.g. "Thread-1.mem".
+            kind: one of the KIND_ constants.
+            rows: iterable of tuples with the values of COLUMNS[kind].
+        """
+        columns = COLUMNS[kind]
+        buffers = [array(_TYPES[column][0]) for column in columns]
+        appends = [buffer.append for buffer in buffers]
+        for row in rows:
+            for (append, value) in zip(appends, row):
+                append(value)
+        directory = os.path.join(self._directory, name)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        for (column, buffer) in zip(columns, buffers):
+            dtype = _TYPES[column][1]
+            values = (numpy.frombuffer(buffer, dtype) if len(buffer)
+                      else numpy.zeros(0, dtype))
+            numpy.save(os.path.join(directory, column + ".npy"), values)
+        with open(os.path.join(directory, "kind"), "w") as f:
+            f.write(kind)
+
+    def copy(self, filename):
+        """Copies a file, if it exists, to the process directory."""
+        if os.path.exists(filename):
+            shutil.copy(filename, self._directory)
+
+    def close(self):
+        """Writes the symbols file."""
+        with open(os.path.join(self._directory, "symbols"), "w") as f:
+            for (name, ident) in sorted(self._ids.items(),
+                                        key=lambda item: item[1]):
+                (filename, line, function) = name.rsplit(":", 2)
+                f.write("{0}\t{1}\t{2}\t{3}\n".format(
+                    ident, filename, line, function))
+
+
+def load(path, start=None, end=None):
+    """Opens a dump of a store.
+
+    Args:
+        path: the dump directory.
+        start, end: timestamps of the first and last records to include,
+                    None for no limit; ignored if the dump has no times.
+
+    Returns:
+        (kind, columns) where columns maps the names in COLUMNS[kind] to
+        read-only memory-mapped arrays.
+    """
+    _requireNumpy()
+    with open(os.path.join(path, "kind")) as f:
+        kind = f.read().strip()
+    columns = {}
+    for column in COLUMNS[kind]:
+        filename = os.path.join(path, column + ".npy")
+        try:
+            columns[column] = numpy.load(filename, mmap_mode="r")
+        except ValueError:
+            # Empty arrays cannot be mapped.
+            columns[column] = numpy.load(filename)
+    times = columns["time"]
+    if (start is not None or end is not None) and len(times) and (
+            times[0] == times[0]):
+        # Records are in time order, the range is a view of the columns.
+        first = numpy.searchsorted(times, start, "left") if (
+            start is not None) else 0
+        last = numpy.searchsorted(times, end, "right") if (
+            end is not None) else len(times)
+        columns = dict((column, values[first:last])
+                       for (column, values) in columns.items())
+    return (kind, columns)
+
+
+def iter_rows(columns, names):
+    """Iterates over the rows of some columns as tuples of Python values.
+
+    Rows are converted a chunk at a time so memory use does not depend on
+    the size of the dump.
+    """
+    arrays = [columns[name] for name in names]
+    size = len(arrays[0]) if arrays else 0
+    for start in range(0, size, _CHUNK_ROWS):
+        chunks = [values[start:start + _CHUNK_ROWS].tolist()
+                  for values in arrays]
+        for row in zip(*chunks):
+            yield row
+
+
+def read_lines(path, timed=True, start=None, end=None):
+    """Converts a dump of a store into the equivalent text lines.
+
+    Args:
+        path: the dump directory.
+        timed: include timestamps in the lines.
+        start, end: time range of the lines, as in load.
+
+    Returns:
+        A generator of text lines, newline included.
+    """
+    (kind, columns) = load(path, start, end)
+    for row in iter_rows(columns, COLUMNS[kind]):
+        now = row[0]
+        stamp = str(now) + "#" if timed and now == now else ""
+        if kind == KIND_PROCESS:
+            yield "{0}{1}\n".format(stamp, row[1])
+        elif kind == KIND_STACK:
+            yield "{0}{1}@{2}\n".format(" " * row[1], stamp, row[2])
+        elif kind == KIND_BLOCK:
+            yield "{0}@{1}=>@{2};{3};{4}\n".format(stamp, *row[2:])
+        elif row[1] == SUMMARY_DEPTH:
+            yield "{0}{1}@{2}=>{3}\n".format(
+                SUMMARY_PREFIX, stamp, row[2], row[3])
+        elif kind == KIND_MEMORY_TIMED and row[4] >= 0:
+            durations = [str(d) for d in row[4:] if d >= 0]
+            yield "{0}@{1}=>{2};{3}\n".format(
+                stamp, row[2], row[3], ";".join(durations))
+        else:
+            yield "{0}@{1}=>{2}\n".format(stamp, row[2], row[3])
+
+
+def memory_records(path, timed=True, start=None, end=None):
+    """Iterates over the (time, name, mem) records of a memory dump.
+
+    Summary records are skipped, names are "@ID" references and time is
+    None when not recorded or timed is not set.
+    The records can be limited to a time range, as in load.
+    """
+    (_, columns) = load(path, start, end)
+    for (now, depth, code, value) in iter_rows(
+            columns, ("time", "depth", "code", "value")):
+        if depth != SUMMARY_DEPTH:
+            yield (now if timed and now == now else None,
+                   "@" + str(code), value)
+
+
+def memory_totals(path):
+    """Sums the memory deltas of a memory dump by function.
+
+    Returns:
+        A dictionary from "@ID" references to the total, in bytes.
+    """
+    (_, columns) = load(path)
+    records = columns["depth"] != SUMMARY_DEPTH
+    codes = columns["code"][records]
+    if not len(codes):
+        return {}
+    totals = numpy.bincount(codes, weights=columns["value"][records])
+    return dict(("@" + str(code), totals[code])
+                for code in numpy.unique(codes).tolist())
+
+
+def write_points(stream, path, column, timed=True):
+    """Writes "X Y" lines for gnuplot from a column of a dump.
+
+    X is the timestamp, or the row number if timed is not set, and Y the
+    value of column.
+
+    Returns:
+        The number of lines written.
+    """
+    (_, columns) = load(path)
+    values = columns[column]
+    size = len(values)
+    for start in range(0, size, _CHUNK_ROWS):
+        chunk = values[start:start + _CHUNK_ROWS].tolist()
+        if timed:
+            x = columns["time"][start:start + _CHUNK_ROWS].tolist()
+        else:
+            x = range(start, start + len(chunk))
+        stream.write("".join("{0} {1}\n".format(*point)
+                             for point in zip(x, chunk)))
+    return size
@@ -0,0 +1,94 @@
+"""
+(c) 2014 Arts Alliance Media
+
+Queues used to move output off the profiled threads.
+
+Each profiled thread appends pending writes to its own preallocated ring
+buffer and a single writer thread drains all the buffers.
+"""
+
+import threading
+
+
+class RingBuffer(object):
+    """Preallocated queue of pending calls with a single producer.
+
+    The producer (the profiled thread) only moves the head and the consumer
+    (whoever drains the buffer) only moves the tail so, thanks to the GIL,
+    appending does not require any locking.
+
+    When the buffer is full events are either dropped, and counted, or the
+    producer blocks until the buffer is drained.
+    A blocked producer that waits too long drains the buffer itself so it
+    never deadlocks if the writer thread is gone.
+    """
+    def __init__(self, size, block=False):
+        self._slots = [None] * size
+        self._size = size
+        self._head = 0
+        self._tail = 0
+        self._block = block
+        self._space = threading.Event()
+        self.dropped = 0
+        self.lock = threading.RLock()
+
+    def append(self, function, args):
+        """Queues a call to function(*args)."""
+        while self._head - self._tail >= self._size:
+            if not self._block:
+                self.dropped += 1
+                return
+            self._space.clear()
+            if not self._space.wait(0.05):
+                self.drain()
+        self._slots[self._head % self._size] = (function, args)
+        self._head += 1
+
+    def drain(self):
+        """Performs all the queued calls.
+
+        Returns:
+            The number of calls performed.
+        """
+        with self.lock:
+            head = self._head
+            slots = self._slots
+            size = self._size
+            for index in range(self._tail, head):
+                slot = index % size
+                (function, args) = slots[slot]
+                slots[slot] = None
+                try:
+                    function(*args)
+                except (IOError, ValueError):
+                    pass
+            count = head - self._tail
+            self._tail = head
+            self._space.set()
+            return count
+
+
+class QueuedWriter(object):
+    """Writer that queues events in a RingBuffer instead of writing them.
+
+    The wrapped writer is only used when the buffer is drained.
+    """
+    def __init__(self, writer, ring):
+        self.writer = writer
+        self._ring = ring
+        self._write_call = writer.writeCall
+        self._write_return = writer.writeReturn
+        self._write_summary = writer.writeSummary
+        self._write_block = writer.writeBlock
+
+    def writeCall(self, *args):
+        self._ring.append(self._write_call, args)
+
+    def writeReturn(self, *args):
+        self._ring.append(self._write_return, args)
+
+    def writeSummary(self, *args):
+        self._ring.append(self._write_summary, args)
+
+    def writeBlock(self, *args):
+        self._ring.append(self._write_block, args)
@@ -0,0 +1,352 @@
+"""
+(c) 2014 Arts Alliance Media
+
+Vectorized processing of memory dumps for the memg command of ProfilerGraph.
+
+Dumps are read in chunks of at most _CHUNK_ROWS records into NumPy arrays,
+from the columns of a store, the records of a binary dump or the lines of
+a text dump, so that memory use does not depend on the size of the dump.
+Zero-run compression, capping and peak detection are then done on whole
+chunks, carrying the little state they need from one chunk to the next.
+The points written are the same as those of the line by line loop of memg.
+"""
+
+import re
+
+import DumpFormat
+import DumpStore
+import TimeIndex
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Records processed at a time.
+_CHUNK_ROWS = 65536
+# Bytes of text dumps parsed at a time.
+_CHUNK_BYTES = 1024 * 1024
+# Peaks compared one by one before searching the arrays for the next.
+_SCAN_PEAKS = 16
+
+# Memory lines, "TIME#NAME=>MEM[;WALL[;CPU]]" or without "TIME#".
+_TIMED_LINE = re.compile(r"^([^#\n]*)#([^\n]*)=>(-?\d+)(?:;[^\n]*)?$",
+                         re.MULTILINE)
+_LINE = re.compile(r"^([^\n]*)=>(-?\d+)(?:;[^\n]*)?$", re.MULTILINE)
+_SUMMARY_LINE = re.compile(
+    "^" + re.escape(DumpFormat.SUMMARY_PREFIX), re.MULTILINE)
+
+
+def available():
+    """Checks if the vectorized engine can be used."""
+    return numpy is not None
+
+
+def _requireNumpy():
+    if numpy is None:
+        raise RuntimeError("numpy is not installed.")
+
+
+def _record_type(kind):
+    fields = [("time", "<f8"), ("depth", "<u4"), ("code", "<i4"),
+              ("value", "<i8")]
+    if kind == DumpFormat.KIND_MEMORY_TIMED:
+        fields += [("wall", "<i8"), ("cpu", "<i8")]
+    return numpy.dtype(fields)
+
+
+def _records(records):
+    """Returns the (time, mem, code) columns of the non summary records."""
+    keep = records["depth"] != DumpFormat.SUMMARY_DEPTH
+    return (records["time"][keep], records["value"][keep],
+            records["code"][keep])
+
+
+def _store_chunks(path, start, end):
+    (_, columns) = DumpStore.load(path, start, end)
+    size = len(columns["time"])
+    for start in range(0, size, _CHUNK_ROWS):
+        chunk = slice(start, start + _CHUNK_ROWS)
+        keep = columns["depth"][chunk] != DumpFormat.SUMMARY_DEPTH
+        yield (columns["time"][chunk][keep], columns["value"][chunk][keep],
+               columns["code"][chunk][keep])
+
+
+def _binary_chunks(stream, names):
+    (_, kind) = DumpFormat.HEADER.unpack(
+        stream.read(DumpFormat.HEADER.size))
+    record = _record_type(kind)
+    data = b""
+    while True:
+        chunk = stream.read(_CHUNK_ROWS * record.itemsize)
+        if not chunk:
+            return
+        data += chunk
+        offset = 0
+        while True:
+            count = (len(data) - offset) // record.itemsize
+            records = numpy.frombuffer(data, record, count, offset)
+            symbols = numpy.flatnonzero(
+                records["depth"] == DumpFormat.SYMBOL_DEPTH)
+            if not len(symbols):
+                yield _records(records)
+                offset += count * record.itemsize
+                break
+            # Inline symbol definitions break the fixed record layout.
+            first = symbols[0]
+            yield _records(records[:first])
+            start = offset + (first + 1) * record.itemsize
+            end = start + int(records["value"][first])
+            if end > len(data):
+                offset += first * record.itemsize
+                break
+            names[int(records["code"][first])] = data[start:end].decode(
+                "utf-8")
+            offset = end
+        data = data[offset:]
+
+
+def _text_chunks(stream, names, timed, errors):
+    ids = {}
+    rest = b""
+    while True:
+        data = stream.read(_CHUNK_BYTES)
+        if data:
+            data = rest + data
+            end = data.rfind(b"\n") + 1
+            (data, rest) = (data[:end], data[end:])
+            if not data:
+                continue
+        else:
+            (data, rest) = (rest, b"")
+            if not data:
+                return
+        yield _text_chunk(data.decode("utf-8"), ids, names, timed, errors)
+
+
+def _text_chunk(text, ids, names, timed, errors):
+    records = (_TIMED_LINE if timed else _LINE).findall(text)
+    lines = text.count("\n") + (not text.endswith("\n"))
+    if len(records) != lines - len(_SUMMARY_LINE.findall(text)):
+        # Find the lines that cannot be parsed.
+        records = []
+        for line in text.splitlines():
+            if DumpFormat.is_summary(line):
+                continue
+            match = (_TIMED_LINE if timed else _LINE).match(line.rstrip())
+            if match is None:
+                errors.append(line)
+            else:
+                records.append(match.groups())
+    if not timed:
+        records = [("nan",) + record for record in records]
+    (times, strings, mems) = (zip(*records) if records else ((), (), ()))
+    codes = [ids.setdefault(string, len(ids)) for string in strings]
+    if len(ids) > len(names):
+        for (string, code) in ids.items():
+            names.setdefault(code, string)
+    return (numpy.array(times, dtype="float64"),
+            numpy.array([int(mem) for mem in mems], dtype="int64"),
+            numpy.array(codes, dtype="int32"))
+
+
+def read_chunks(filename, timed, names, errors, start=None, end=None):
+    """Reads the memory records of a dump in chunks.
+
+    Summary records are skipped.
+
+    Args:
+        filename: a text or binary dump or the dump of a store.
+        timed: the dump has timestamps, when not set times are NaN.
+        names: dictionary filled with the names of the codes, codes that
+               are not in it are "@ID" references to the symbols file.
+        errors: list the text lines that cannot be parsed are appended to.
+        start, end: timestamps of the first and last records to read, None
+                    for no limit; dumps are read from start using their
+                    TimeIndex.
+
+    Returns:
+        A generator of (time, mem, code) arrays.
+    """
+    _requireNumpy()
+    if not timed:
+        (start, end) = (None, None)
+    if DumpStore.is_store(filename):
+        for chunk in _untimed(_store_chunks(filename, start, end), timed):
+            yield chunk
+        return
+    with TimeIndex.open_from(filename, start) as stream:
+        if DumpFormat.is_binary(stream.peek(len(DumpFormat.MAGIC))):
+            chunks = _binary_chunks(stream, names)
+        else:
+            chunks = _text_chunks(stream, names, timed, errors)
+        for chunk in _untimed(_window(chunks, start, end), timed):
+            yield chunk
+
+
+def _window(chunks, start, end):
+    """Limits chunks of records in time order to a time range."""
+    if start is None and end is None:
+        for chunk in chunks:
+            yield chunk
+        return
+    for (times, mems, codes) in chunks:
+        keep = numpy.ones(len(times), dtype=bool)
+        if start is not None:
+            keep &= times >= start
+        if end is not None:
+            keep &= times <= end
+        yield (times[keep], mems[keep], codes[keep])
+        if end is not None and len(times) and times[-1] > end:
+            return
+
+
+def _untimed(chunks, timed):
+    for (times, mems, codes) in chunks:
+        if not timed:
+            times = numpy.full(len(mems), numpy.nan)
+        yield (times, mems, codes)
+
+
+def write_thread(stream, chunks, timed, cap, peak):
+    """Writes the memg points of a thread dump.
+
+    A record is plotted when its memory delta, or the delta of the
+    previous record, is not zero.
+    When a run of hidden zero records ends, a zero point is plotted at the
+    time of the last of them.
+
+    Args:
+        stream: the gnuplot data file.
+        chunks: the (time, mem, code) arrays returned by read_chunks.
+        timed: use the timestamps as X, the number of the point otherwise.
+        cap: the absolute value KB deltas are capped to, None to not cap.
+        peak: the deltas exceeding this size, in KB, are peaks.
+
+    Returns:
+        (count, peaks) where count is the number of records plotted and
+        peaks a list of (x, kmem, code, mem) tuples.
+    """
+    peaks = []
+    count = 0
+    # Whether the last record had a delta and was hidden, and its time.
+    previous = (False, False, float("nan"))
+    for (times, mems, codes) in chunks:
+        if not len(mems):
+            continue
+        (last_delta, last_hidden, last_time) = previous
+        deltas = mems != 0
+        shown = deltas.copy()
+        shown[0] |= last_delta
+        shown[1:] |= deltas[:-1]
+        hidden = ~shown
+        previous = (bool(deltas[-1]), bool(hidden[-1]), times[-1])
+        before = numpy.concatenate(([last_hidden], hidden[:-1]))
+        before_times = numpy.concatenate(([last_time], times[:-1]))
+        rows = numpy.flatnonzero(shown)
+        if not len(rows):
+            continue
+        # Zero point before the first record shown after hidden records.
+        zeros = before[rows] & (before_times[rows] == before_times[rows])
+        zeros &= before_times[rows] != 0
+        kmem = mems[rows] / 1024
+        if cap:
+            kmem = numpy.where(numpy.abs(kmem) > cap,
+                               numpy.copysign(cap, kmem), kmem)
+        if timed:
+            x = times[rows]
+            missing = (x != x) | (x == 0)
+            x = numpy.where(missing, numpy.arange(count, count + len(rows)),
+                            x)
+        else:
+            x = numpy.arange(count, count + len(rows))
+        for index in numpy.flatnonzero(numpy.abs(kmem) > peak).tolist():
+            peaks.append((x[index].item(), kmem[index].item(),
+                          int(codes[rows[index]]), int(mems[rows[index]])))
+        count += len(rows)
+        stream.write(_format_points(x, kmem, zeros, before_times[rows]))
+    return (count, peaks)
+
+
+def _format_points(x, kmem, zeros, zero_x):
+    """Formats the points of a chunk, preceded by their zero points."""
+    positions = numpy.arange(len(x)) + numpy.cumsum(zeros)
+    zero_positions = positions[zeros] - 1
+    points_x = numpy.empty(len(x) + len(zero_positions), x.dtype)
+    points_x[positions] = x
+    points_x[zero_positions] = zero_x[zeros]
+    points_y = numpy.zeros(len(points_x))
+    points_y[positions] = kmem
+    points_y = points_y.tolist()
+    # Zero points are written as integers.
+    for position in zero_positions.tolist():
+        points_y[position] = 0
+    return "".join(map("{0} {1}\n".format, points_x.tolist(), points_y))
+
+
+def filter_peaks(peaks, delta_time, delta_value):
+    """Removes the peaks too close to a previous one to be marked.
+
+    Peaks are sorted, then a peak is kept if it is more than delta_time
+    away in time or delta_value away in memory from the last kept peak.
+
+    Args:
+        peaks: list of (time, kmem, mark) tuples.
+
+    Returns:
+        The sorted list of the peaks kept.
+    """
+    _requireNumpy()
+    times = numpy.array([time for (time, _, _) in peaks], dtype="float64")
+    mems = numpy.array([mem for (_, mem, _) in peaks], dtype="float64")
+    marks = numpy.array([mark for (_, _, mark) in peaks], dtype=str)
+    order = numpy.lexsort((marks, mems, times))
+    (times, mems) = (times[order], mems[order])
+    (time_list, mem_list) = (times.tolist(), mems.tolist())
+    size = len(times)
+    kept = [0]
+    last = 0
+    while True:
+        # Consecutive peaks are often both kept: look at the next few
+        # peaks one by one before searching the arrays.
+        start = last + 1
+        limit = min(start + _SCAN_PEAKS, size)
+        while start < limit and not (
+                time_list[start] - time_list[last] > delta_time or
+                abs(mem_list[start] - mem_list[last]) > delta_value):
+            start += 1
+        if start < limit or start == size:
+            last = start
+        else:
+            last = _next_peak(times, mems, last, start, delta_time,
+                              delta_value)
+        if last >= size:
+            break
+        kept.append(last)
+    return [peaks[index] for index in order[kept].tolist()]
+
+
+def _next_peak(times, mems, last, start, delta_time, delta_value):
+    """Returns the index of the first peak from start far enough from last.
+
+    The peaks before start are known to be too close to last.
+    """
+    # The first peak far enough in time, searchsorted can be off by one
+    # because of rounding.
+    end = int(numpy.searchsorted(times, times[last] + delta_time, "right"))
+    while end > start and times[end - 1] - times[last] > delta_time:
+        end -= 1
+    while end < len(times) and not times[end] - times[last] > delta_time:
+        end += 1
+    # Unless a closer one is far enough in memory, looked for in blocks of
+    # growing size so that the cost depends on the distance to it.
+    block = _SCAN_PEAKS
+    while start < end:
+        far = numpy.flatnonzero(numpy.abs(
+            mems[start:min(start + block, end)] - mems[last]) > delta_value)
+        if len(far):
+            return start + int(far[0])
+        start += block
+        block *= 2
+    return end
@@ -0,0 +1,261 @@
+"""
+(c) 2014 Arts Alliance Media
+
+Sources of process-level memory information.
+
+Each source exposes an rss method returning the resident set size of the
+current process in bytes.
+processCounters reads further process counters for the process memory
+samples.
+"""
+
+import gc
+import os
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    from pympler.process import ProcessMemoryInfo
+except ImportError:
+    ProcessMemoryInfo = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+_clock = getattr(time, "perf_counter", time.time)
+_STATM = "/proc/self/statm"
+
+
+class PymplerMemorySource(object):
+    """Uses pympler to collect memory information.
+
+    Portable but slow: every sample reads and parses several files.
+    """
+    def __init__(self):
+        if ProcessMemoryInfo is None:
+            raise RuntimeError("pympler is not installed.")
+
+    def rss(self):
+        return ProcessMemoryInfo().rss
+
+
+class StatmMemorySource(object):
+    """Reads the resident set size from /proc/self/statm (Linux only).
+
+    The file is opened once and each sample is a single pread (a seek and
+    a read where os.pread is missing, as on Python 2).
+    /proc/self is resolved when the file is opened so the descriptor is
+    re-opened in forked children.
+    """
+    def __init__(self):
+        self._page_size = os.sysconf("SC_PAGE_SIZE")
+        self._fd = None
+        self._pid = None
+        self._open()
+        self._check_pid = not hasattr(os, "register_at_fork")
+        if not self._check_pid:
+            os.register_at_fork(after_in_child=self._open)
+
+    def _open(self):
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(_STATM, os.O_RDONLY)
+        self._pid = os.getpid()
+
+    def rss(self):
+        if self._check_pid and os.getpid() != self._pid:
+            self._open()
+        return int(self._read().split()[1]) * self._page_size
+
+    if hasattr(os, "pread"):
+        def _read(self):
+            return os.pread(self._fd, 128, 0)
+    else:
+        def _read(self):
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            return os.read(self._fd, 128)
+
+
+class CachedMemorySource(object):
+    """Rate limits another source by reusing recent readings.
+
+    A reading is reused if it is less than max_age microseconds old.
+    """
+    def __init__(self, source, max_age):
+        self._source = source
+        self._max_age = max_age / 1000000.0
+        self._stamp = None
+        self._value = 0
+
+    def rss(self):
+        now = _clock()
+        if self._stamp is None or now - self._stamp >= self._max_age:
+            self._value = self._source.rss()
+            self._stamp = now
+        return self._value
+
+
+class TracemallocMemorySource(object):
+    """Uses the tracemalloc counters of traced Python allocations.
+
+    Traced memory does not include memory held by the allocator, it only
+    counts the bytes of the Python allocations.
+    The rss method returns the memory traced for the whole process while
+    threadUsage returns a per-thread counter of allocated minus freed
+    bytes.
+
+    tracemalloc only has a process-wide counter: its changes are charged
+    to the thread that last resumed counting (see pause and resume), which
+    is not always the thread that allocated.
+    Threads switching without a profile event in between, and threads that
+    are not profiled, are charged to the last profiled thread.
+    The profiler pauses counting while it handles an event so its own
+    allocations are not charged.
+    overhead, the bytes the interpreter still allocates for each event
+    (measured by the profiler), is subtracted from each change charged.
+
+    Tracing must be started (see start) before readings are meaningful.
+    """
+    def __init__(self, depth=1):
+        """Creates the source.
+
+        Args:
+            depth: number of frames stored by tracemalloc for each
+                   allocation. 1, the default, only records the allocating
+                   frame and is the cheapest setting.
+        """
+        if tracemalloc is None:
+            raise RuntimeError("tracemalloc is not available.")
+        self.depth = depth
+        self.overhead = 0
+        self._started = False
+        self._lock = threading.Lock()
+        self._last = 0
+        self._owner = None
+        self._paused = False
+        self._usage = {}
+
+    def _charge(self):
+        """Charges the change of the counter to the owner, lock held."""
+        now = tracemalloc.get_traced_memory()[0]
+        if self._owner is not None:
+            self._usage[self._owner] = (self._usage.get(self._owner, 0) +
+                                        now - self._last - self.overhead)
+        self._last = now
+
+    def rss(self):
+        return tracemalloc.get_traced_memory()[0]
+
+    def start(self):
+        """Starts tracing unless tracemalloc is already tracing."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.depth)
+            self._started = True
+        self._last = tracemalloc.get_traced_memory()[0]
+        self._owner = None
+        self._paused = False
+
+    def stop(self):
+        """Stops tracing if it was started by this source."""
+        if self._started:
+            tracemalloc.stop()
+            self._started = False
+
+    def pause(self):
+        """Charges the owner and stops charging allocations to any thread.
+
+        Returns:
+            The ident of the thread charged until now, None if already
+            paused.
+        """
+        with self._lock:
+            if self._paused:
+                return None
+            self._charge()
+            self._paused = True
+            return self._owner
+
+    def resume(self, owner):
+        """Charges the allocations made from now on to a thread.
+
+        Args:
+            owner: the ident of the thread, as returned by pause, None to
+                   stay paused.
+        """
+        with self._lock:
+            self._last = tracemalloc.get_traced_memory()[0]
+            self._owner = owner
+            self._paused = owner is None
+
+    def threadUsage(self):
+        """Returns the bytes allocated minus freed by the current thread.
+
+        Unless counting is paused the current thread becomes the owner.
+        """
+        ident = threading.get_ident()
+        with self._lock:
+            if not self._paused:
+                self._charge()
+                self._owner = ident
+            return self._usage.get(ident, 0)
+
+
+_SOURCES = {
+    "pympler": PymplerMemorySource,
+    "statm": StatmMemorySource,
+    "tracemalloc": TracemallocMemorySource
+}
+
+
+def createMemorySource(name=None, max_age=None):
+    """Creates a memory source.
+
+    Args:
+        name: "statm", "pympler", "tracemalloc" or None to pick the
+              fastest available.
+        max_age: if set, readings younger than max_age microseconds
+                 are reused.
+    """
+    if name is None:
+        name = "statm" if os.path.exists(_STATM) else "pympler"
+    source = _SOURCES[name]()
+    if max_age:
+        source = CachedMemorySource(source, max_age)
+    return source
+
+
+def _virtualSize():
+    """Returns the virtual memory size of the process, -1 if unknown."""
+    if os.path.exists(_STATM):
+        with open(_STATM) as statm:
+            return int(statm.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    if ProcessMemoryInfo is not None:
+        return ProcessMemoryInfo().vsz
+    return -1
+
+
+def processCounters():
+    """Reads process counters that complement the resident set size.
+
+    Returns:
+        A (vms, minor_faults, major_faults, gc0, gc1, gc2) tuple: the
+        virtual memory size in bytes, the page faults and the garbage
+        collections of each generation since the process started.
+        Counters that are not available on the platform are -1.
+    """
+    (minor, major) = (-1, -1)
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        (minor, major) = (usage.ru_minflt, usage.ru_majflt)
+    get_stats = getattr(gc, "get_stats", None)
+    collections = ([stats["collections"] for stats in get_stats()]
+                   if get_stats else [-1, -1, -1])
+    return tuple([_virtualSize(), minor, major] + collections[:3])
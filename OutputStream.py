@@ -0,0 +1,319 @@
+"""
+(c) 2014 Arts Alliance Media
+
+Compressed and rotated output streams.
+
+A stream is written as a sequence of segments on disk.
+Without rotation there is a single segment named after the stream
+(e.g. "Thread-1.mem"), with rotation segments are numbered
+("Thread-1.mem.0", "Thread-1.mem.1", ...).
+Compressed segments have the extension of the compression appended
+(e.g. "Thread-1.mem.0.gz").
+Readers open the logical stream name and get the segments in order as
+a single stream.
+"""
+
+import gzip
+import io
+import os
+import threading
+from time import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+# Compressed streams are flushed at most once every interval seconds:
+# each flush ends a compression block and hurts the ratio.
+_COMPRESSED_FLUSH_INTERVAL = 1.0
+
+
+def _open_gzip(filename, mode):
+    if "b" not in mode:
+        mode += "t"
+    return gzip.open(filename, mode, compresslevel=1)
+
+
+def _open_zstd(filename, mode):
+    if zstandard is None:
+        raise RuntimeError("zstandard is not installed.")
+    return zstandard.open(filename, mode)
+
+
+def _open_lz4(filename, mode):
+    if lz4 is None:
+        raise RuntimeError("lz4 is not installed.")
+    if "b" not in mode:
+        mode += "t"
+    return lz4.frame.open(filename, mode)
+
+
+_COMPRESSIONS = {
+    "gzip": (".gz", _open_gzip),
+    "zstd": (".zst", _open_zstd),
+    "lz4": (".lz4", _open_lz4)
+}
+_SUFFIXES = dict((suffix, opener)
+                 for (suffix, opener) in _COMPRESSIONS.values())
+
+
+def available_compressions():
+    """Returns the names of the compressions that can be used."""
+    names = ["gzip"]
+    if zstandard is not None:
+        names.append("zstd")
+    if lz4 is not None:
+        names.append("lz4")
+    return names
+
+
+def _split_suffix(filename):
+    """Splits the compression extension, if any, from a file name."""
+    (base, suffix) = os.path.splitext(filename)
+    if suffix in _SUFFIXES:
+        return (base, suffix)
+    return (filename, "")
+
+
+def logical_name(filename):
+    """Returns the name of the stream a segment file belongs to."""
+    (base, _) = _split_suffix(filename)
+    (head, _, index) = base.rpartition(".")
+    if index.isdigit() and "." in os.path.basename(head):
+        return head
+    return base
+
+
+def find_segments(name):
+    """Lists the segments of a logical stream, oldest first.
+
+    Args:
+        name: the logical stream name, a segment name is also accepted.
+
+    Returns:
+        The list of segment file names.
+    """
+    name = logical_name(name)
+    for suffix in [""] + list(_SUFFIXES):
+        if os.path.exists(name + suffix):
+            return [name + suffix]
+    segments = []
+    (directory, base) = os.path.split(name)
+    # Match base names so that the directory is used as given, e.g.
+    # "dir//name".
+    prefix = base + "."
+    try:
+        entries = os.listdir(directory or os.curdir)
+    except OSError:
+        entries = []
+    for entry in entries:
+        if entry.startswith(prefix):
+            (index, _) = _split_suffix(entry[len(prefix):])
+            if index.isdigit():
+                segments.append((int(index), os.path.join(directory, entry)))
+    if not segments:
+        # Let open report the missing file.
+        return [name]
+    return [candidate for (_, candidate) in sorted(segments)]
+
+
+def open_segment(filename, mode="rb"):
+    """Opens a single segment, decompressing it if needed."""
+    (_, suffix) = _split_suffix(filename)
+    if suffix:
+        return _SUFFIXES[suffix](filename, mode)
+    return open(filename, mode)
+
+
+class _SegmentReader(io.RawIOBase):
+    """Reads the bytes of a list of segments as a single stream.
+
+    Reading can start at an offset in the first segment, after a prefix.
+    """
+    def __init__(self, segments, offset=0, prefix=b""):
+        super(_SegmentReader, self).__init__()
+        self._segments = list(segments)
+        self._current = None
+        self._offset = offset
+        self._prefix = prefix
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._prefix:
+            data = self._prefix[:len(buffer)]
+            self._prefix = self._prefix[len(data):]
+            buffer[:len(data)] = data
+            return len(data)
+        while True:
+            if self._current is None:
+                if not self._segments:
+                    return 0
+                self._current = open_segment(self._segments.pop(0), "rb")
+                if self._offset:
+                    # Compressed segments are decompressed up to the offset.
+                    self._current.seek(self._offset)
+                    self._offset = 0
+            data = self._current.read(len(buffer))
+            if data:
+                buffer[:len(data)] = data
+                return len(data)
+            self._current.close()
+            self._current = None
+
+    def close(self):
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+        super(_SegmentReader, self).close()
+
+
+def discard_stream(stream):
+    """Redirects a stream inherited from the parent process to os.devnull.
+
+    After a fork the data the parent buffered in the stream would be
+    written a second time when the child flushes or closes its copy.
+    The file descriptor is kept, pointing to os.devnull, so that it is not
+    reused by a file opened by the child while the stream is still open.
+    Streams without a file descriptor are left untouched.
+    """
+    try:
+        fd = stream.fileno()
+    except (AttributeError, IOError, OSError, ValueError):
+        return
+    null = os.open(os.devnull, os.O_WRONLY)
+    try:
+        os.dup2(null, fd)
+    finally:
+        os.close(null)
+
+
+def open_stream(name, position=None, prefix=b""):
+    """Opens a logical stream for reading.
+
+    Args:
+        name: the logical stream name.
+        position: (segment, offset) tuple where reading starts, the index
+                  in find_segments(name) of a segment and an offset in its
+                  uncompressed bytes, None to read from the start.
+        prefix: bytes read before those of the stream.
+
+    Returns:
+        A buffered binary file object over all the segments in order.
+    """
+    segments = find_segments(name)
+    (segment, offset) = position or (0, 0)
+    return io.BufferedReader(
+        _SegmentReader(segments[segment:], offset, prefix))
+
+
+class DiskBudget(object):
+    """Limits the disk space used by the segments of all streams.
+
+    When closed segments exceed the budget the oldest are deleted.
+    The first segment of each stream is never deleted because it holds
+    the header of binary dumps.
+    """
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._total = 0
+        self._deletable = []
+        self._lock = threading.Lock()
+
+    def add(self, filename, first=False):
+        """Accounts for a closed segment and deletes old ones if needed."""
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            return
+        with self._lock:
+            self._total += size
+            if not first:
+                self._deletable.append((filename, size))
+            while self._total > self._max_bytes and self._deletable:
+                (oldest, size) = self._deletable.pop(0)
+                try:
+                    os.remove(oldest)
+                except OSError:
+                    pass
+                self._total -= size
+
+
+class RotatingStream(object):
+    """Writable stream split into compressed and/or rotated segments.
+
+    A new segment is started when the current one would grow past
+    max_size bytes (before compression) or is older than max_age seconds.
+    Writes are never split across segments.
+    """
+    def __init__(self, filename, mode="w", compression=None, max_size=None,
+                 max_age=None, budget=None):
+        """Opens the first segment.
+
+        Args:
+            filename: the logical stream name.
+            mode: "w" or "wb".
+            compression: None, "gzip", "zstd" or "lz4".
+            max_size: maximum uncompressed bytes in a segment.
+            max_age: maximum seconds a segment is written to.
+            budget: DiskBudget shared by all the streams, if any.
+        """
+        self._filename = filename
+        self._mode = mode
+        (self._suffix, self._opener) = (
+            _COMPRESSIONS[compression] if compression else ("", open))
+        self._max_size = max_size
+        self._max_age = max_age
+        self._rotate = bool(max_size or max_age)
+        self._budget = budget
+        self._index = 0
+        self._stream = None
+        self._open()
+
+    def _open(self):
+        if self._rotate:
+            name = "{0}.{1}".format(self._filename, self._index)
+        else:
+            name = self._filename
+        self._path = name + self._suffix
+        self._stream = self._opener(self._path, self._mode)
+        self._size = 0
+        self._opened = time()
+        self._last_flush = self._opened
+
+    def _close(self):
+        self._stream.close()
+        if self._budget is not None:
+            self._budget.add(self._path, self._index == 0)
+
+    def close(self):
+        self._close()
+
+    def fileno(self):
+        return self._stream.fileno()
+
+    def flush(self):
+        if self._suffix:
+            now = time()
+            if now - self._last_flush < _COMPRESSED_FLUSH_INTERVAL:
+                return
+            self._last_flush = now
+        self._stream.flush()
+
+    def write(self, data):
+        if self._size and (
+                (self._max_size and self._size + len(data) > self._max_size) or
+                (self._max_age and time() - self._opened >= self._max_age)):
+            self._close()
+            self._index += 1
+            self._open()
+        self._stream.write(data)
+        self._size += len(data)
@@ -4,20 +4,107 @@
 MultiThreaded profiler aggregating data from other profiler libraries.
 """
 
+import atexit
+from os import devnull
 from os import getpid
+from os import getppid
+from os import kill
 from os import makedirs
 from os import path
+from os import remove
+from os import rename
+import signal
+from site import addsitedir
 import sys
+import time as _time
 from time import time
 import threading
+from types import BuiltinFunctionType
+import weakref
 #import traceback
 
-from pympler.process import ProcessMemoryInfo
+try:
+    from os import PRIO_PROCESS
+    from os import getpriority
+    from os import setpriority
+except ImportError:
+    setpriority = None
+
+try:
+    from os import register_at_fork
+except ImportError:
+    register_at_fork = None
+
+try:
+    from threading import get_ident as _get_ident
+except ImportError:
+    from thread import get_ident as _get_ident
+
+try:
+    from time import perf_counter_ns as _wall_clock
+except ImportError:
+    # Python 2.7 has no perf_counter either.
+    _wall_clock_seconds = getattr(_time, "perf_counter", _time.time)
+
+    def _wall_clock():
+        return int(_wall_clock_seconds() * 1000000000)
+
+# Not available on every platform.
+_cpu_clock = getattr(_time, "thread_time_ns", None)
+
+try:
+    from asyncio import _get_running_loop
+    from asyncio import current_task as _current_task
+except ImportError:
+    _current_task = None
+
+from BlockingCalls import BlockingRegistry
+from CallFilter import CallFilter
+from ControlChannel import ControlServer
+from DumpFormat import BinaryWriter
+from DumpFormat import KIND_BLOCK
+from DumpFormat import KIND_MEMORY
+from DumpFormat import KIND_MEMORY_TIMED
+from DumpFormat import KIND_STACK
+from DumpFormat import SymbolTable
+from DumpFormat import TextWriter
+from DumpFormat import write_snapshot
+from DumpFormat import write_stats
+from EventQueue import QueuedWriter
+from EventQueue import RingBuffer
+from MemorySource import TracemallocMemorySource
+from MemorySource import createMemorySource
+from MemorySource import processCounters
+from OutputStream import DiskBudget
+from OutputStream import RotatingStream
+from OutputStream import discard_stream
+from OutputStream import find_segments
+
+
+_memory_source = None
 
 
 def _getProcessMemory():
     """Utility function that defined the logic to get memory."""
-    return ProcessMemoryInfo().rss
+    return _memory_source.rss()
+
+
+def setMemorySource(source=None, max_age=None):
+    """Selects the process-wide source used to read memory usage.
+
+    Args:
+        source: "statm", "pympler", an object with an rss method or None
+                to pick the fastest available source.
+        max_age: reuse readings younger than max_age microseconds.
+                 Only applies to sources selected by name.
+    """
+    global _memory_source
+    if source is None or isinstance(source, str):
+        source = createMemorySource(source, max_age)
+    _memory_source = source
+
+
+setMemorySource()
 
 
 class _ThreadLocals(object):
@@ -49,6 +136,344 @@ class _ThreadLocals(object):
         return self._locals.thread_name
 
 
+# Initial depth of the per-thread shadow stacks, they grow when needed.
+_SHADOW_STACK_SIZE = 64
+
+# One event in _DISPATCH_SAMPLE is timed to estimate the time spent in the
+# profile function, odd so that calls and returns are both sampled.
+_DISPATCH_SAMPLE = 61
+
+
+def _calibrationCall():
+    pass
+
+
+def _calibrationWorkload(calls):
+    """Makes calls Python calls, used to calibrate the profiler."""
+    call = _calibrationCall
+    for _ in range(calls):
+        call()
+
+
+# The profiler whose settings are sent to the children spawned by
+# multiprocessing and the original multiprocessing function it replaces.
+_spawning_profile = None
+_preparation_data = None
+
+
+class _SpawnPath(object):
+    """Adds the directory of the profiler to sys.path when unpickled.
+
+    The data multiprocessing sends to the children is unpickled before the
+    child sets up sys.path, see _SpawnBootstrap.
+    """
+    def __reduce__(self):
+        return (addsitedir, (path.dirname(path.abspath(__file__)),))
+
+
+class _SpawnBootstrap(object):
+    """Profiles a child process started by multiprocessing.
+
+    An instance is added to the data multiprocessing sends to the children
+    it starts with the spawn and forkserver methods: unpickling it in the
+    child starts a profiler with the settings of the parent.
+    It is pickled as a call to _startSpawnedProfile, after a _SpawnPath
+    so that Profiler can be imported.
+    """
+    def __init__(self, settings):
+        self._settings = settings
+
+    def __reduce__(self):
+        return (_startSpawnedProfile, (self._settings,))
+
+
+def _preparationData(name):
+    """Replaces multiprocessing.spawn.get_preparation_data."""
+    data = _preparation_data(name)
+    profile = _spawning_profile
+    if profile is not None and profile._enabled:
+        # Unpickled in order.
+        data["thread_graph"] = (
+            _SpawnPath(), _SpawnBootstrap(profile._spawnSettings()))
+    return data
+
+
+def _startSpawnedProfile(settings):
+    """Profiles a child process spawned by multiprocessing."""
+    profile = ProcessProfile(default_log_path=settings["log_path"],
+                             profile=settings["profile"])
+    profile._applySettings(settings)
+    profile._writeProcessInfo("spawn", settings["parent"])
+    profile._installTerminateHandler()
+    profile.enable()
+
+
+def _hookMultiprocessing(profile):
+    """Profiles the children started by multiprocessing.
+
+    Spawned children receive the settings of the profile with the data
+    multiprocessing sends them, see _SpawnBootstrap.
+    Forked children are profiled by the fork hooks but exit without running
+    the atexit handlers so a multiprocessing finalizer writes their events.
+    Children terminated with SIGTERM (Pool.terminate) write them from a
+    signal handler, see _installTerminateHandler.
+    """
+    global _preparation_data, _spawning_profile
+    try:
+        from multiprocessing import spawn
+        from multiprocessing import util
+    except ImportError:
+        return
+    if _preparation_data is None:
+        _preparation_data = spawn.get_preparation_data
+        spawn.get_preparation_data = _preparationData
+    if _spawning_profile is not profile:
+        _spawning_profile = profile
+        util.register_after_fork(profile, ProcessProfile._registerFinalizer)
+
+
+class _PeriodicThread(threading.Thread):
+    """Daemon thread that calls a function at a fixed interval.
+
+    With nice set the thread lowers its own scheduling priority by that
+    much, where a single thread can be reniced (Linux).
+    With tracing set, a TracemallocMemorySource, counting is paused while
+    the function runs so that its allocations are not charged to the
+    profiled threads.
+    """
+    def __init__(self, interval, function, name=None, nice=None,
+                 tracing=None):
+        super(_PeriodicThread, self).__init__(name=name)
+        self.daemon = True
+        # Marks the thread so that it is never profiled.
+        self.profiler_thread = True
+        self._interval = interval
+        self._function = function
+        self._nice = nice
+        self._tracing = tracing
+        self._stopped = threading.Event()
+
+    def _renice(self):
+        # Elsewhere the priority applies to the whole process.
+        if setpriority is None or not sys.platform.startswith("linux"):
+            return
+        try:
+            thread = threading.get_native_id()
+            setpriority(PRIO_PROCESS, thread,
+                        getpriority(PRIO_PROCESS, thread) + self._nice)
+        except (AttributeError, OSError):
+            pass
+
+    def run(self):
+        # Never profile the profiler's own threads.
+        sys.setprofile(None)
+        if self._nice:
+            self._renice()
+        while not self._stopped.wait(self._interval):
+            owner = self._tracing.pause() if self._tracing else None
+            try:
+                self._function()
+            except Exception:
+                # Keep going: a failed sample should not stop collection.
+                pass
+            finally:
+                if self._tracing:
+                    self._tracing.resume(owner)
+
+    def stop(self):
+        """Stops the thread and waits for it to terminate."""
+        self._stopped.set()
+        if self is not threading.current_thread():
+            self.join()
+
+
+class _IgnoredThread(object):
+    """Stands in for the profiler of threads that are not profiled."""
+    _decisions = {}
+
+    def _dispatch(self, frame, event, arg):
+        pass
+
+
+class _TaskRouter(object):
+    """Routes the events of a thread to the profiler of the current task.
+
+    Installed as profile function of the thread in asyncio mode.
+    Events outside of a task, e.g. those of the event loop itself, go to
+    the profiler of the thread.
+    Each task has its own profiler and so its own shadow stack: resuming
+    a coroutine is a call and suspending it a return on the stack of the
+    task, which is not disturbed by the other tasks.
+    """
+    def __init__(self, process, thread, thread_stats):
+        self._process = process
+        self._thread = thread
+        self._thread_stats = thread_stats
+        self._profiles = weakref.WeakKeyDictionary()
+        # Most consecutive events belong to the same task.
+        self._task = None
+        self._task_stats = thread_stats
+
+    @property
+    def _decisions(self):
+        return self._thread_stats._decisions
+
+    def _dispatch(self, frame, event, arg):
+        """Forwards the event to the profiler of the current task."""
+        if not self._process._enabled:
+            # A thread idle while the profiler was enabled, its tasks are
+            # not profiled.
+            return
+        try:
+            loop = _get_running_loop()
+            task = _current_task(loop) if loop is not None else None
+            if task is not self._task:
+                self._task = task
+                if task is None:
+                    self._task_stats = self._thread_stats
+                else:
+                    self._task_stats = self._profiles.get(task)
+                    if self._task_stats is None:
+                        self._task_stats = self._process._newTaskProfile(
+                            self._thread, task)
+                        self._profiles[task] = self._task_stats
+            self._task_stats._dispatch(frame, event, arg)
+        except:
+            # See ProcessProfile._dispatch.
+            pass
+
+
+class _Monitor(object):
+    """Receives events from sys.monitoring (Python 3.12 or later).
+
+    Events are converted into the equivalent sys.setprofile events and
+    forwarded to the thread profilers so the output does not change.
+    Functions rejected by the filter are disabled with
+    sys.monitoring.DISABLE so they run at full speed after the first call.
+    """
+    _METHOD_DESCRIPTOR = type(str.join)
+
+    def __init__(self, process, profile):
+        self._process = process
+        self._profile = profile if profile else "both"
+        self._locals = threading.local()
+
+    def _cFunction(self, callable, arg0):
+        """Returns the C function being called, None for other callables."""
+        if type(callable) is BuiltinFunctionType:
+            return callable
+        if (type(callable) is self._METHOD_DESCRIPTOR and
+                arg0 is not sys.monitoring.MISSING):
+            return callable.__get__(arg0)
+        return None
+
+    def _threadProfile(self):
+        try:
+            return self._locals.profile
+        except AttributeError:
+            # Events start before a new thread is registered, looking it
+            # up with current_thread would create a dummy thread instead.
+            current = threading._active.get(_get_ident())
+            if current is None:
+                return _IgnoredThread()
+            if getattr(current, "profiler_thread", False):
+                thread_stats = _IgnoredThread()
+            else:
+                thread_stats = self._process._threadDispatcher(current.name)
+            self._locals.profile = thread_stats
+            return thread_stats
+
+    def _pyStart(self, code, offset):
+        try:
+            thread_stats = self._threadProfile()
+        except:
+            return None
+        thread_stats._dispatch(sys._getframe(1), "call", None)
+        if thread_stats._decisions.get(code) is False:
+            return sys.monitoring.DISABLE
+
+    def _pyReturn(self, code, offset, retval):
+        try:
+            thread_stats = self._threadProfile()
+        except:
+            return None
+        if thread_stats._decisions.get(code) is False:
+            return sys.monitoring.DISABLE
+        thread_stats._dispatch(sys._getframe(1), "return", retval)
+
+    def _pyUnwind(self, code, offset, exception):
+        try:
+            self._threadProfile()._dispatch(
+                sys._getframe(1), "exception", exception)
+        except:
+            pass
+
+    def _cCall(self, code, offset, callable, arg0):
+        function = self._cFunction(callable, arg0)
+        if function is not None:
+            try:
+                self._threadProfile()._dispatch(
+                    sys._getframe(1), "c_call", function)
+            except:
+                pass
+
+    def _cReturn(self, code, offset, callable, arg0):
+        function = self._cFunction(callable, arg0)
+        if function is not None:
+            try:
+                self._threadProfile()._dispatch(
+                    sys._getframe(1), "c_return", function)
+            except:
+                pass
+
+    def _cRaise(self, code, offset, callable, arg0):
+        function = self._cFunction(callable, arg0)
+        if function is not None:
+            try:
+                self._threadProfile()._dispatch(
+                    sys._getframe(1), "c_exception", function)
+            except:
+                pass
+
+    def reset(self):
+        """Forgets the thread profilers, used after a fork."""
+        self._locals = threading.local()
+
+    def restart(self):
+        """Re-enables the locations disabled by the filter."""
+        sys.monitoring.restart_events()
+
+    def start(self):
+        monitoring = sys.monitoring
+        events = monitoring.events
+        tool = monitoring.PROFILER_ID
+        monitoring.use_tool_id(tool, "ThreadGraph")
+        callbacks = {}
+        if self._profile != "c":
+            callbacks[events.PY_START] = self._pyStart
+            callbacks[events.PY_RETURN] = self._pyReturn
+            callbacks[events.PY_UNWIND] = self._pyUnwind
+        if self._profile != "python":
+            callbacks[events.CALL] = self._cCall
+            callbacks[events.C_RETURN] = self._cReturn
+            callbacks[events.C_RAISE] = self._cRaise
+        mask = 0
+        for (event, callback) in callbacks.items():
+            monitoring.register_callback(tool, event, callback)
+            mask |= event
+        monitoring.set_events(tool, mask)
+
+    def stop(self):
+        monitoring = sys.monitoring
+        tool = monitoring.PROFILER_ID
+        monitoring.set_events(tool, 0)
+        for event in (monitoring.events.PY_START, monitoring.events.PY_RETURN,
+                      monitoring.events.PY_UNWIND, monitoring.events.CALL,
+                      monitoring.events.C_RETURN, monitoring.events.C_RAISE):
+            monitoring.register_callback(tool, event, None)
+        monitoring.free_tool_id(tool)
+
+
 class ProcessProfile(object):
     """Keeps track of profiling information for the current process.
 
@@ -86,27 +511,140 @@ class ProcessProfile(object):
         self._default_log_path = default_log_path if default_log_path else "."
         self._profile = profile
         self._threads = {}
+        self._routers = {}
         self._previous_profiler = None
         self._main_pid = getpid()
         self._locals = _ThreadLocals()  # Per-thread locals.
+        self._enabled = False
+        self._closed = False
+        # Held while the pending events are written at exit.
+        self._exit_lock = threading.Lock()
 
         # Store process-level memory.
+        self._compression = None
+        self._segment_size = None
+        self._segment_age = None
+        self._disk_budget = None
+        self._budget = None
         self._openProcessStream()
 
         # Store process-level tweeks.
         self._proc_mem_check = 0
-        self._proc_mem_freq = 1000
+        self._proc_mem_freq = None
+        self._proc_mem_interval = 0.1
+        self._proc_mem_counters = False
+        self._memory_sampler = None
         self._profile_forked = False
+        self._sampling_interval = None
+        self._sampler = None
+        self._monitoring = False
+        self._monitor = None
+        self._queue_size = None
+        self._queue_policy = "drop"
+        self._writer_interval = None
+        self._writer = None
 
         # Store defaults for new thread profilers.
-        self._filter = ""
+        self._filter = CallFilter()
         self._mem = True
         self._times = True
+        self._durations = None
         self._sleep = True
+        self._blocking = BlockingRegistry()
+        self._block_threshold = None
         self._stack = False
+        self._binary = False
+        self._symbols = None
+        self._buffer_size = None
+        self._flush_interval = None
+        self._tracemalloc = None
+        self._aggregate = False
+        self._asyncio = False
+        self._throttle = None
+        self._snapshot_interval = None
+        self._snapshotter = None
+        self._control = None
+        self._control_default = False
+        self._calibration = {}
+
+        self._writeProcessInfo("main")
+
+        # Buffered events would be lost if the process exits without
+        # disabling the profiler.
+        atexit.register(self._atExit)
+
+        # Where possible forks are detected by a hook rather than checking
+        # the pid at every event.
+        if register_at_fork:
+            register_at_fork(after_in_child=self._afterFork)
+
+    def _afterFork(self):
+        """Called in the child process after a fork."""
+        if not self._enabled:
+            return
+        if self._forked():
+            self._startThreads()
+            if self._monitor is not None:
+                self._monitor.reset()
+            elif not self._sampling_interval:
+                sys.setprofile(self._bootstrap)
+        else:
+            self._enabled = False
+            if self._monitor is not None:
+                self._monitor.stop()
+                self._monitor = None
+            else:
+                sys.setprofile(self._previous_profiler)
+                threading.setprofile(self._previous_profiler)
+
+    def _atExit(self):
+        with self._exit_lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._memory_sampler is not None:
+                self._memory_sampler.stop()
+                self._memory_sampler = None
+            self.flush()
+            if self._aggregate and self._threads:
+                self.writeSnapshot()
+            if self._threads:
+                self.writeStats()
+            if self._compression:
+                # Compressed streams are only complete once closed.
+                for thread in list(self._threads.values()):
+                    thread.closeStreams()
+                self._proc_mem.close()
+
+    def _bootstrap(self, frame, event, arg):
+        """Installs the thread profiler as profile function of the thread.
+
+        This is the first profile function called in every thread.
+        After that the events go straight to the thread profiler without
+        any further routing.
+        Nothing is installed once the profiler is disabled, in case a
+        thread idle while it was enabled sends its first event after.
+        """
+        if not self._enabled:
+            return
+        try:
+            current = threading.current_thread()
+            if getattr(current, "profiler_thread", False):
+                sys.setprofile(None)
+                return
+            thread_stats = self._threadDispatcher(current.name)
+            sys.setprofile(thread_stats._dispatch)
+            thread_stats._dispatch(frame, event, arg)
+        except:
+            # See _dispatch.
+            pass
 
     def _dispatch(self, frame, event, arg):
-        """Dispatches the event to the appropriate thread profiler."""
+        """Dispatches the event to the appropriate thread profiler.
+
+        Used on Python versions without os.register_at_fork, otherwise
+        each thread profiler receives events directly (see _bootstrap).
+        """
         try:
             # It seems that sometimes, when the VM exits and the profiler
             # is enabled the dispatch method is called during the tear-down
@@ -120,35 +658,23 @@ class ProcessProfile(object):
             # function and open file descriptors.
             # Check here if the PID changed and react appropriately.
             if getpid() != self._main_pid:
-                if self._profile_forked:
-                    self._proc_mem.close()
-                    self._openProcessStream()
-                    self._threads = {}
-                    self._main_pid = getpid()
+                if self._forked():
+                    self._startThreads()
                 else:
                     self.disable()
                     return None
 
-            # Log process-level memory usage.
-            if self._proc_mem_freq:
-                if self._proc_mem_check == 0:
-                    stamp = str(time()) + "#" if self._times else ""
-                    self._proc_mem.write("{0}{1}\n".format(
-                        stamp, _getProcessMemory()))
-                    self._proc_mem.flush()
-                self._proc_mem_check = ((self._proc_mem_check + 1) %
-                                        self._proc_mem_freq)
-
             # Dispatch to thread-level profiler.
             thread = self._locals.getThreadName()
             thread_stats = self._threads.get(thread)
-            if thread_stats is None:
-                thread_stats = ThreadProfile(
-                    stream_factory=self._stream_factory, profile=self._profile,
-                    track_memory=self._mem, track_times=self._times,
-                    track_stack=self._stack, track_sleep=self._sleep)
-                thread_stats.setFilter(self._filter)
-                self._threads[thread] = thread_stats
+            if (thread_stats is None and
+                    getattr(threading.current_thread(), "profiler_thread",
+                            False)):
+                # See _bootstrap.
+                sys.setprofile(None)
+                return None
+            if thread_stats is None or self._asyncio:
+                thread_stats = self._threadDispatcher(thread)
             thread_stats._dispatch(frame, event, arg)
             return self._dispatch
         # Used to debug tool.
@@ -162,47 +688,597 @@ class ProcessProfile(object):
             # Catch all to prevent unexpected and unexplained terminations.
             return self._dispatch
 
+    def _forked(self):
+        """Resets the state inherited from the parent after a fork.
+
+        Events buffered before the fork are written by the parent so
+        the thread profilers are discarded, and the profiler threads did
+        not survive the fork.
+
+        Returns:
+            True if the child process should be profiled.
+        """
+        parent = self._main_pid
+        for thread_stats in list(self._threads.values()):
+            thread_stats.discardStreams()
+        discard_stream(self._proc_mem)
+        self._threads = {}
+        self._routers = {}
+        self._writer = None
+        self._sampler = None
+        self._memory_sampler = None
+        self._snapshotter = None
+        self._main_pid = getpid()
+        if self._control is not None:
+            # The socket belongs to the parent.
+            self._control.close()
+            self._control = None
+        if not self._profile_forked:
+            return False
+        self._proc_mem.close()
+        if self._disk_budget:
+            # The segments of the parent are not ours to delete.
+            self._budget = DiskBudget(self._disk_budget)
+        self._openProcessStream()
+        self._writeProcessInfo("fork", parent)
+        if self._symbols:
+            self.useSymbols()
+        if self._control_default:
+            self.listen()
+        return True
+
+    def _logProcessMemory(self):
+        """Logs process-level memory usage every _proc_mem_freq calls."""
+        if self._proc_mem_freq:
+            if self._proc_mem_check == 0:
+                self._writeProcessMemory()
+            self._proc_mem_check = ((self._proc_mem_check + 1) %
+                                    self._proc_mem_freq)
+
+    def _processTick(self):
+        """Returns the process_tick function of the thread profilers."""
+        return self._logProcessMemory if self._proc_mem_freq else None
+
+    def _applySettings(self, settings):
+        """Configures the profiler with settings from _spawnSettings."""
+        self.setFilter(CallFilter(**settings["filter"]))
+        self.trackMemory(settings["memory"])
+        self.logTimestamps(settings["timestamps"])
+        durations = settings["durations"]
+        self.trackDurations(durations is not None, durations == "cpu")
+        self.trackSleeps(settings["sleeps"])
+        if settings["blocking"] is not None:
+            self.trackBlocking(True, settings["blocking"])
+        self.trackStack(settings["stack"])
+        self.useBinaryFormat(settings["binary"])
+        self.useSymbols(settings["symbols"])
+        self.setBuffering(*settings["buffering"])
+        if settings["tracemalloc"] is not None:
+            self.useTracemalloc(depth=settings["tracemalloc"])
+        self.useAggregation(*settings["aggregate"])
+        self.useAsyncio(settings["asyncio"])
+        if settings["throttle"] is not None:
+            self.useThrottling(True, *settings["throttle"])
+        self.useMonitoring(settings["monitoring"])
+        if any(settings["storage"]):
+            self.setStorage(*settings["storage"])
+        (size, policy, interval) = settings["writer"]
+        self.useWriterThread(size is not None, size, policy, interval)
+        self.setSamplingInterval(settings["sampling"])
+        if settings["frequency"]:
+            self.setProcessMemoryFrequence(settings["frequency"])
+        else:
+            self.setProcessMemoryInterval(*settings["memory_interval"])
+        self.enableForkedProfile()
+        if settings["listen"]:
+            self.listen()
+
+    def _newThreadProfile(self, thread):
+        """Creates and registers the profiler for the named thread."""
+        stream_factory = self._stream_factory
+        if stream_factory == self.default_stream_factory:
+            # The thread creating the streams is not the profiled one
+            # when sampling so name the files explicitly.
+            def stream_factory(stream_type, mode="w"):
+                return self.default_stream_factory(stream_type, mode, thread)
+        memory_usage = None
+        tracing = None
+        if self._tracemalloc is not None:
+            # Samples are taken by another thread so per-thread
+            # attribution is not possible.
+            if self._sampling_interval:
+                memory_usage = self._tracemalloc.rss
+            else:
+                memory_usage = self._tracemalloc.threadUsage
+                tracing = self._tracemalloc
+        thread_stats = ThreadProfile(
+            stream_factory=stream_factory, profile=self._profile,
+            track_memory=self._mem, track_times=self._times,
+            track_stack=self._stack,
+            track_sleep=self._sleep and memory_usage is None,
+            process_tick=self._processTick(), binary=self._binary, buffer_size=self._buffer_size,
+            flush_interval=self._flush_interval, queue_size=self._queue_size,
+            queue_policy=self._queue_policy, symbols=self._symbols,
+            memory_usage=memory_usage, tracing=tracing,
+            aggregate=self._aggregate,
+            # The CPU time of the sampler thread means nothing.
+            durations=("wall" if self._durations and self._sampling_interval
+                       else self._durations),
+            throttle=self._throttle, blocking=self._blocking,
+            track_blocking=(None if self._sampling_interval
+                            else self._block_threshold))
+        thread_stats.setFilter(self._filter)
+        self._threads[thread] = thread_stats
+        return thread_stats
+
+    def _newTaskProfile(self, thread, task):
+        """Creates and registers the profiler for an asyncio task.
+
+        The profiler is registered as "THREAD@TASK", where TASK is the name
+        of the task, and its streams are closed when the task is done.
+        """
+        get_name = getattr(task, "get_name", None)
+        task_name = get_name() if get_name else "Task-{0}".format(id(task))
+        name = "{0}@{1}".format(thread, task_name.replace("/", "_"))
+        if name in self._threads:
+            # Task names are not necessarily unique.
+            name = "{0}-{1}".format(name, id(task))
+        thread_stats = self._newThreadProfile(name)
+        task.add_done_callback(lambda task: thread_stats.closeStreams())
+        return thread_stats
+
+    def _threadDispatcher(self, thread):
+        """Returns the object receiving the events of the named thread.
+
+        That is the profiler of the thread or, in asyncio mode, the router
+        dispatching the events to the profilers of its tasks.
+        """
+        thread_stats = self._threads.get(thread)
+        if thread_stats is None:
+            thread_stats = self._newThreadProfile(thread)
+        if not self._asyncio:
+            return thread_stats
+        router = self._routers.get(thread)
+        if router is None:
+            router = _TaskRouter(self, thread, thread_stats)
+            self._routers[thread] = router
+        return router
+
+    def _registerFinalizer(self):
+        """Writes pending events when a multiprocessing child exits.
+
+        Called in the children started by multiprocessing.
+        """
+        from multiprocessing import util
+        # Run after the finalizers of the program.
+        util.Finalize(None, self._atExit, exitpriority=-100)
+        self._installTerminateHandler()
+
+    def _installTerminateHandler(self):
+        """Writes pending events when a multiprocessing child is terminated.
+
+        Pool.terminate and Process.terminate send SIGTERM, which exits
+        without running the finalizers or the atexit handlers.
+        On SIGTERM the profiler is closed, then the process is terminated
+        as the default action would.
+        Programs handling SIGTERM themselves keep their handler.
+        """
+        try:
+            if signal.getsignal(signal.SIGTERM) != signal.SIG_DFL:
+                return
+            signal.signal(signal.SIGTERM, self._terminated)
+        except ValueError:
+            # Not called from the main thread.
+            pass
+
+    def _terminated(self, signum, frame):
+        """SIGTERM handler installed by _installTerminateHandler.
+
+        The interrupted code may hold locks the profiler needs (or be
+        the profiler itself), so it is closed by another thread while the
+        main thread carries on.
+        """
+        signal.signal(signum, signal.SIG_DFL)
+        thread = threading.Thread(target=self._terminate, args=(signum,),
+                                  name="ThreadGraph terminate")
+        thread.daemon = True
+        thread.profiler_thread = True
+        thread.start()
+
+    def _terminate(self, signum):
+        # Waits for the pending events being written if the process is
+        # already exiting, in which case it exits before the kill.
+        with self._exit_lock:
+            self.close()
+        kill(getpid(), signum)
+
+    def _sample(self):
+        """Records the current stack of every thread.
+
+        Called periodically by the sampler thread.
+        """
+        self._logProcessMemory()
+        names = dict((t.ident, t.getName()) for t in threading.enumerate()
+                     if not getattr(t, "profiler_thread", False))
+        sampled = set()
+        for (ident, frame) in sys._current_frames().items():
+            thread = names.get(ident)
+            if thread is None:
+                continue
+            thread_stats = self._threads.get(thread)
+            if thread_stats is None:
+                thread_stats = self._newThreadProfile(thread)
+            thread_stats._sample(frame)
+            sampled.add(thread)
+        # Unwind the stacks of threads that terminated.
+        for (thread, thread_stats) in list(self._threads.items()):
+            if thread not in sampled:
+                thread_stats._sample(None)
+
+    def _spawnSettings(self):
+        """Returns the settings of the profiler made of builtin types only.
+
+        A custom stream factory and memory source are not included.
+        """
+        return {
+            "log_path": self._default_log_path,
+            "profile": self._profile,
+            "parent": getpid(),
+            "filter": self._filter.rules,
+            "memory": self._mem,
+            "timestamps": self._times,
+            "durations": self._durations,
+            "sleeps": self._sleep,
+            "blocking": self._block_threshold,
+            "stack": self._stack,
+            "binary": self._binary,
+            "symbols": self._symbols is not None,
+            "buffering": (self._buffer_size, self._flush_interval),
+            "tracemalloc": (self._tracemalloc.depth if self._tracemalloc
+                            else None),
+            "aggregate": (self._aggregate, self._snapshot_interval),
+            "asyncio": self._asyncio,
+            "throttle": self._throttle,
+            "monitoring": self._monitoring,
+            "storage": (self._compression, self._segment_size,
+                        self._segment_age, self._disk_budget),
+            "writer": (self._queue_size, self._queue_policy,
+                       self._writer_interval),
+            "sampling": self._sampling_interval,
+            "frequency": self._proc_mem_freq,
+            "memory_interval": (self._proc_mem_interval,
+                                self._proc_mem_counters),
+            "listen": self._control_default
+        }
+
+    def _startThreads(self):
+        """Starts the writer and sampler threads if needed."""
+        if self._queue_size and self._writer is None:
+            self._writer = _PeriodicThread(
+                self._writer_interval, self.flush, name="ThreadGraph writer",
+                tracing=self._tracemalloc)
+            self._writer.start()
+        if self._sampling_interval and self._sampler is None:
+            self._sampler = _PeriodicThread(
+                self._sampling_interval, self._sample,
+                name="ThreadGraph sampler")
+            self._sampler.start()
+        if self._proc_mem_interval and self._memory_sampler is None:
+            self._memory_sampler = _PeriodicThread(
+                self._proc_mem_interval, self._writeProcessMemory,
+                name="ThreadGraph memory", nice=10,
+                tracing=self._tracemalloc)
+            self._memory_sampler.start()
+        if (self._aggregate and self._snapshot_interval and
+                self._snapshotter is None):
+            self._snapshotter = _PeriodicThread(
+                self._snapshot_interval, self.writeSnapshot,
+                name="ThreadGraph snapshot", tracing=self._tracemalloc)
+            self._snapshotter.start()
+
     def _openProcessStream(self):
         basepath = path.join(self._default_log_path, str(getpid()))
         filename = path.join(basepath, "process.mem")
         if not path.exists(basepath):
             makedirs(basepath)
-        self._proc_mem = open(filename, "w")
+        self._proc_mem = self._openStream(filename, "w")
+
+    def _updateProcessMemory(self):
+        """Applies the process memory settings to the running profiler."""
+        tick = self._processTick()
+        for thread in self._threads.values():
+            thread.setProcessTick(tick)
+        if self._memory_sampler is not None:
+            self._memory_sampler.stop()
+            self._memory_sampler = None
+        if self._enabled:
+            self._startThreads()
+
+    def _writeProcessMemory(self):
+        """Writes a sample of the process memory to process.mem."""
+        stamp = str(time()) + "#" if self._times else ""
+        sample = str(_getProcessMemory())
+        if self._proc_mem_counters:
+            sample += "".join(";" + str(value) for value in processCounters())
+        self._proc_mem.write("{0}{1}\n".format(stamp, sample))
+        self._proc_mem.flush()
+
+    def _openStream(self, filename, mode):
+        """Opens an output file with the configured storage options."""
+        if not (self._compression or self._segment_size or self._segment_age):
+            return open(filename, mode)
+        return RotatingStream(filename, mode, self._compression,
+                              self._segment_size, self._segment_age,
+                              self._budget)
+
+    def _writeProcessInfo(self, start, parent=0):
+        """Describes the process in "process.info", next to "process.mem".
 
-    def default_stream_factory(self, stream_type):
+        Args:
+            start: how the process was started, "main", "fork" or "spawn".
+            parent: pid of the profiled parent process, 0 if none.
+        """
+        basepath = path.join(self._default_log_path, str(getpid()))
+        if not path.exists(basepath):
+            makedirs(basepath)
+        with open(path.join(basepath, "process.info"), "w") as stream:
+            write_stats(stream, [("pid", getpid()), ("parent", parent),
+                                 ("ppid", getppid()), ("start", start),
+                                 ("time", time())])
+
+    def calibrate(self, calls=20000):
+        """Measures the cost of each enabled profiler feature.
+
+        Similar in spirit to profile.Profile.calibrate: a workload of calls
+        to an empty function is run without profiling and then profiled with
+        each feature enabled on its own, writing to os.devnull.
+        The results are written to "profiler.stats" with the other counters
+        so that ProfilerGraph can subtract the overhead from durations.
+        Must be called while the profiler is disabled.
+
+        Args:
+            calls: number of calls in the workload.
+
+        Returns:
+            A dictionary with the nanoseconds per event of the bare dispatch
+            and the extra cost of each enabled feature, and "event" with
+            the cost of an event with all the current settings.
+        """
+        def factory(stream_type, mode="w"):
+            return open(devnull, mode)
+
+        def measure(track_memory=False, track_stack=False, durations=None):
+            best = None
+            for _ in range(3):
+                thread_stats = ThreadProfile(
+                    stream_factory=factory, profile=self._profile,
+                    track_memory=track_memory, track_times=self._times,
+                    track_stack=track_stack, track_sleep=False,
+                    binary=self._binary, buffer_size=self._buffer_size,
+                    flush_interval=self._flush_interval, durations=durations)
+                previous = sys.getprofile()
+                sys.setprofile(thread_stats._dispatch)
+                start = _wall_clock()
+                _calibrationWorkload(calls)
+                elapsed = _wall_clock() - start
+                sys.setprofile(previous)
+                thread_stats.closeStreams()
+                cost = max(elapsed - baseline, 0) / float(thread_stats.events)
+                best = cost if best is None else min(best, cost)
+            return best
+
+        baseline = None
+        for _ in range(3):
+            start = _wall_clock()
+            _calibrationWorkload(calls)
+            elapsed = _wall_clock() - start
+            baseline = elapsed if baseline is None else min(baseline, elapsed)
+        dispatch = measure()
+        results = {"dispatch": dispatch}
+        if self._mem:
+            results["memory"] = measure(track_memory=True) - dispatch
+        if self._stack:
+            results["stack"] = measure(track_stack=True) - dispatch
+        if self._mem and self._durations:
+            results["durations"] = (measure(True, durations=self._durations) -
+                                    measure(track_memory=True))
+        results["event"] = measure(self._mem, self._stack, self._durations)
+        self._calibration = results
+        return results
+
+    def _calibrateTracemalloc(self, calls=1000):
+        """Measures the bytes charged to a thread for each event.
+
+        The allocations of the profiler are not charged but the interpreter
+        still allocates for each event, e.g. frame objects: the bytes
+        charged per event while profiling calls to an empty function are
+        subtracted from the changes charged from now on.
+        """
+        def factory(stream_type, mode="w"):
+            return open(devnull, mode)
+
+        source = self._tracemalloc
+        source.overhead = 0
+        thread_stats = ThreadProfile(
+            stream_factory=factory, profile="python", track_memory=False,
+            track_sleep=False, memory_usage=source.threadUsage,
+            tracing=source)
+        previous = sys.getprofile()
+        before = source.threadUsage()
+        sys.setprofile(thread_stats._dispatch)
+        _calibrationWorkload(calls)
+        sys.setprofile(previous)
+        after = source.threadUsage()
+        thread_stats.closeStreams()
+        source.overhead = int(round(
+            (after - before) / float(thread_stats.events + 1)))
+
+    def close(self):
+        """Stops profiling, writes all pending events and closes the streams.
+
+        Closing more than once has no effect.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if hasattr(atexit, "unregister"):
+            atexit.unregister(self._atExit)
+        self.disable()
+        for thread in list(self._threads.values()):
+            thread.closeStreams()
+        self._proc_mem.close()
+
+    def default_stream_factory(self, stream_type, mode="w", thread_name=None):
         """Creates a file for each thread to log data to.
 
         This is the default function used by the profiler.
+        Custom factories must accept the mode argument when the binary
+        format is enabled.
 
         Args:
           stream_type: Type of information to be stored in the stream.
+          mode: Mode in which the file is opened, "w" or "wb".
+          thread_name: Thread the stream is for, defaults to the current one.
         """
         filename = "{0}.{1}".format(
-            self._locals.getThreadName(), stream_type)
+            thread_name if thread_name else self._locals.getThreadName(),
+            stream_type)
         basepath = path.join(self._default_log_path, str(getpid()))
         filename = path.join(basepath, filename)
         if not path.exists(basepath):
             makedirs(basepath)
-        return open(filename, "w")
+        return self._openStream(filename, mode)
 
     def disable(self):
-        """Stop profiling the program and restore previous profile function."""
-        sys.setprofile(self._previous_profiler)
-        threading.setprofile(self._previous_profiler)
+        """Stop profiling the program and restore previous profile function.
+
+        Before Python 3.12 threads other than the calling one remove their
+        profile function at their next event.
+        """
+        self._enabled = False
+        for thread in list(self._threads.values()):
+            thread.setActive(False)
+        if self._sampler is not None:
+            self._sampler.stop()
+            self._sampler = None
+        elif self._monitor is not None:
+            self._monitor.stop()
+            self._monitor = None
+        elif hasattr(threading, "setprofile_all_threads"):
+            threading.setprofile_all_threads(self._previous_profiler)
+        else:
+            sys.setprofile(self._previous_profiler)
+            threading.setprofile(self._previous_profiler)
+        if self._writer is not None:
+            self._writer.stop()
+            self._writer = None
+        if self._memory_sampler is not None:
+            self._memory_sampler.stop()
+            self._memory_sampler = None
+        if self._tracemalloc is not None:
+            self._tracemalloc.stop()
+        if self._snapshotter is not None:
+            self._snapshotter.stop()
+            self._snapshotter = None
+        self.flush()
+        if self._aggregate:
+            self.writeSnapshot()
+        if self._threads:
+            self.writeStats()
 
     def disableForkedProfile(self):
-        """Do not profile processes forked off the current one."""
+        """Do not profile processes forked or spawned off the current one."""
+        global _spawning_profile
         self._profile_forked = False
+        if _spawning_profile is self:
+            _spawning_profile = None
+
+    def droppedEvents(self):
+        """Returns the number of events dropped because a queue was full."""
+        return sum(thread.droppedEvents()
+                   for thread in list(self._threads.values()))
 
     def enable(self):
         """Start profiling the program."""
+        self._enabled = True
+        for thread in list(self._threads.values()):
+            thread.setActive(True)
+        if self._tracemalloc is not None:
+            self._tracemalloc.start()
+            self._calibrateTracemalloc()
+        # Start the threads before the profile function so that they
+        # are not profiled.
+        self._startThreads()
+        if self._sampling_interval:
+            return
+        if self._monitoring and hasattr(sys, "monitoring"):
+            if self._monitor is None:
+                self._monitor = _Monitor(self, self._profile)
+                self._monitor.start()
+            return
+        profiler = self._bootstrap if register_at_fork else self._dispatch
         self._previous_profiler = sys.getprofile()
-        threading.setprofile(self._dispatch)
-        sys.setprofile(self._dispatch)
+        if hasattr(threading, "setprofile_all_threads"):
+            # Python 3.12 or later can also profile running threads.
+            threading.setprofile_all_threads(profiler)
+            return
+        threading.setprofile(profiler)
+        sys.setprofile(profiler)
 
     def enableForkedProfile(self):
-        """Profile processes forked off the current one."""
+        """Profile processes forked off the current one.
+
+        Processes started by multiprocessing with the spawn or forkserver
+        methods while the profiler is enabled are profiled as well, with the
+        same settings but the default stream factory.
+        Each process writes to its own directory, named after its pid, where
+        "process.info" records the pid of the profiled parent.
+        """
         self._profile_forked = True
+        _hookMultiprocessing(self)
+
+    def flush(self):
+        """Writes all pending events to the streams."""
+        for thread in list(self._threads.values()):
+            thread.flushStreams()
+
+    def installSignalHandler(self, signum=signal.SIGUSR2):
+        """Toggles profiling when the process receives a signal.
+
+        The handler runs in the main thread.
+        Before Python 3.12 enabling the profiler only affects the main
+        thread and threads started after it.
+        """
+        def toggle(signum, frame):
+            if self._enabled:
+                self.disable()
+            else:
+                self.enable()
+        signal.signal(signum, toggle)
+
+    def listen(self, address=None):
+        """Accepts control commands on a Unix domain socket.
+
+        See ControlChannel for the commands.
+        Before Python 3.12 enabling the profiler only affects threads
+        started after it, as running threads cannot be hooked.
+
+        Args:
+            address: path of the socket, "control" next to "process.mem"
+                     by default.
+                     Forked processes, if profiled, listen on their own
+                     default socket.
+        """
+        if self._control is not None:
+            self._control.stop()
+        self._control_default = address is None
+        if address is None:
+            basepath = path.join(self._default_log_path, str(getpid()))
+            if not path.exists(basepath):
+                makedirs(basepath)
+            address = path.join(basepath, "control")
+        self._control = ControlServer(self, address)
+        self._control.start()
 
     def logTimestamps(self, enable=True):
         """Enables or disables collection timestamps."""
@@ -210,6 +1286,39 @@ class ProcessProfile(object):
         for thread in self._threads.values():
             thread.logTimestamps(enable)
 
+    def resyncCount(self):
+        """Returns how many times thread shadow stacks were realigned.
+
+        A realignment happens when a return does not match the last call,
+        usually because some return events were not delivered.
+        """
+        return sum(thread.resyncCount()
+                   for thread in list(self._threads.values()))
+
+    def setBlockingCalls(self, registry):
+        """Sets the BlockingRegistry used by new threads.
+
+        The registry decides which calls are sleeps for sleep tracking
+        and which are reported in the block dumps.
+        Register more functions in the registry to track calls blocking
+        in C extensions, or in Python functions wrapping them.
+        Spawned children use the default registry.
+        """
+        self._blocking = registry
+
+    def setBuffering(self, size=None, interval=None):
+        """Sets the output buffering for new threads.
+
+        Events are kept in memory and written to the per-thread streams
+        when more than size bytes are buffered or when more than interval
+        seconds have passed since the last write.
+        A size of 0 writes and flushes every event.
+        When size is None the default for the output format is used:
+        every event for the text format, 64 KB or 1 second for the binary one.
+        """
+        self._buffer_size = size
+        self._flush_interval = interval
+
     def setFilter(self, filter):
         """Sets a file filter for new and running threads.
 
@@ -217,22 +1326,163 @@ class ProcessProfile(object):
         is checked against the filter. If the filter is a prefix of the
         function filename than the function is profiled, otherwise it is
         ignored. If no filter is defined all functions are profiled.
+
+        The filter can also be a CallFilter, which supports several
+        include and exclude rules based on files, modules and function
+        names as well as selecting C functions by module.
+        Each function is checked against the filter only the first time
+        it is called, rejected functions cost a dictionary lookup after that.
         """
+        if not isinstance(filter, CallFilter):
+            filter = CallFilter.fromPrefix(filter)
         self._filter = filter
         for thread in self._threads.values():
             thread.setFilter(filter)
+        if self._monitor is not None:
+            self._monitor.restart()
 
     def setProcessMemoryFrequence(self, freq):
-        """Sets process-level memory collection frequency.
+        """Collects process-level memory every freq events.
 
-        Process-level memory is collected at any event with a sampling
-        approach to avoid performance impact and log flooding.
-        The frequency defines how many events will be ignored between
-        collections.
+        The sample rate follows the call volume: there are no samples
+        while the process is idle and many during bursts, and every event
+        pays for the counter check.
+        Prefer setProcessMemoryInterval, the default, which this replaces.
+        With sampling, the frequency counts samples.
 
         Set this value to None to disable process-level memory collection.
         """
         self._proc_mem_freq = freq
+        self._proc_mem_interval = None
+        self._updateProcessMemory()
+
+    def setProcessMemoryInterval(self, interval, counters=False):
+        """Collects process-level memory every interval seconds.
+
+        A background thread, with a lowered priority where supported,
+        writes a sample to "process.mem" at a fixed interval whatever the
+        activity of the profiled threads, which do no work for it.
+        This is the default, with a 0.1 seconds interval.
+        Replaces setProcessMemoryFrequence.
+
+        Args:
+            interval: seconds between samples, None disables process-level
+                      memory collection.
+            counters: also record the virtual memory size, the minor and
+                      major page faults and the garbage collections of each
+                      generation (see MemorySource.processCounters).
+        """
+        self._proc_mem_interval = interval
+        self._proc_mem_counters = counters
+        self._proc_mem_freq = None
+        self._updateProcessMemory()
+
+    def setStorage(self, compression=None, max_size=None, max_age=None,
+                   budget=None):
+        """Sets how the default stream factory stores the dumps.
+
+        Must be called before enable: "process.mem" is re-opened.
+
+        Args:
+            compression: None, "gzip" or, when installed, "zstd" or "lz4".
+            max_size: start a new segment of a stream when the current one
+                      would grow past max_size bytes (before compression).
+            max_age: start a new segment of a stream every max_age seconds.
+            budget: once the closed segments use more than budget bytes
+                    delete the oldest ones, except the first of each stream.
+        """
+        self._compression = compression
+        self._segment_size = max_size
+        self._segment_age = max_age
+        self._disk_budget = budget
+        self._budget = DiskBudget(budget) if budget else None
+        # Replace the file opened with the previous options.
+        self._proc_mem.close()
+        basepath = path.join(self._default_log_path, str(getpid()))
+        for segment in find_segments(path.join(basepath, "process.mem")):
+            remove(segment)
+        self._openProcessStream()
+
+    def setSamplingInterval(self, interval):
+        """Switches between sampling and deterministic profiling.
+
+        By default every call and return is intercepted through
+        sys.setprofile, which is accurate but slows down every thread.
+        When an interval (in seconds) is set, enable starts a background
+        thread that records the stack of every thread and the process memory
+        at that interval instead.
+        Calls and returns are inferred by comparing consecutive samples so
+        the dumps have the same format but short calls are missed.
+        With sampling, the process memory frequency counts samples.
+
+        Set this value to None to go back to deterministic profiling.
+        Changes take effect the next time the profiler is enabled.
+        """
+        self._sampling_interval = interval
+
+    def status(self):
+        """Returns a dictionary describing the current settings."""
+        return {
+            "enabled": self._enabled,
+            "memory": self._mem,
+            "stack": self._stack,
+            "sleeps": self._sleep,
+            "blocking": self._block_threshold is not None,
+            "frequency": self._proc_mem_freq,
+            "interval": self._proc_mem_interval,
+            "threads": len(self._threads),
+            "dropped": self.droppedEvents(),
+            "resyncs": self.resyncCount()
+        }
+
+    def stopListening(self):
+        """Stops accepting control commands."""
+        if self._control is not None:
+            self._control.stop()
+            self._control = None
+            self._control_default = False
+
+    def trackBlocking(self, enable=True, threshold=10000):
+        """Writes the calls blocking threads to a "block" dump.
+
+        Each call matched by the BlockingRegistry (see setBlockingCalls)
+        and lasting at least threshold nanoseconds is written with its
+        call site, its wall time and the part of it spent off the CPU,
+        which needs the thread CPU clock (the whole wall time is used
+        otherwise).
+        Waits in registered Python functions, like Queue.get, are written
+        as such, from the line calling them.
+        Applies to new and running threads, not in sampling mode.
+        Requires C function events, which a "python" profile only gets
+        without sys.monitoring.
+
+        Args:
+            enable: write the block dumps.
+            threshold: minimum duration of the calls written, so that
+                       uncontended locks do not flood the dumps.
+        """
+        self._block_threshold = threshold if enable else None
+        for thread in self._threads.values():
+            thread.trackBlocking(self._block_threshold)
+
+    def trackDurations(self, enable=True, cpu=False):
+        """Adds the duration of each call to the memory records.
+
+        Durations are measured from the call to the return with the
+        perf_counter_ns clock, in nanoseconds, and include the time spent
+        in nested calls.
+        The thread CPU time can be recorded as well: a wall time much larger
+        than the CPU time reveals a thread waiting for I/O or the GIL.
+        Only applies to threads created after the call.
+
+        Args:
+            enable: record durations.
+            cpu: also record the thread CPU time, where supported.
+        """
+        if not enable:
+            self._durations = None
+        else:
+            self._durations = "cpu" if cpu and _cpu_clock else "wall"
 
     def trackMemory(self, enable=True):
         """Enables or disables memory tracking for new and running threads."""
@@ -254,9 +1504,9 @@ class ProcessProfile(object):
         strange and/or inconsistent measurements.
         If that happens you are encouraged to disable this feature.
         """
-        self._mem = enable
+        self._sleep = enable
         for thread in self._threads.values():
-            thread.trackMemory(enable)
+            thread.trackSleeps(enable)
 
     def trackStack(self, enable=True):
         """Enables or disables stack tracking for new and running threads."""
@@ -264,6 +1514,217 @@ class ProcessProfile(object):
         for thread in self._threads.values():
             thread.trackStack(enable)
 
+    def useAggregation(self, enable=True, interval=60):
+        """Keeps per-function statistics instead of logging every event.
+
+        New threads do not write memory dumps, they record the number of
+        calls, the total, minimum and maximum memory delta and the inclusive
+        wall time of each function instead.
+        The statistics of all threads are merged and written to the
+        "aggregate.snap" file, next to "process.mem", every interval seconds
+        (if set), when the profiler is disabled and when the process exits.
+        Stack dumps are not affected.
+
+        Args:
+            enable: aggregate the events of threads created from now on.
+            interval: seconds between snapshots, None to only write them
+                      on disable and at exit.
+        """
+        self._aggregate = enable
+        self._snapshot_interval = interval
+
+    def useAsyncio(self, enable=True):
+        """Attributes the events of asyncio event loops to their tasks.
+
+        Thousands of coroutines can interleave on the thread running an
+        event loop, mixing their calls in the dumps of the thread.
+        In asyncio mode each task is profiled on its own: it has its own
+        shadow stack and its own dump files, named "THREAD@TASK" after
+        the thread and the name of the task (e.g. "MainThread@Task-12.mem").
+        The dump files of the thread only contain the events of the event
+        loop itself and the files of a task are closed when it is done.
+        Resuming a coroutine is recorded as a call and suspending it as a
+        return, except with sys.monitoring where the coroutine remains on
+        the stack of its task until it returns.
+
+        Each event costs a lookup of the current task.
+        Not supported when sampling.
+        Changes take effect the next time the profiler is enabled.
+        """
+        if enable and _current_task is None:
+            raise RuntimeError("asyncio is not available.")
+        self._asyncio = enable
+
+    def useBinaryFormat(self, enable=True):
+        """Enables or disables the compact binary format for new threads.
+
+        Binary dumps are made of fixed-size records and are buffered in
+        memory to avoid a write and a flush for every event.
+        ProfilerGraph reads both formats.
+        """
+        self._binary = enable
+
+    def useMonitoring(self, enable=True):
+        """Selects sys.monitoring to intercept calls (Python 3.12 or later).
+
+        sys.monitoring is significantly faster than sys.setprofile and
+        functions rejected by the filter run at full speed after their
+        first call.
+        The dump files have the same format.
+        On older interpreters sys.setprofile is used regardless.
+        Changes take effect the next time the profiler is enabled.
+        """
+        self._monitoring = enable
+
+    def useSymbols(self, enable=True):
+        """Enables or disables the symbol table for new threads.
+
+        By default each record repeats the file, line and name of the
+        function as text.
+        With the symbol table each function is assigned a small integer
+        id the first time it is seen and the records only contain the id.
+        The ids are mapped to file, first line and name by the "symbols"
+        file, next to "process.mem", which ProfilerGraph reads when needed.
+        Note that the line of return events is not recorded with symbols.
+        """
+        if not enable:
+            self._symbols = None
+            return
+        basepath = path.join(self._default_log_path, str(getpid()))
+        if not path.exists(basepath):
+            makedirs(basepath)
+        self._symbols = SymbolTable(open(path.join(basepath, "symbols"), "w"))
+
+    def useThrottling(self, enable=True, calls=10000, memory=256,
+                      duration=10000):
+        """Stops recording the calls of hot functions that do nothing.
+
+        Most of the cost of profiling everything comes from a few tiny
+        functions called millions of times.
+        Once a function has been called calls times, if its calls changed
+        the memory by at most memory bytes and lasted at most duration
+        nanoseconds on average, its calls are only counted.
+        The counts are written to the memory dumps as summary lines every
+        calls calls and when the streams are flushed.
+        Applies to threads created after the call and requires memory
+        tracking; calls in the threads' stack dumps are throttled as well.
+
+        Args:
+            enable: throttle functions in new threads.
+            calls: calls observed before deciding.
+            memory: maximum average absolute memory delta, in bytes.
+                    The resident set size moves in pages so with the
+                    default memory source this is the page size times
+                    the fraction of calls that changed it.
+            duration: maximum average duration, in nanoseconds, including
+                      the profiler overhead.
+        """
+        self._throttle = (calls, memory, duration) if enable else None
+
+    def useTracemalloc(self, enable=True, depth=1):
+        """Measures per-thread memory with tracemalloc instead of RSS.
+
+        Each thread is charged for the Python allocations, and frees, made
+        since the previous event it handled, leaving out those of the
+        profiler and, once calibrated by enable, the bytes the interpreter
+        allocates for every event.
+        tracemalloc only counts for the whole process so this is not exact
+        when threads switch: the allocations of a thread that switches in
+        without an event, or that is not profiled, are charged to the last
+        thread that had one.
+        Sleep tracking is not needed, and not used, in this mode.
+        Tracing is started by enable and, unless tracemalloc was already
+        tracing, stopped by disable.
+        The process.mem file still records the resident set size.
+
+        Args:
+            enable: use tracemalloc for threads created from now on.
+            depth: frames stored by tracemalloc for each allocation.
+                   1 is the cheapest, larger values are only useful if
+                   the program takes its own tracemalloc snapshots.
+        """
+        self._tracemalloc = TracemallocMemorySource(depth) if enable else None
+
+    def writeStats(self):
+        """Writes the profiler counters to "profiler.stats".
+
+        The file, next to "process.mem", has the process totals and the
+        counters of each thread (prefixed by "thread.NAME.") of events seen,
+        events rejected by the filter, throttled functions, bytes
+        (characters for text dumps)
+        written, nanoseconds spent in the profile function (estimated from
+        a sample of the events), dropped events and shadow stack resyncs.
+        Calibration results, if any, are prefixed by "calibrated.".
+        """
+        names = ("events", "filtered", "throttled", "bytes", "dispatch_ns",
+                 "dropped", "resyncs")
+        totals = dict.fromkeys(names, 0)
+        threads = []
+        for (thread, thread_stats) in sorted(self._threads.items()):
+            counters = thread_stats.counters()
+            for name in names:
+                totals[name] += counters[name]
+                threads.append(("thread.{0}.{1}".format(thread, name),
+                                counters[name]))
+        stats = [(name, totals[name]) for name in names]
+        stats.extend(("calibrated.{0}_ns".format(feature), round(cost, 1))
+                     for (feature, cost) in sorted(self._calibration.items()))
+        stats.extend(threads)
+        basepath = path.join(self._default_log_path, str(getpid()))
+        if not path.exists(basepath):
+            makedirs(basepath)
+        with open(path.join(basepath, "profiler.stats"), "w") as stream:
+            write_stats(stream, stats)
+
+    def writeSnapshot(self):
+        """Merges the statistics of all threads and writes a snapshot.
+
+        The snapshot replaces the previous one atomically so readers
+        never see a partial file.
+        """
+        merged = {}
+        for thread in list(self._threads.values()):
+            # The profiled threads keep updating their tables.
+            for (code, entry) in list(thread.stats.items()):
+                total = merged.get(code)
+                if total is None:
+                    merged[code] = list(entry)
+                    continue
+                total[3] += entry[3]
+                total[4] += entry[4]
+                total[5] = min(total[5], entry[5])
+                total[6] = max(total[6], entry[6])
+                total[7] += entry[7]
+        basepath = path.join(self._default_log_path, str(getpid()))
+        filename = path.join(basepath, "aggregate.snap")
+        if not path.exists(basepath):
+            makedirs(basepath)
+        with open(filename + ".tmp", "w") as stream:
+            write_snapshot(stream, merged.values())
+        rename(filename + ".tmp", filename)
+
+    def useWriterThread(self, enable=True, size=65536, policy="drop",
+                        interval=0.1):
+        """Moves output off the profiled threads.
+
+        When enabled each new thread queues its events in a preallocated
+        buffer instead of writing them, and a writer thread, started by
+        enable, drains all the buffers every interval seconds.
+
+        Args:
+            enable: use the writer thread for new threads.
+            size: number of events each thread can queue.
+            policy: what to do when a buffer is full: "drop" discards the
+                    event (see droppedEvents) while "block" waits for the
+                    writer thread to drain the buffer.
+            interval: seconds between writer thread runs.
+        """
+        if policy not in ("drop", "block"):
+            raise ValueError("Unknown policy: {0}".format(policy))
+        self._queue_size = size if enable else None
+        self._queue_policy = policy
+        self._writer_interval = interval
+
 
 class ThreadProfile(object):
     """Profiles a single thread.
@@ -278,12 +1739,48 @@ class ThreadProfile(object):
         * sys.settrace: http://docs.python.org/3.4/library/sys.html#sys.settrace
     """
     def __init__(self, stream_factory=None, profile=None, track_memory=True,
-                 track_times=True, track_stack=False, track_sleep=True):
+                 track_times=True, track_stack=False, track_sleep=True,
+                 process_tick=None, binary=False, buffer_size=None, flush_interval=None,
+                 queue_size=None, queue_policy="drop", symbols=None,
+                 memory_usage=None, tracing=None, aggregate=False,
+                 durations=None, throttle=None, blocking=None,
+                 track_blocking=None):
         """Creates a per-thread profiler.
 
         Args:
             stream_factory: callable that returns a writeable file.
             profile: choose what to profile, "c", "python" or "both".
+            process_tick: if set, called at every event.
+            binary: write dumps in the binary format instead of text.
+            buffer_size: bytes buffered before writing to the streams,
+                         None selects the default for the format.
+            flush_interval: maximum seconds between writes to the streams.
+            queue_size: if set, events are queued in a buffer of this size
+                        and only written when flushStreams is called.
+            queue_policy: "drop" or "block", what to do when the queue
+                          is full.
+            symbols: SymbolTable shared by the process, if set records
+                     refer to functions by id.
+            memory_usage: callable returning the memory used by the thread,
+                          the process RSS is used if not set.
+            tracing: TracemallocMemorySource paused while an event is
+                     handled, so that the allocations of the profiler
+                     are not charged to the thread.
+            aggregate: keep per-function statistics in stats instead of
+                       writing memory dumps.
+            durations: None, "wall" or "cpu": add the wall time and, for
+                       "cpu", the thread CPU time of calls to the memory
+                       records.
+            throttle: None or a (calls, memory, duration) tuple: once a
+                      function has been called calls times with an average
+                      absolute memory delta of at most memory bytes and an
+                      average duration of at most duration nanoseconds its
+                      calls are only counted.
+            blocking: BlockingRegistry of the calls tracked as sleeps and
+                      blocking calls, the default one if not set.
+            track_blocking: None or the minimum duration, in nanoseconds,
+                            of the blocking calls written to the block
+                            dump.
         """
         dispatchers = {
             "c": {
@@ -306,104 +1803,431 @@ class ThreadProfile(object):
             }
         }
         self._dispatcher = dispatchers[profile if profile else "both"]
+        self._process_tick = process_tick
+        self._memory_usage = memory_usage
+        self._tracing = tracing
+        if tracing is not None:
+            # Created by the thread it profiles.
+            self._ident = _get_ident()
+            # Shadows the method, so it is what gets installed.
+            self._dispatch = self._tracedDispatch
 
         # Per-thread information used during collection.
-        self._frames = {}
-        self._sleep_accounting = 0
-        self._sleep_frames = {}
+        # Calls in progress are kept in a shadow stack: preallocated
+        # parallel lists indexed by stack level, so entering a call does not
+        # allocate.
         self._stack_level = 0
+        self._capacity = _SHADOW_STACK_SIZE
+        self._fids = [None] * _SHADOW_STACK_SIZE
+        self._codes = [None] * _SHADOW_STACK_SIZE
+        self._names = [None] * _SHADOW_STACK_SIZE
+        self._filenames = [None] * _SHADOW_STACK_SIZE
+        self._mem_before = [0] * _SHADOW_STACK_SIZE
+        self._starts = [None] * _SHADOW_STACK_SIZE
+        self._cpu_starts = [None] * _SHADOW_STACK_SIZE
+        self._shadow_stack = (self._fids, self._codes, self._names,
+                              self._filenames, self._mem_before,
+                              self._starts, self._cpu_starts)
+        self.resyncs = 0
+        self._sleep_accounting = 0
+        self._blocked = None
+        self._sampled = []
+
+        # Counters of the profiler's own activity.
+        self.events = 0
+        self.filtered = 0
+        self.dispatch_time = 0
+        self.timed_events = 0
+        self._aggregate = aggregate
+        self.stats = {}
+        self._active = True
+
+        # Per-function totals of calls, absolute memory deltas and durations
+        # while deciding, then [calls, code, filename, line, name] entries
+        # counting the calls not recorded since the last summary.
+        self._throttle = throttle
+        self._observed = {}
+        self._throttled = {}
 
         # Data collection tweeks.
-        self._file_filter = ""
+        self.setFilter(None)
         self._mem = track_memory
         self._times = track_times
         self._stack = track_stack
+        self._durations = durations is not None
+        self._cpu_time = durations == "cpu" and _cpu_clock is not None
+        self._mem_kind = KIND_MEMORY_TIMED if durations else KIND_MEMORY
 
         # Attempt to recognize context switch returns
         # The idea is simple: if the return is from a function that is
         # likely to trigger a context switch the memory delta registered
         # at the return event is ignored from the thread memory usage.
         self._sleep_trak = track_sleep
-        self._sleep_triggers = {
-            "time": set(["sleep"]),
-            "/usr/lib/python2.6/threading.py": set(["acquire"]),
-            None: set(["acquire"])  # For some reason acquire seems to belong to the None module.
-        }
+        self._blocking = (blocking if blocking is not None
+                          else BlockingRegistry())
+        self._block_threshold = track_blocking
+        self._block_writer = None
 
         # Create required streams.
-        self._mem_stream = stream_factory("mem") if self._mem else None
-        self._stack_stream = stream_factory("stack") if self._stack else None
+        if queue_size and buffer_size is None:
+            # The writer thread flushes after draining the queue.
+            buffer_size = 64 * 1024
+        if binary:
+            if buffer_size is None:
+                buffer_size = 64 * 1024
+                flush_interval = flush_interval if flush_interval else 1.0
+            def writer(stream_type, kind):
+                return BinaryWriter(stream_factory(stream_type, mode="wb"),
+                                    kind, buffer_size, flush_interval,
+                                    symbols)
+        else:
+            buffer_size = buffer_size if buffer_size else 0
+            def writer(stream_type, kind):
+                return TextWriter(stream_factory(stream_type), buffer_size,
+                                  flush_interval, symbols)
+        self._writer_factory = writer
+        self._writers = []
+
+        # Queue events to be written by another thread.
+        self._queue = None
+        if queue_size:
+            self._queue = RingBuffer(queue_size, queue_policy == "block")
+
+        self._mem_writer = (self._openWriter("mem", self._mem_kind)
+                            if self._mem and not aggregate else None)
+        self._stack_writer = (self._openWriter("stack", KIND_STACK)
+                              if self._stack else None)
+        if track_blocking is not None:
+            self._block_writer = self._openWriter("block", KIND_BLOCK)
+        self._updateHandlers()
 
     def _dispatch(self, frame, event, arg):
         """Entry point for event dispatch.
 
+        This is installed as the profile function of the thread so the
+        handlers must not raise.
+        Only they are guarded: an error in the dispatch itself is not
+        hidden by dropping the event.
+
         Args:
             frame: the frame executing at the time of interrupt.
             event: the event that triggered the interrupt.
             arg:   the arguments associated with the event.
         """
-        if (self._sleep_trak and event == "c_call" and
-            arg.__module__ in self._sleep_triggers and
-            arg.__name__ in self._sleep_triggers[arg.__module__]):
-            self._sleep_frames[id(frame)] = self._getMemory()
-        elif (self._sleep_trak and (event == "c_return" or
-              event == "c_exception") and id(frame) in self._sleep_frames):
-            mem_before = self._sleep_frames[id(frame)];
-            del self._sleep_frames[id(frame)]
+        if not self._active:
+            # Profiling was disabled from another thread.
+            sys.setprofile(None)
+            return
+        self.events += 1
+        if self.events % _DISPATCH_SAMPLE:
+            try:
+                if self._process_tick is not None:
+                    self._process_tick()
+                handler = self._handlers.get(event)
+                if handler is not None:
+                    handler(frame, event, arg)
+            except:
+                pass
+            return
+        # Same as above, timed.
+        start = _wall_clock()
+        try:
+            if self._process_tick is not None:
+                self._process_tick()
+            handler = self._handlers.get(event)
+            if handler is not None:
+                handler(frame, event, arg)
+        except:
+            pass
+        self.dispatch_time += _wall_clock() - start
+        self.timed_events += 1
+
+    def _tracedDispatch(self, frame, event, arg):
+        """Entry point for event dispatch with tracemalloc.
+
+        The traced memory is read as the event arrives and counting only
+        resumes once the event has been handled, so the shadow stack
+        entries, buffered records and other allocations of the profiler
+        are not charged to the thread.
+        """
+        self._tracing.pause()
+        try:
+            ThreadProfile._dispatch(self, frame, event, arg)
+        finally:
+            self._tracing.resume(self._ident)
+
+    def _enter(self, fid, code, filename, line, name):
+        """Records the start of a call.
+
+        Args:
+            fid: Identifier of the call, matched by the return.
+            code: The code object of the function, or a (module, name)
+                  tuple for C functions.
+            filename: The filename (or module) containing the function.
+            line: The line the function starts at.
+            name: The name of the function being called.
+        """
+        level = self._stack_level
+        if self._stack:
+            self._stack_writer.writeCall(
+                time() if self._times else None, level, code,
+                filename, line, name)
+        if level == self._capacity:
+            for values in self._shadow_stack:
+                values.extend(values[:level])
+            self._capacity += level
+        self._stack_level = level + 1
+        self._fids[level] = fid
+        self._codes[level] = code
+        self._names[level] = name
+        self._filenames[level] = filename
+        self._mem_before[level] = self._getMemory() if self._mem else 0
+        self._starts[level] = (
+            _wall_clock() if self._aggregate or self._durations or
+            self._throttle else None)
+        self._cpu_starts[level] = _cpu_clock() if self._cpu_time else None
+
+    def _exit(self, fid, line, frame=None):
+        """Records the end of a call started by _enter.
+
+        Args:
+            fid: Identifier of the call passed to _enter.
+            line: The line the function returns from.
+            frame: The frame returning (or calling the C function), used
+                   to resynchronize the shadow stack.
+        """
+        level = self._stack_level - 1
+        if level < 0:
+            return
+        if self._fids[level] != fid:
+            level = self._resync(fid, frame)
+            if level < 0:
+                return
+        self._stack_level = level
+        code = self._codes[level]
+        name = self._names[level]
+        filename = self._filenames[level]
+        mem_before = self._mem_before[level]
+        start = self._starts[level]
+        if self._aggregate:
+            elapsed = (_wall_clock() - start) / 1000000000.0
+            mem_delta = self._getMemory() - mem_before if self._mem else 0
+            self._account(code, filename, name, mem_delta, elapsed)
+        elif self._mem:
+            durations = None
+            if start is not None:
+                # Read the clocks before the memory to leave its cost out.
+                durations = (_wall_clock() - start,)
+                cpu_start = self._cpu_starts[level]
+                if cpu_start is not None:
+                    durations += (_cpu_clock() - cpu_start,)
             mem_after = self._getMemory()
-            self._sleep_accounting += mem_after - mem_before
+            mem_delta = mem_after - mem_before
+            self._mem_writer.writeReturn(
+                time() if self._times else None, self._stack_level,
+                code, filename, line, name, mem_delta,
+                durations if self._durations else None)
+            if self._throttle is not None:
+                self._observe(code, filename, line, name, mem_delta,
+                              durations[0])
+
+    def _resync(self, fid, frame):
+        """Realigns the shadow stack when a return does not match the top.
+
+        If the call is further down the stack the calls above it returned
+        without an event (e.g. generators torn down by the garbage
+        collector) and are discarded.
+        Otherwise the call started before profiling did and, if the frame is
+        known, calls whose frame is no longer in the frame.f_back chain are
+        discarded.
+
+        Returns:
+            The level of the call, or -1 if it is not in the stack.
+        """
+        fids = self._fids
+        level = self._stack_level - 1
+        while level >= 0 and fids[level] != fid:
+            level -= 1
+        if level >= 0:
+            self._truncate(level + 1)
+            self.resyncs += 1
+            return level
+        if frame is None:
+            return -1
+        live = set()
+        while frame is not None:
+            live.add(id(frame))
+            frame = frame.f_back
+        kept = [level for level in range(self._stack_level)
+                if abs(fids[level]) in live]
+        if len(kept) < self._stack_level:
+            for values in self._shadow_stack:
+                values[:len(kept)] = [values[level] for level in kept]
+            self._truncate(len(kept))
+            self.resyncs += 1
+        return -1
+
+    def _isTop(self, fid):
+        """Checks if a call is the last one in the shadow stack.
+
+        Calls of a function that started before it was throttled still
+        return normally.
+        """
+        level = self._stack_level - 1
+        return level >= 0 and self._fids[level] == fid
+
+    def _truncate(self, depth):
+        """Discards the calls above depth from the shadow stack."""
+        self._stack_level = depth
+
+    def _observe(self, code, filename, line, name, mem_delta, elapsed):
+        """Throttles a function once its calls are known to be negligible."""
+        entry = self._observed.get(code)
+        if entry is None:
+            entry = self._observed[code] = [0, 0, 0]
+        entry[0] += 1
+        entry[1] += abs(mem_delta)
+        entry[2] += elapsed
+        (calls, memory, duration) = self._throttle
+        if (entry[0] >= calls and entry[1] <= memory * entry[0] and
+                entry[2] <= duration * entry[0]):
+            del self._observed[code]
+            self._throttled[code] = [0, code, filename, line, name]
+
+    def _skip(self, entry):
+        """Counts a call of a throttled function."""
+        entry[0] += 1
+        if entry[0] >= self._throttle[0]:
+            self._writeSummary(self._mem_writer, entry)
+
+    def _writeSummary(self, writer, entry):
+        """Writes the calls counted for a throttled function."""
+        (calls, code, filename, line, name) = entry
+        if calls and writer is not None:
+            writer.writeSummary(time() if self._times else None, code,
+                                filename, line, name, calls)
+        entry[0] = 0
+
+    def _writeSummaries(self):
+        """Writes the calls counted for all throttled functions.
+
+        Called while flushing the streams, possibly by another thread, so
+        the summaries bypass the queue.
+        """
+        writer = getattr(self._mem_writer, "writer", self._mem_writer)
+        for entry in list(self._throttled.values()):
+            self._writeSummary(writer, entry)
 
-        if event in self._dispatcher:
-            self._dispatcher[event](frame, event, arg)
+    def _account(self, code, filename, name, mem_delta, elapsed):
+        """Adds a completed call to the per-function statistics.
+
+        Entries are lists of filename, line, name, calls, total memory
+        delta, minimum delta, maximum delta and inclusive wall time.
+        """
+        entry = self.stats.get(code)
+        if entry is None:
+            self.stats[code] = [filename, getattr(code, "co_firstlineno", 0),
+                                name, 1, mem_delta, mem_delta, mem_delta,
+                                elapsed]
+            return
+        entry[3] += 1
+        entry[4] += mem_delta
+        if mem_delta < entry[5]:
+            entry[5] = mem_delta
+        if mem_delta > entry[6]:
+            entry[6] = mem_delta
+        entry[7] += elapsed
+
+    def _flushWriters(self):
+        try:
+            for writer in self._writers:
+                writer.flush()
+        except (IOError, ValueError):
+            pass
+
+    def _openWriter(self, stream_type, kind):
+        """Opens a stream and returns the writer to use for it."""
+        writer = self._writer_factory(stream_type, kind)
+        self._writers.append(writer)
+        if self._queue is not None:
+            return QueuedWriter(writer, self._queue)
+        return writer
 
     def _getMemory(self):
         """Internally used to fetch memory."""
+        if self._memory_usage is not None:
+            return self._memory_usage()
         return _getProcessMemory() - self._sleep_accounting
 
-    def _handleIn(self, frame, event, arg, fid=None, name=None, filename=None):
+    def _sample(self, frame):
+        """Infers calls and returns from a sampled stack.
+
+        The stack is compared with the previous sample: frames that are
+        no longer there have returned and new frames have been called.
+        Only the frames identity, code and line are retained between samples.
+
+        Args:
+            frame: The innermost frame of the thread, None if the thread
+                   has terminated.
+        """
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            if code not in self._decisions:
+                self._filter.decide(code, code.co_filename, code.co_name,
+                                    frame.f_globals.get("__name__"))
+            stack.append((id(frame), code, frame.f_lineno))
+            frame = frame.f_back
+        stack.reverse()
+        common = 0
+        for (previous, current) in zip(self._sampled, stack):
+            if previous[:2] != current[:2]:
+                break
+            common += 1
+        for (fid, _, line) in reversed(self._sampled[common:]):
+            self._exit(fid, line)
+        for (fid, code, _) in stack[common:]:
+            if self._decisions.get(code):
+                self._enter(fid, code, code.co_filename, code.co_firstlineno,
+                            code.co_name)
+        self._sampled = stack
+
+    def _handleIn(self, frame, event, arg):
         """Handles a function call.
         Args:
             frame: The frame object passed by CPython.
             event: The event that triggered the profile function.
             arg: Additional argument passed by CPython, depends on event.
-            fid: If specified, it is the id of the frame.
-            name: If specified, it is the name of the function being called.
-            filename: If specified, it is the filename containing the function being called.
-        """
-        filename = filename if filename else frame.f_code.co_filename
-        name = name if name else frame.f_code.co_name
-        fid = fid if fid else id(frame)
-        if not filename.startswith(self._file_filter): return
-        if self._stack:
-            now = str(time()) + "#" if self._times else ""
-            self._stack_stream.write("{0}{1}{2}:{3}:{4}\n".format(
-                " ".join([""] * self._stack_level), now, filename,
-                frame.f_lineno, name))
-            self._stack_stream.flush()
-        self._stack_level += 1
-        self._frames[fid] = (
-            self._getMemory() if self._mem else 0, name, filename)
-
-    def _handleOut(self, frame, event, arg, fid=None):
+        """
+        code = frame.f_code
+        accepted = self._decisions.get(code)
+        if accepted is None:
+            accepted = self._filter.decide(
+                code, code.co_filename, code.co_name,
+                frame.f_globals.get("__name__"))
+        if accepted:
+            throttled = self._throttled.get(code)
+            if throttled is None:
+                self._enter(id(frame), code, code.co_filename,
+                            frame.f_lineno, code.co_name)
+            else:
+                self._skip(throttled)
+        else:
+            self.filtered += 1
+
+    def _handleOut(self, frame, event, arg):
         """Handles a function return (even in case of exception).
         Args:
             frame: The frame object passed by CPython.
             event: The event that triggered the profile function.
             arg: Additional argument passed by CPython, depends on event.
-            fid: If specified, it is the id of the frame.
-        """
-        fid = fid if fid else id(frame)
-        if fid in self._frames:
-            self._stack_level -= 1
-            (mem_before, name, filename) = self._frames[fid]
-            del self._frames[fid]
-            if self._mem:
-                mem_after = self._getMemory()
-                mem_delta = mem_after - mem_before
-                now = str(time()) + "#" if self._times else ""
-                self._mem_stream.write("{0}{1}:{2}:{3}=>{4}\n".format(
-                    now, filename, frame.f_lineno, name, mem_delta))
-                self._mem_stream.flush()
+        """
+        code = frame.f_code
+        if self._decisions.get(code, True):
+            if code not in self._throttled or self._isTop(id(frame)):
+                self._exit(id(frame), frame.f_lineno, frame)
+        else:
+            self.filtered += 1
 
     def _handleCIn(self, frame, event, arg):
         """Handles a C function call.
@@ -412,8 +2236,20 @@ class ThreadProfile(object):
             event: The event that triggered the profile function.
             arg: Additional argument passed by CPython, depends on event.
         """
-        self._handleIn(frame, event, arg, -id(frame), arg.__name__,
-                       arg.__module__)
+        module = arg.__module__
+        code = (module, arg.__name__)
+        accepted = self._decisions.get(code)
+        if accepted is None:
+            accepted = self._filter.decide(code, module, arg.__name__, module)
+        if accepted:
+            throttled = self._throttled.get(code)
+            if throttled is None:
+                self._enter(-id(frame), code, module, frame.f_lineno,
+                            arg.__name__)
+            else:
+                self._skip(throttled)
+        else:
+            self.filtered += 1
 
     def _handleCOut(self, frame, event, arg):
         """Handles a C function return (even in case of exception).
@@ -422,29 +2258,197 @@ class ThreadProfile(object):
             event: The event that triggered the profile function.
             arg: Additional argument passed by CPython, depends on event.
         """
-        self._handleOut(frame, event, arg, -id(frame))
+        code = (arg.__module__, arg.__name__)
+        if self._decisions.get(code, True):
+            if code not in self._throttled or self._isTop(-id(frame)):
+                self._exit(-id(frame), frame.f_lineno, frame)
+        else:
+            self.filtered += 1
+
+    def _block(self, frame, blocker):
+        """Records the start of a blocking call.
+
+        The call is attributed to the outermost registered Python function
+        it is made from, if any, and to the line calling it.
+
+        Args:
+            frame: the frame making the blocking C call.
+            blocker: the registry entry of the C function.
+        """
+        site = frame
+        wrapper = self._blocking.wrapper(site.f_code)
+        while wrapper is not None and site.f_back is not None:
+            blocker = wrapper
+            site = site.f_back
+            wrapper = self._blocking.wrapper(site.f_code)
+        code = site.f_code
+        self._blocked = (
+            -id(frame), blocker,
+            (code, code.co_filename, site.f_lineno, code.co_name),
+            self._getMemory() if self._sleep_trak else None,
+            _cpu_clock() if _cpu_clock is not None else None,
+            _wall_clock())
+
+    def _unblock(self):
+        """Records the end of the blocking call started by _block."""
+        end = _wall_clock()
+        cpu_end = _cpu_clock() if _cpu_clock is not None else None
+        (_, blocker, site, mem_before, cpu_start, start) = self._blocked
+        self._blocked = None
+        if mem_before is not None:
+            self._sleep_accounting += self._getMemory() - mem_before
+        wall = end - start
+        threshold = self._block_threshold
+        if threshold is not None and wall >= threshold:
+            off_cpu = wall
+            if cpu_start is not None:
+                off_cpu = max(0, wall - (cpu_end - cpu_start))
+            self._block_writer.writeBlock(
+                time() if self._times else None, site, blocker, wall,
+                off_cpu)
+
+    def _handleBlockingIn(self, frame, event, arg):
+        """Handles a C function call when blocking calls are tracked."""
+        handler = self._dispatcher.get(event)
+        if handler is not None:
+            handler(frame, event, arg)
+        if self._blocked is None:
+            blocker = self._blocking.match(arg)
+            if blocker is not None:
+                self._block(frame, blocker)
+
+    def _handleBlockingOut(self, frame, event, arg):
+        """Handles a C function return when blocking calls are tracked."""
+        if self._blocked is not None and self._blocked[0] == -id(frame):
+            self._unblock()
+        handler = self._dispatcher.get(event)
+        if handler is not None:
+            handler(frame, event, arg)
+
+    def _updateHandlers(self):
+        """Builds the event to handler map used by _dispatch."""
+        handlers = dict(self._dispatcher)
+        if self._sleep_trak or self._block_threshold is not None:
+            handlers["c_call"] = self._handleBlockingIn
+            handlers["c_exception"] = self._handleBlockingOut
+            handlers["c_return"] = self._handleBlockingOut
+        else:
+            self._blocked = None
+        self._handlers = handlers
+
+    def discardStreams(self):
+        """Closes the streams inherited from the parent process.
+
+        Pending events are dropped, the parent process writes them.
+        """
+        for writer in self._writers:
+            discard_stream(writer.discard())
+            try:
+                writer.close()
+            except (IOError, ValueError):
+                pass
 
     def closeStreams(self):
+        self.flushStreams()
         try:
-            if self._mem_stream:
-                self._mem_stream.close()
-            if self._stack_stream:
-                self._stack_stream.close()
-        except IOError:
+            for writer in self._writers:
+                writer.close()
+        except (IOError, ValueError):
             pass
 
+    def counters(self):
+        """Returns the counters of the profiler's own activity.
+
+        The time spent in the profile function, "dispatch_ns", is
+        estimated from the events timed, one in _DISPATCH_SAMPLE.
+        """
+        dispatch_time = (self.dispatch_time * self.events //
+                         max(self.timed_events, 1))
+        return {
+            "events": self.events,
+            "filtered": self.filtered,
+            "throttled": len(self._throttled),
+            "bytes": sum(writer.written for writer in self._writers),
+            "dispatch_ns": dispatch_time,
+            "dropped": self.droppedEvents(),
+            "resyncs": self.resyncs
+        }
+
+    def droppedEvents(self):
+        """Returns the number of events dropped because the queue was full."""
+        return self._queue.dropped if self._queue else 0
+
+    def resyncCount(self):
+        """Returns how many times the shadow stack was realigned."""
+        return self.resyncs
+
+    def flushStreams(self):
+        """Writes queued and buffered events to the streams.
+
+        The calls counted for throttled functions are written as well.
+        """
+        if self._queue is None:
+            self._writeSummaries()
+            self._flushWriters()
+            return
+        with self._queue.lock:
+            self._queue.drain()
+            self._writeSummaries()
+            self._flushWriters()
+
     def logTimestamps(self, enable=True):
         """Enables or disables collection timestamps."""
         self._times = enable
 
     def setFilter(self, filter):
-        """Sets the file filter for the thread."""
-        self._file_filter = filter
+        """Sets the filter for the thread.
+
+        Args:
+            filter: A CallFilter, a file name prefix or None to profile
+                    all functions.
+        """
+        if not isinstance(filter, CallFilter):
+            filter = CallFilter.fromPrefix(filter)
+        self._filter = filter
+        self._decisions = filter.decisions
+
+    def setProcessTick(self, process_tick):
+        """Sets the function called at every event, None for none."""
+        self._process_tick = process_tick
+
+    def setActive(self, active):
+        """Activates or deactivates the profiler.
+
+        An inactive profiler removes itself as profile function of the
+        thread at the first event it receives.
+        """
+        self._active = active
 
     def trackMemory(self, enable=True):
         """Enable or disable memory tracking."""
+        if enable and self._mem_writer is None and not self._aggregate:
+            self._mem_writer = self._openWriter("mem", self._mem_kind)
         self._mem = enable
 
+    def trackBlocking(self, threshold=None):
+        """Enables or disables the block dump.
+
+        Args:
+            threshold: None to disable the dump, or the minimum duration,
+                       in nanoseconds, of the blocking calls written to it.
+        """
+        if threshold is not None and self._block_writer is None:
+            self._block_writer = self._openWriter("block", KIND_BLOCK)
+        self._block_threshold = threshold
+        self._updateHandlers()
+
+    def trackSleeps(self, enable=True):
+        """Enables or disables sleep tracking."""
+        self._sleep_trak = enable
+        self._updateHandlers()
+
     def trackStack(self, enable=True):
         """Enables or disables stack tracking."""
+        if enable and self._stack_writer is None:
+            self._stack_writer = self._openWriter("stack", KIND_STACK)
         self._stack = enable
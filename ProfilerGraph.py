@@ -9,14 +9,23 @@ from __future__ import print_function
 
 import argparse
 from datetime import datetime
+from functools import partial
+import heapq
+import io
 import math
+import multiprocessing
 import os
 import subprocess
 import sys
 import tempfile
 from time import mktime
 
+import DumpFormat
+import DumpStore
+import MemoryGraph
+import OutputStream
 import StackTree
+import TimeIndex
 from StackTree import count_spaces
 
 
@@ -47,10 +56,214 @@ class _Markers(object):
 
 
 # Define file parsers.
+def _read_dump(filename, timed=True, summaries=False, start=None, end=None):
+    """Iterates over the lines of a dump file in either format.
+
+    Binary dumps are converted to the equivalent text lines so that
+    parsers only deal with the text format.
+    Compressed and rotated dumps are read as a single stream.
+    Dumps of a store (see import_dumps) are converted to text lines too.
+    Summary lines of throttled functions are skipped unless summaries is set.
+    When start or end are set only the lines in that time range are read,
+    starting from the position of start in the TimeIndex of the dump.
+    """
+    if not timed:
+        (start, end) = (None, None)
+    if DumpStore.is_store(filename):
+        for line in DumpStore.read_lines(filename, timed, start, end):
+            if summaries or not DumpFormat.is_summary(line):
+                yield line
+        return
+    with TimeIndex.open_from(filename, start) as f:
+        if DumpFormat.is_binary(f.peek(len(DumpFormat.MAGIC))):
+            lines = DumpFormat.read_binary(f, timed)
+        else:
+            lines = io.TextIOWrapper(f)
+        if start is not None or end is not None:
+            lines = _window(lines, start, end)
+        for line in lines:
+            if summaries or not DumpFormat.is_summary(line):
+                yield line
+
+
+def _window(lines, start, end):
+    """Limits the lines of a dump, in time order, to a time range."""
+    for line in lines:
+        try:
+            time = float(line.lstrip(" " + DumpFormat.SUMMARY_PREFIX)
+                         .split("#", 1)[0])
+        except ValueError:
+            # Let the caller report the line.
+            yield line
+            continue
+        if start is not None and time < start:
+            continue
+        if end is not None and time > end:
+            return
+        yield line
+
+
+def _logical_files(files):
+    """Maps segments of compressed or rotated dumps to their stream name.
+
+    Each stream is listed once, in the position of its first segment.
+    TimeIndex sidecar files are skipped.
+    """
+    logical = []
+    for filename in files:
+        if filename.endswith(TimeIndex.INDEX_SUFFIX):
+            continue
+        name = OutputStream.logical_name(filename)
+        if name not in logical:
+            logical.append(name)
+    return logical
+
+
+def _pid_dumps(roots, suffixes):
+    """Lists the dumps of every pid directory under the given roots.
+
+    Args:
+        roots: log directories, containing one directory per process, or
+               process directories.
+        suffixes: extensions of the dumps to list.
+
+    Returns:
+        The logical names of the dumps, grouped by process.
+    """
+    dumps = []
+    for root in roots:
+        if os.path.basename(os.path.normpath(root)).isdigit():
+            directories = [root]
+        else:
+            directories = sorted(
+                (os.path.join(root, name) for name in os.listdir(root)
+                 if name.isdigit()),
+                key=lambda directory: int(os.path.basename(directory)))
+        for directory in directories:
+            names = _logical_files(sorted(
+                os.path.join(directory, name)
+                for name in os.listdir(directory)))
+            dumps.extend(name for name in names if name.endswith(suffixes))
+    return dumps
+
+
+def _is_process(filename):
+    """Checks if a dump is the process memory dump."""
+    return os.path.basename(filename).rsplit(".", 1)[0] == "process"
+
+
+def _thread_name(filename, args):
+    """Returns the name of the thread of a dump.
+
+    With --merge_pids the name is prefixed by the pid, PID/THREAD.
+    """
+    thread = os.path.basename(filename).rsplit(".", 1)[0]
+    if args.merge_pids:
+        directory = os.path.dirname(os.path.abspath(filename))
+        thread = "{0}/{1}".format(os.path.basename(directory), thread)
+    return thread
+
+
+def _process_info(filename):
+    """Reads the process.info file next to a dump, None if missing."""
+    directory = os.path.dirname(os.path.abspath(filename))
+    try:
+        with open(os.path.join(directory, "process.info")) as f:
+            return DumpFormat.read_info(f)
+    except IOError:
+        return None
+
+
+def _sum_series(series):
+    """Sums time series of (time, value) samples.
+
+    Each value holds until the next sample of its series, a series stops
+    contributing after its last sample (e.g. the process exited).
+    """
+    events = []
+    for (index, samples) in enumerate(series):
+        for (position, (time, value)) in enumerate(samples):
+            events.append((time, index, value, position == len(samples) - 1))
+    events.sort()
+    current = {}
+    running = 0
+    total = []
+    for (time, index, value, last) in events:
+        running += value - current.get(index, 0)
+        current[index] = value
+        total.append((time, running))
+        if last:
+            running -= value
+            del current[index]
+    return total
+
+
+def _is_snapshot(filename):
+    """Checks if a file is an aggregate snapshot rather than a dump."""
+    if DumpStore.is_store(filename):
+        return False
+    with OutputStream.open_stream(filename) as f:
+        return DumpFormat.is_snapshot(
+            f.peek(len(DumpFormat.SNAPSHOT_HEADER)))
+
+
+_symbol_tables = {}
+
+
+def _resolve(name, dump):
+    """Resolves a function name from a dump into "file:line:name".
+
+    Names written with a symbol table are "@ID" references to the symbols
+    file next to the dump, which is loaded the first time it is needed.
+    Other names are returned as they are.
+    """
+    if not name.startswith("@"):
+        return name
+    directory = os.path.dirname(os.path.abspath(dump))
+    symbols = _symbol_tables.get(directory)
+    if symbols is None:
+        with open(os.path.join(directory, "symbols")) as f:
+            symbols = DumpFormat.read_symbols(f)
+        _symbol_tables[directory] = symbols
+    return symbols[name]
+
+
+_overheads = {}
+
+
+def _overhead(dump):
+    """Returns the estimated profiler cost of a traced call, in nanoseconds.
+
+    The estimate is read from the "profiler.stats" file next to the dump:
+    the calibrated cost of an event if the profiler was calibrated, the
+    average time spent in the profile function otherwise.
+    A traced call costs two events, the call and the return.
+    """
+    directory = os.path.dirname(os.path.abspath(dump))
+    overhead = _overheads.get(directory)
+    if overhead is None:
+        with open(os.path.join(directory, "profiler.stats")) as f:
+            stats = DumpFormat.read_stats(f)
+        event = stats.get("calibrated.event_ns")
+        if event is None:
+            event = stats["dispatch_ns"] / float(max(stats["events"], 1))
+        overhead = 2 * event
+        _overheads[directory] = overhead
+    return overhead
+
+
 def _parse_datetime(string):
-    """Convert a user friendly time string into a UNIX timestamps."""
-    if string is None:
+    """Convert a user friendly time string into a gnuplot UNIX timestamp."""
+    timestamp = _parse_timestamp(string)
+    if timestamp is None:
         return ""
+    return '"{0}"'.format(timestamp)
+
+
+def _parse_timestamp(string):
+    """Convert a user friendly time string into a UNIX timestamp."""
+    if string is None:
+        return None
     with_date = ["%d/%m/%Y %H:%M", "%d/%m/%y %H:%M", "%d/%m/%Y", "%d/%m/%y"]
     without_date = ["%H:%M"]
     time = None
@@ -69,23 +282,60 @@ def _parse_datetime(string):
         except ValueError:
             pass
     if time:
-        return '"{0}"'.format(mktime(time.timetuple()))
+        return mktime(time.timetuple())
     raise ValueError()
 
 
+def _time_range(args):
+    """Returns the (start, end) timestamps of --time_from and --time_to."""
+    return (_parse_timestamp(args.time_from), _parse_timestamp(args.time_to))
+
+
 def _parse_process_memory(line):
-    (time, mem) = line.split("#")
-    return (time, int(mem))
+    (time, sample) = line.split("#")
+    # The resident set size may be followed by ";"-separated counters.
+    return (time, int(sample.split(";", 1)[0]))
 
 
 def _parse_thread_memory(line, timed):
+    (time, name, mem, _, _) = _parse_thread_durations(line, timed)
+    return (time, name, mem)
+
+
+def _parse_thread_durations(line, timed):
+    """Parses a memory line including the optional call durations.
+
+    Returns:
+        (time, name, mem, wall, cpu) where wall and cpu are in nanoseconds
+        and None if they were not recorded.
+    """
     if timed:
         (time, line) = line.split("#")
         time = float(time)
     else:
         time = None
     (name, mem) = line.split("=>")
-    return (time, name, int(mem))
+    durations = mem.split(";")
+    wall = int(durations[1]) if len(durations) > 1 else None
+    cpu = int(durations[2]) if len(durations) > 2 else None
+    return (time, name, int(durations[0]), wall, cpu)
+
+
+def _parse_block(line, timed):
+    """Parses a line of a block dump.
+
+    Returns:
+        (time, site, blocker, wall, off_cpu) with the durations in
+        nanoseconds.
+    """
+    if timed:
+        (time, line) = line.split("#")
+        time = float(time)
+    else:
+        time = None
+    (site, line) = line.split("=>")
+    (blocker, wall, off_cpu) = line.rsplit(";", 2)
+    return (time, site, blocker, int(wall), int(off_cpu))
 
 
 def _parse_thread_stack(line, timed):
@@ -98,7 +348,166 @@ def _parse_thread_stack(line, timed):
     return (level, time, line)
 
 
+def _process_records(profile, start=None, end=None):
+    """Iterates over the (time, mem) samples of a process memory dump."""
+    if DumpStore.is_store(profile):
+        (_, columns) = DumpStore.load(profile, start, end)
+        for row in DumpStore.iter_rows(columns, ("time", "value")):
+            yield row
+        return
+    for line in _read_dump(profile, start=start, end=end):
+        line = line.rstrip()
+        try:
+            (time, mem) = _parse_process_memory(line)
+        except ValueError:
+            print("Unable to parse a line", file=sys.stderr)
+            continue
+        yield (time, mem)
+
+
+def _memory_records(profile, timed, start=None, end=None):
+    """Iterates over the (time, name, mem) records of a thread memory dump."""
+    if DumpStore.is_store(profile):
+        for record in DumpStore.memory_records(profile, timed, start, end):
+            yield record
+        return
+    for line in _read_dump(profile, timed, start=start, end=end):
+        line = line.rstrip()
+        try:
+            (time, name, mem) = _parse_thread_memory(line, timed)
+        except ValueError:
+            print("Unable to parse a line.", file=sys.stderr)
+            continue
+        yield (time, name, mem)
+
+
+def _times(profile, start=None, end=None):
+    """Iterates over the timestamps of a thread memory dump."""
+    if DumpStore.is_store(profile):
+        for (time, _, _) in DumpStore.memory_records(
+                profile, True, start, end):
+            yield time
+        return
+    for line in _read_dump(profile, start=start, end=end):
+        line = line.rstrip()
+        (time, _, _) = _parse_thread_memory(line, True)
+        yield time
+
+
+def _data_file():
+    """Creates a gnuplot data file, removed by the caller once plotted.
+
+    The file outlives the worker process that writes it with --jobs.
+    """
+    return tempfile.NamedTemporaryFile(mode="w", delete=False)
+
+
+def _map_files(function, args):
+    """Applies function(args, profile) to each of args.files.
+
+    With --jobs N the files are processed by a pool of N processes.
+    Results are returned in the order of the files either way, so that
+    merging them gives the same output as processing the files in turn.
+    """
+    function = partial(function, args)
+    if args.jobs <= 1 or len(args.files) <= 1:
+        return map(function, args.files)
+    return _pool_map(function, args.files, min(args.jobs, len(args.files)))
+
+
+def _pool_map(function, files, jobs):
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap(function, files):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 # Processing functions.
+def _memg_file(args, profile):
+    """Converts a dump into a memg data file.
+
+    Returns:
+        (profile, title, data, peaks, samples) where data is the name of
+        the data file or None if there is nothing to plot, peaks is a list
+        of (x, kmem, label) peak candidates and samples is the list of
+        (time, kmem) samples of a process dump, None for threads.
+    """
+    thread = _thread_name(profile, args)
+    (start, end) = _time_range(args) if args.time else (None, None)
+    if _is_process(profile):
+        if args.no_process:
+            return (profile, thread, None, [], None)
+        print("Processing data for the process", file=sys.stderr)
+        data = _data_file()
+        samples = []
+        for (time, mem) in _process_records(profile, start, end):
+            mem = mem / 1024
+            samples.append((float(time), mem))
+            mem -= args.process_rebase
+            data.write("{0} {1}\n".format(time, mem))
+        data.close()
+        return (profile, thread[:-len("process")] + "Process", data.name, [],
+                samples)
+    print("Processing data for thread " + thread, file=sys.stderr)
+    if MemoryGraph.available():
+        return _memg_vectorized(args, profile, thread, start, end)
+    zero_insert = False  # Used to remove duplicate zero points after a non-zero point.
+    prev_zero = None  # A zero point should be added before the current point:
+                      #   if there is a sequence of zero values we should plot the
+                      #   first and last zeros but not the ones in the middle.
+                      #   The first is needed to prevent misleading graphs, the last
+                      #   is to prevent strange lines cutting the graph.
+    index = 0  # Used to convert file:line:function to a number.
+               # Although file:line:function has more meaning, it is impossible to see in the plot.
+    peaks = []
+    data = _data_file()
+    for (time, name, mem) in _memory_records(profile, args.time, start, end):
+        if mem or zero_insert:
+            if prev_zero:
+                data.write('{0} {1}\n'.format(prev_zero or index, 0))
+                prev_zero = None
+            kmem = mem / 1024  # Convert B to KB
+            if args.cap and abs(kmem) > args.cap:
+                kmem = math.copysign(args.cap, kmem)
+            data.write('{0} {1}\n'.format(time or index, kmem))
+            if abs(kmem) > args.peak:
+                label = "{0}=>{1}".format(_resolve(name, profile), mem)
+                peaks.append((time or index, kmem, label))
+            zero_insert = kmem != 0
+            index += 1
+        else:
+            prev_zero = time
+    data.close()
+    if not index:
+        os.remove(data.name)
+        return (profile, thread, None, peaks, None)
+    return (profile, thread, data.name, peaks, None)
+
+
+def _memg_vectorized(args, profile, thread, start, end):
+    """Same as the thread part of _memg_file with the MemoryGraph engine."""
+    names = {}
+    errors = []
+    data = _data_file()
+    (count, peaks) = MemoryGraph.write_thread(
+        data, MemoryGraph.read_chunks(profile, args.time, names, errors,
+                                      start, end),
+        args.time, args.cap, args.peak)
+    data.close()
+    for _ in errors:
+        print("Unable to parse a line.", file=sys.stderr)
+    peaks = [(x, kmem, "{0}=>{1}".format(
+                 _resolve(names.get(code, "@" + str(code)), profile), mem))
+             for (x, kmem, code, mem) in peaks]
+    if not count:
+        os.remove(data.name)
+        return (profile, thread, None, peaks, None)
+    return (profile, thread, data.name, peaks, None)
+
+
 def memg(args):
     """Graphs the memory usage of each thread and the process.
 
@@ -111,75 +520,37 @@ def memg(args):
           where TIME# is a Unix timestamp, which is required if --time is set
           and must be omitted it otherwise, and MEM is in bytes.
       * The exception to the rule above is a file called "process.*".
-          In this file the lines must be TIME#MEM
-          where TIME# is always required and MEM is, again, in bytes.
+          In this file the lines must be TIME#MEM[;COUNTERS]
+          where TIME# is always required, MEM is, again, in bytes and
+          COUNTERS, written by setProcessMemoryInterval, are ignored.
     """
-    # Process lines and store them in a temporary file.
+    # Process lines and store them in temporary files.
     marks = _Markers()
     temps = []
     peaks = []
-    for profile in args.files:
-        thread = os.path.basename(profile).rsplit(".", 1)[0]
-        if thread == "process":
-            if args.no_process:
-                continue
-            print("Processing data for the process", file=sys.stderr)
-            with open(profile) as f:
-                data = tempfile.NamedTemporaryFile(mode="w")
-                for line in f:
-                    line = line.rstrip()
-                    try:
-                        (time, mem) = _parse_process_memory(line)
-                        mem = int(mem) / 1024
-                    except ValueError:
-                        print("Unable to parse a line", file=sys.stderr)
-                        continue
-                    mem -= args.process_rebase
-                    data.write("{0} {1}\n".format(time, mem))
-                temps.append((data, "Process"))
-            data.flush()
-            continue
-        print("Processing data for thread " + thread, file=sys.stderr)
-        with open(profile) as f:
-            zero_insert = False  # Used to remove duplicate zero points after a non-zero point.
-            prev_zero = None  # A zero point should be added before the current point:
-                              #   if there is a sequence of zero values we should plot the
-                              #   first and last zeros but not the ones in the middle.
-                              #   The first is needed to prevent misleading graphs, the last
-                              #   is to prevent strange lines cutting the graph.
-            index = 0  # Used to convert file:line:function to a number.
-                       # Although file:line:function has more meaning, it is impossible to see in the plot.
-            data = tempfile.NamedTemporaryFile(mode="w")
-            for line in f:
-                line = line.rstrip()
-                try:
-                    (time, name, mem) = _parse_thread_memory(line, args.time)
-                    mem = int(mem)
-                except ValueError:
-                    print("Unable to parse a line.", file=sys.stderr)
-                    continue
-                if mem or zero_insert:
-                    if prev_zero:
-                        data.write('{0} {1}\n'.format(prev_zero or index, 0))
-                        prev_zero = None
-                    kmem = mem / 1024  # Convert B to KB
-                    if args.cap and abs(kmem) > args.cap:
-                        kmem = math.copysign(args.cap, kmem)
-                    data.write('{0} {1}\n'.format(time or index, kmem))
-                    if abs(kmem) > args.peak:
-                        label = "{0}=>{1}".format(name, mem)
-                        peaks.append((time or index, kmem, marks.newMark(label, thread)))
-                    zero_insert = kmem != 0
-                    index += 1
-                else:
-                    prev_zero = time
-            if index:
-                data.flush()
-                temps.append((data, thread))
-            else:
-                data.close()
+    processes = []
+    for (profile, thread, data, file_peaks, samples) in _map_files(
+            _memg_file, args):
+        for (time, kmem, label) in file_peaks:
+            peaks.append((time, kmem, marks.newMark(label, thread)))
+        if samples is not None:
+            processes.append((profile, samples))
+        if data is not None:
+            temps.append((data, thread))
+    if len(processes) > 1:
+        # The memory of the whole process tree.
+        print("Summing the memory of the processes", file=sys.stderr)
+        data = _data_file()
+        for (time, mem) in _sum_series([samples for (_, samples)
+                                        in processes]):
+            data.write("{0} {1}\n".format(time, mem - args.process_rebase))
+        data.close()
+        temps.append((data.name, "Total"))
     # If time is available sort all peaks and filter the list to avoid overlaps.
-    if args.time and peaks:
+    if args.time and peaks and MemoryGraph.available():
+        peaks = MemoryGraph.filter_peaks(
+            peaks, args.peak_delta_time, args.peak_delta_value)
+    elif args.time and peaks:
         sorted_peaks = sorted(peaks)
         peaks = [sorted_peaks[0]]
         for (time, mem, mark) in sorted_peaks[1:]:
@@ -203,24 +574,61 @@ def memg(args):
         plot.write('set label at "{0}",{1} "{2}" front center\n'.format(i, v, m))
     for m in sorted(marks.iter()):
         legend.write('{0}: {1}\n'.format(m, marks.getElement(m)))
+    for (profile, _) in processes:
+        info = _process_info(profile)
+        if info is not None:
+            legend.write('Process {0}: {1}, parent {2}\n'.format(
+                info["pid"], info["start"], info["parent"]))
     plot.write('plot ')
     for (temp, thread) in temps[:-1]:
         plot.write('"{0}" using 1:2 with lines title "{1}", \\\n'
-                   .format(temp.name, thread))
+                   .format(temp, thread))
     if temps:
         plot.write('"{0}" using 1:2 with lines title "{1}"\n'
-                   .format(temps[-1][0].name, temps[-1][1]))
+                   .format(temps[-1][0], temps[-1][1]))
     # Create plot.
     plot.flush()
     print("Running gnuplot.", file=sys.stderr)
     gnuplot = subprocess.Popen(["gnuplot", plot.name])
     gnuplot.wait()
     for (temp, _) in temps:
-        temp.close()
+        os.remove(temp)
     plot.close()
     legend.close()
 
 
+def _memh_file(args, profile):
+    """Sums the memory of a dump by function.
+
+    Returns:
+        The list of (name, KB) pairs, in the order they are to be added to
+        the bins.
+    """
+    thread = _thread_name(profile, args)
+    if _is_process(profile):
+        return []
+    if _is_snapshot(profile):
+        print("Processing snapshot " + profile, file=sys.stderr)
+        with OutputStream.open_stream(profile) as f:
+            return [(name, total / 1024)
+                    for (name, _, total, _, _, _) in DumpFormat.read_snapshot(
+                        io.TextIOWrapper(f))]
+    print("Processing data for thread " + thread, file=sys.stderr)
+    thread_bins = {}
+    if DumpStore.is_store(profile):
+        for (name, mem) in DumpStore.memory_totals(profile).items():
+            thread_bins[name] = mem / 1024
+    else:
+        for line in _read_dump(profile, args.time):
+            line = line.rstrip()
+            (time, name, mem) = _parse_thread_memory(line, args.time)
+            mem = int(mem) / 1024
+            thread_bins[name] = thread_bins.get(name, 0) + mem
+    # Symbol ids are only unique within a process.
+    return [(_resolve(name, profile), mem)
+            for (name, mem) in thread_bins.items()]
+
+
 def memh(args):
     """Highlights most allocating and freeing functions.
 
@@ -233,20 +641,13 @@ def memh(args):
           where TIME# is a Unix timestamp, which is required if --time is set
           and must be omitted it otherwise, and MEM is in bytes.
       * The exception to the rule above is a file called "process.*" which is ignored.
+      * Aggregate snapshots are recognised and their totals used directly.
     """
     # Build bins.
     bins = {}
-    for profile in args.files:
-        thread = os.path.basename(profile).rsplit(".", 1)[0]
-        if thread == "process":
-            continue
-        print("Processing data for thread " + thread, file=sys.stderr)
-        with open(profile) as f:
-            for line in f:
-                line = line.rstrip()
-                (time, name, mem) = _parse_thread_memory(line, args.time)
-                mem = int(mem) / 1024
-                bins[name] = bins.get(name, 0) + mem
+    for file_bins in _map_files(_memh_file, args):
+        for (name, mem) in file_bins:
+            bins[name] = bins.get(name, 0) + mem
     # Write them to file.
     def key(kv):
         (k, v) = kv
@@ -279,6 +680,204 @@ def memh(args):
     data.close()
 
 
+def timeh(args):
+    """Highlights the functions with the highest inclusive time.
+
+    Ranks functions by total wall time, CPU time or waiting time (wall time
+    minus CPU time, spent blocked on I/O, locks or the GIL) and graphs the
+    top ones with gnuplot.
+    Also creates a legend file with the totals for the displayed functions.
+
+    The files must meet the following assumptions:
+      * Each line in non-empty files has the form TIME#NAME=>MEM;WALL[;CPU]
+          where TIME# is a Unix timestamp, which is required if --time is set
+          and must be omitted it otherwise, and WALL and CPU are in
+          nanoseconds. Lines without durations are ignored.
+          With --subtract_overhead the estimated cost of the profiler
+          events of each call, from "profiler.stats", is subtracted (the
+          cost of nested calls is not known and is not subtracted).
+      * Summary lines of throttled functions only add to the number of
+          throttled calls, their time was not recorded.
+      * The exception to the rule above is a file called "process.*" which is ignored.
+      * Aggregate snapshots are recognised and their wall times used directly.
+    """
+    # Build bins: calls, wall and CPU time for each function.
+    bins = {}
+    def add(name, calls, wall, cpu, throttled=0):
+        totals = bins.setdefault(name, [0, 0, 0, 0])
+        totals[0] += calls
+        totals[1] += wall
+        totals[2] += cpu
+        totals[3] += throttled
+    for profile in args.files:
+        thread = _thread_name(profile, args)
+        if _is_process(profile):
+            continue
+        if _is_snapshot(profile):
+            print("Processing snapshot " + profile, file=sys.stderr)
+            with OutputStream.open_stream(profile) as f:
+                for (name, calls, _, _, _, elapsed) in DumpFormat.read_snapshot(
+                        io.TextIOWrapper(f)):
+                    add(name, calls, elapsed * 1000000000, 0)
+            continue
+        print("Processing data for thread " + thread, file=sys.stderr)
+        thread_bins = {}
+        for line in _read_dump(profile, args.time, summaries=True):
+            line = line.rstrip()
+            if DumpFormat.is_summary(line):
+                (_, name, calls) = _parse_thread_memory(line[1:], args.time)
+                thread_bins.setdefault(name, [0, 0, 0, 0])[3] += calls
+                continue
+            (_, name, _, wall, cpu) = _parse_thread_durations(line, args.time)
+            if wall is None:
+                continue
+            totals = thread_bins.setdefault(name, [0, 0, 0, 0])
+            totals[0] += 1
+            totals[1] += wall
+            totals[2] += cpu or 0
+        overhead = _overhead(profile) if args.subtract_overhead else 0
+        # Symbol ids are only unique within a process.
+        for (name, (calls, wall, cpu, throttled)) in thread_bins.items():
+            add(_resolve(name, profile), calls,
+                max(wall - calls * overhead, 0),
+                max(cpu - calls * overhead, 0) if cpu else 0, throttled)
+    # Rank and write the top functions to file.
+    def key(kv):
+        (name, (calls, wall, cpu, _)) = kv
+        value = {"wall": wall, "cpu": cpu, "wait": wall - cpu}[args.sort]
+        return (value, name)
+    histo = sorted(bins.items(), key=key, reverse=True)[:args.top]
+    data = tempfile.NamedTemporaryFile(mode="w")
+    marks = _Markers()
+    legend = open("timeh.txt", "w")
+    for (name, totals) in histo:
+        mark = marks.newMark(name)
+        (calls, wall, cpu, throttled) = totals
+        data.write('"{0}" {1}\n'.format(mark, key((name, totals))[0] / 1e6))
+        legend.write("{0}: {1} calls={2} wall={3:.6f}s cpu={4:.6f}s".format(
+            mark, name, calls, wall / 1e9, cpu / 1e9))
+        if throttled:
+            legend.write(" throttled={0}".format(throttled))
+        legend.write("\n")
+    legend.close()
+    data.flush()
+    # Create plot definition.
+    plot = tempfile.NamedTemporaryFile(mode="w")
+    plot.write('set term svg size 1920,1080\n')
+    plot.write('set output "timeh.svg"\n')
+    plot.write('set ylabel "{0} time (ms)"\n'.format(args.sort))
+    plot.write('plot "{0}" using 2:xticlabels(1) with boxes\n'
+               .format(data.name))
+    # Create plot.
+    plot.flush()
+    print("Running gnuplot.", file=sys.stderr)
+    gnuplot = subprocess.Popen(["gnuplot", plot.name])
+    gnuplot.wait()
+    plot.close()
+    data.close()
+
+
+def blockh(args):
+    """Ranks where each thread spends its time waiting.
+
+    Sums the blocking calls of each thread by call site and blocking
+    function, ranks them by off-CPU or wall time and graphs the top ones
+    with gnuplot.
+    Also creates a legend file with the totals of each thread followed by
+    the totals for the displayed call sites.
+
+    The files must meet the following assumptions:
+      * Each line in non-empty files has the form
+          TIME#SITE=>BLOCKER;WALL;OFFCPU
+          where TIME# is a Unix timestamp, which is required if --time is set
+          and must be omitted it otherwise, and WALL and OFFCPU are in
+          nanoseconds.
+    """
+    # Build bins: calls, wall and off-CPU time for each thread and site.
+    bins = {}
+    threads = {}
+    for profile in args.files:
+        thread = _thread_name(profile, args)
+        print("Processing data for thread " + thread, file=sys.stderr)
+        thread_bins = {}
+        for line in _read_dump(profile, args.time):
+            (_, site, blocker, wall, off_cpu) = _parse_block(
+                line.rstrip(), args.time)
+            totals = thread_bins.setdefault((site, blocker), [0, 0, 0])
+            totals[0] += 1
+            totals[1] += wall
+            totals[2] += off_cpu
+        thread_totals = threads.setdefault(thread, [0, 0, 0])
+        for ((site, blocker), totals) in thread_bins.items():
+            key = (thread, _resolve(site, profile), _resolve(blocker, profile))
+            merged = bins.setdefault(key, [0, 0, 0])
+            for index in range(3):
+                merged[index] += totals[index]
+                thread_totals[index] += totals[index]
+    # Rank and write the top sites to file.
+    column = 1 if args.sort == "wall" else 2
+    def key(kv):
+        return (kv[1][column], kv[0])
+    histo = sorted(bins.items(), key=key, reverse=True)[:args.top]
+    data = tempfile.NamedTemporaryFile(mode="w")
+    marks = _Markers()
+    legend = open("blockh.txt", "w")
+    for (thread, (calls, wall, off_cpu)) in sorted(
+            threads.items(), key=lambda kv: (kv[1][column], kv[0]),
+            reverse=True):
+        legend.write("{0}: calls={1} wall={2:.6f}s off_cpu={3:.6f}s\n"
+                     .format(thread, calls, wall / 1e9, off_cpu / 1e9))
+    for ((thread, site, blocker), totals) in histo:
+        mark = marks.newMark("{0} via {1}".format(site, blocker), thread)
+        (calls, wall, off_cpu) = totals
+        data.write('"{0}" {1}\n'.format(mark, totals[column] / 1e6))
+        legend.write("{0}: {1} calls={2} wall={3:.6f}s off_cpu={4:.6f}s\n"
+                     .format(mark, marks.getElement(mark), calls, wall / 1e9,
+                             off_cpu / 1e9))
+    legend.close()
+    data.flush()
+    # Create plot definition.
+    plot = tempfile.NamedTemporaryFile(mode="w")
+    plot.write('set term svg size 1920,1080\n')
+    plot.write('set output "blockh.svg"\n')
+    plot.write('set ylabel "{0} time (ms)"\n'.format(
+        "wall" if args.sort == "wall" else "off-CPU"))
+    plot.write('plot "{0}" using 2:xticlabels(1) with boxes\n'
+               .format(data.name))
+    # Create plot.
+    plot.flush()
+    print("Running gnuplot.", file=sys.stderr)
+    gnuplot = subprocess.Popen(["gnuplot", plot.name])
+    gnuplot.wait()
+    plot.close()
+    data.close()
+
+
+def _nesting_file(args, profile):
+    """Converts a stack dump into a nesting data file.
+
+    Returns:
+        (thread, data) where data is the name of the data file, None if the
+        dump is empty.
+    """
+    thread = _thread_name(profile, args)
+    print("Processing data for thread " + thread, file=sys.stderr)
+    data = _data_file()
+    index = 0
+    if DumpStore.is_store(profile):
+        index = DumpStore.write_points(data, profile, "depth", args.time)
+    for line in ([] if index else _read_dump(profile, args.time)):
+        line = line.rstrip()
+        (level, time, name) = _parse_thread_stack(line, args.time)
+        data.write("{0} {1}\n".format(time if time else index, level))
+        index += 1
+    data.close()
+    if not index:
+        os.remove(data.name)
+        return (thread, None)
+    return (thread, data.name)
+
+
 def nesting(args):
     """Display per-thread stack nesting.
 
@@ -291,23 +890,8 @@ def nesting(args):
           TIME# is a Unix timestamp, which is required if --time is set
           and must be omitted it otherwise, and .* is anything (and is ignored).
     """
-    temps = []
-    for profile in args.files:
-        thread = os.path.basename(profile).rsplit(".", 1)[0]
-        print("Processing data for thread " + thread, file=sys.stderr)
-        with open(profile) as f:
-            data = tempfile.NamedTemporaryFile(mode="w")
-            index = 0
-            for line in f:
-                line = line.rstrip()
-                (level, time, name) = _parse_thread_stack(line, args.time)
-                data.write("{0} {1}\n".format(time if time else index, level))
-                index += 1
-            if index:
-                data.flush()
-                temps.append((data, thread))
-            else:
-                data.close()
+    temps = [(data, thread) for (thread, data)
+             in _map_files(_nesting_file, args) if data is not None]
     # Create plot definition.
     plot = tempfile.NamedTemporaryFile(mode="w")
     plot.write('set term png size 1920,1080\n')
@@ -318,19 +902,63 @@ def nesting(args):
     plot.write('plot ')
     for (temp, thread) in temps[:-1]:
         plot.write('"{0}" using 1:2 with points title "{1}", \\\n'
-                   .format(temp.name, thread))
+                   .format(temp, thread))
     plot.write('"{0}" using 1:2 with points title "{1}"\n'
-               .format(temps[-1][0].name, temps[-1][1]))
+               .format(temps[-1][0], temps[-1][1]))
     # Create plot.
     plot.flush()
     print("Running gnuplot.", file=sys.stderr)
     gnuplot = subprocess.Popen(['gnuplot', plot.name])
     gnuplot.wait()
     for (temp, _) in temps:
-        temp.close()
+        os.remove(temp)
     plot.close()
 
 
+def _fold(items):
+    """Removes all consecutive thread events except the first and last."""
+    last = None
+    for (time, thread) in items:
+        if last is None:
+            yield (time, thread)
+        elif thread != last[1]:
+            yield last
+            yield (time, thread)
+        last = (time, thread)
+
+
+def _interleaved(args):
+    """Merges the events of the thread dumps in time order.
+
+    Dumps are written in time order: they are merged as they are read.
+
+    Returns:
+        (threads, events) where threads maps the thread names to their ids
+        and events iterates over the (time, thread) events, consecutive
+        events of a thread folded into the first and last (see _fold).
+    """
+    def events(profile, thread):
+        for time in _times(profile, start, end):
+            yield (time, thread)
+
+    (start, end) = _time_range(args)
+    streams = []
+    threads = {}
+    thread_id = 0
+    for profile in args.files:
+        thread = _thread_name(profile, args)
+        if _is_process(profile):
+            continue
+        if args.merge_tasks:
+            thread = thread.split("@", 1)[0]
+        if thread not in threads:
+            threads[thread] = thread_id
+            thread_id += 1
+        print("Processing data for thread " + thread, file=sys.stderr)
+        streams.append(events(profile, thread))
+    return (threads, _fold(heapq.merge(*streams)))
+
+
 def interleave(args):
     """Graph the interleaving of threads.
 
@@ -341,56 +969,31 @@ def interleave(args):
     The files must meet the following assumptions:
       * Each line in non-empty file has the form TIME#.*
           where TIME# is a Unix timestamp and .* is ignored.
+      * The lines of each file are in time order, as the profiler writes them.
       * The exception to the rule above is a file called "process.*" which is ignored.
-    """
-    def fold(items):
-        """Removes all consecutive thread events except the first and last."""
-        final = []
-        if items:
-            final.append(items[0])
-            (ltime, lthread) = items[0]
-            for (time, thread) in items[1:]:
-                if thread != lthread:
-                    final.append((ltime, lthread))
-                    final.append((time, thread))
-                ltime = time
-                lthread = thread
-        return final
-
-    def split(items):
-        """Split a list of items into multiple lists, one per thread."""
-        final = {}
-        for (time, thread) in items:
-            if thread not in final:
-                final[thread] = [time]
-            else:
-                final[thread].append(time)
-        return final
 
-    times = []
-    threads = {}
-    thread_id = 0
-    for profile in args.files:
-        thread = os.path.basename(profile).rsplit(".", 1)[0]
-        if thread == "process":
-            continue
-        threads[thread] = thread_id
-        thread_id += 1
-        print("Processing data for thread " + thread, file=sys.stderr)
-        with open(profile) as f:
-            for line in f:
-                line = line.rstrip()
-                (time, _, _) = _parse_thread_memory(line, True)
-                times.append((time, thread))
-                used = True
-    times = split(fold(sorted(times)))
+    The files are merged as they are read, so memory use depends on the
+    number of files rather than on the number of events.
+
+    Tasks profiled in asyncio mode have their own files, named
+    THREAD@TASK, and are displayed as threads so the graph shows how the
+    tasks interleave on the event loop.
+    With --merge_tasks the events of tasks are shown as events of their
+    thread instead.
+    """
+    (threads, events) = _interleaved(args)
+    # Write each event straight to the file of its thread.
+    files = {}
     temps = []
-    for (thread, stamps) in times.items():
-        data = tempfile.NamedTemporaryFile(mode="w")
-        for stamp in stamps:
-            data.write('{0} {1}\n'.format(stamp, threads[thread]))
+    for (stamp, thread) in events:
+        data = files.get(thread)
+        if data is None:
+            data = tempfile.NamedTemporaryFile(mode="w")
+            files[thread] = data
+            temps.append((data, thread))
+        data.write('{0} {1}\n'.format(stamp, threads[thread]))
+    for (data, _) in temps:
         data.flush()
-        temps.append((data, thread))
     # Create plot definition.
     plot = tempfile.NamedTemporaryFile(mode="w")
     legend = open("interleave.txt", "w")
@@ -431,56 +1034,57 @@ def decorate_stack(args):
     except ValueError:
         pass
     print("Scanning memory file looking for the event.", file=sys.stderr)
-    mem_to_reverse = tempfile.NamedTemporaryFile()
+    mem_to_reverse = tempfile.NamedTemporaryFile(mode="w+")
     event_file_name = ""
     event_function_name = ""
     mem_time = 0
-    with open(args.mem) as f:
-        index = 0
-        for line in f:
-            line = line.rstrip()
-            mem_to_reverse.write("{0}\n".format(line))
-            index += 1
-            if ((is_event_line_number and index >= max_line) or
-                line == args.event):
-                break;
-        mem_to_reverse.flush()
-        (mem_time, name, _) = _parse_thread_memory(line, True)
-        (event_file_name, _, event_function_name) = name.split(":")
+    index = 0
+    for line in _read_dump(args.mem, summaries=True):
+        line = line.rstrip()
+        index += 1
+        if DumpFormat.is_summary(line):
+            # Counted so that line numbers match the dump file.
+            continue
+        mem_to_reverse.write("{0}\n".format(line))
+        if ((is_event_line_number and index >= max_line) or
+            line == args.event):
+            break;
+    mem_to_reverse.flush()
+    (mem_time, name, _) = _parse_thread_memory(line, True)
+    (event_file_name, _, event_function_name) = _resolve(name, args.mem).split(":")
     print("Scanning stack file looking for a matching event.", file=sys.stderr)
-    stack_to_analize = tempfile.NamedTemporaryFile()
-    with open(args.stack) as f:
-        looking_for_start = True
-        base_trace_level = 0
-        for line in f:
-            line = line.rstrip()
-            (level, stack_time, name) = _parse_thread_stack(line, True)
-            (file_name, _, function_name) = name.split(":")
-            if looking_for_start and stack_time > mem_time:
-                    raise Exception("Unable to find event in stack trace.")
-            # When a matching event before mem_time is found assume it is
-            # the latest and start writing lines to the temp file.
-            # If it was not, the next match will reset the temp file and
-            # overwrite false positives.
-            if (event_file_name == file_name and
-                    event_function_name == function_name and
-                    stack_time <= mem_time):
-                base_trace_level = level
-                looking_for_start = False
+    stack_to_analize = tempfile.NamedTemporaryFile(mode="w+")
+    looking_for_start = True
+    base_trace_level = 0
+    for line in _read_dump(args.stack):
+        line = line.rstrip()
+        (level, stack_time, name) = _parse_thread_stack(line, True)
+        (file_name, _, function_name) = _resolve(name, args.stack).split(":")
+        if looking_for_start and stack_time > mem_time:
+                raise Exception("Unable to find event in stack trace.")
+        # When a matching event before mem_time is found assume it is
+        # the latest and start writing lines to the temp file.
+        # If it was not, the next match will reset the temp file and
+        # overwrite false positives.
+        if (event_file_name == file_name and
+                event_function_name == function_name and
+                stack_time <= mem_time):
+            base_trace_level = level
+            looking_for_start = False
+            data = line[base_trace_level:]
+            stack_to_analize.seek(0);
+            stack_to_analize.write("{0}\n".format(data))
+            stack_to_analize.truncate();
+        elif not looking_for_start:
+            if level <= base_trace_level:
+                # A trace event outside the scope of interest was found.
+                break
+            else:
                 data = line[base_trace_level:]
-                stack_to_analize.seek(0);
                 stack_to_analize.write("{0}\n".format(data))
-                stack_to_analize.truncate();
-            elif not looking_for_start:
-                if level <= base_trace_level:
-                    # A trace event outside the scope of interest was found.
-                    break
-                else:
-                    data = line[base_trace_level:]
-                    stack_to_analize.write("{0}\n".format(data))
-        stack_to_analize.flush()
+    stack_to_analize.flush()
     print("Reversing memory events of interest.", file=sys.stderr)
-    reversed_mem = tempfile.NamedTemporaryFile()
+    reversed_mem = tempfile.NamedTemporaryFile(mode="w+")
     reverse = subprocess.Popen([args.reverse, mem_to_reverse.name], stdout=reversed_mem)
     reverse.wait()
     mem_to_reverse.close()
@@ -493,11 +1097,19 @@ def decorate_stack(args):
 
     def print_decorate_trace(node):
         mem_line = node.get("mem-line")
-        (end_time, end_name, mem) = _parse_thread_memory(mem_line, True)
+        (end_time, end_name, mem, wall, _) = _parse_thread_durations(
+            mem_line, True)
         (_, start_time, start_name) = _parse_thread_stack(node.value(), True)
-        (file_name, end_line, function_name) = end_name.split(":")
-        (_, start_line, _) = start_name.split(":")
-        delta = end_time - start_time
+        (file_name, end_line, function_name) = _resolve(end_name, args.mem).split(":")
+        (_, start_line, _) = _resolve(start_name, args.stack).split(":")
+        if wall is not None:
+            # Measured by the profiler, more accurate than the timestamps.
+            delta = wall / 1e9
+        else:
+            delta = end_time - start_time
+        if args.subtract_overhead:
+            # Every traced call below this one, and this one, cost events.
+            delta = max(delta - node.count() * _overhead(args.mem) / 1e9, 0)
         indent = "".join([args.indent] * node.level())
         if args.prefix and file_name.startswith(args.prefix):
             file_name = file_name[len(args.prefix):]
@@ -515,22 +1127,138 @@ def decorate_stack(args):
 
 
 # Command line parsers.
-def _common_parser(parser, function=None):
+def import_dumps(args):
+    """Converts the dumps of processes into a columnar store.
+
+    Each dump is parsed once and written as NumPy arrays to a directory
+    named after it (see DumpStore), under a directory per process in the
+    output directory.
+    The other commands accept the dumps of the store in place of the
+    original ones and read the columns they need through memory maps.
+    Aggregate snapshots are not imported.
+    """
+    nan = float("nan")
+    dumps = _pid_dumps(args.directories, (".mem", ".stack", ".block"))
+    processes = []
+    for dump in dumps:
+        directory = os.path.dirname(dump)
+        if not processes or processes[-1][0] != directory:
+            processes.append((directory, []))
+        processes[-1][1].append(dump)
+    for (directory, names) in processes:
+        pid = os.path.basename(os.path.normpath(directory))
+        print("Importing process " + pid, file=sys.stderr)
+        writer = DumpStore.StoreWriter(os.path.join(args.output, pid))
+        for dump in names:
+            if _is_snapshot(dump):
+                continue
+            (kind, rows) = _store_rows(dump, writer, args.time, nan)
+            writer.writeDump(os.path.basename(dump), kind, rows)
+        writer.copy(os.path.join(directory, "process.info"))
+        writer.copy(os.path.join(directory, "profiler.stats"))
+        writer.close()
+
+
+def _store_rows(dump, writer, timed, nan):
+    """Returns the store kind and the rows of a dump (see import_dumps)."""
+    symbols = {}
+
+    def symbol(name):
+        ident = symbols.get(name)
+        if ident is None:
+            ident = writer.symbol(_resolve(name, dump))
+            symbols[name] = ident
+        return ident
+
+    def stamp(time):
+        return nan if time is None else time
+
+    lines = (line.rstrip() for line in _read_dump(dump, timed, summaries=True))
+    if _is_process(dump):
+        return (DumpStore.KIND_PROCESS,
+                ((float(time), mem) for (time, mem) in
+                 (_parse_process_memory(line) for line in lines)))
+    if dump.endswith(".stack"):
+        return (DumpStore.KIND_STACK,
+                ((stamp(time), level, symbol(name)) for (level, time, name) in
+                 (_parse_thread_stack(line, timed) for line in lines)))
+    if dump.endswith(".block"):
+        return (DumpStore.KIND_BLOCK,
+                ((stamp(time), 0, symbol(site), symbol(blocker), wall, off)
+                 for (time, site, blocker, wall, off) in
+                 (_parse_block(line, timed) for line in lines)))
+    # Memory dumps record durations on all lines or none.
+    durations = False
+    for line in _read_dump(dump, timed):
+        durations = _parse_thread_durations(line.rstrip(), timed)[3] is not None
+        break
+
+    def memory_rows():
+        for line in lines:
+            summary = DumpFormat.is_summary(line)
+            if summary:
+                line = line[len(DumpFormat.SUMMARY_PREFIX):]
+            (time, name, mem, wall, cpu) = _parse_thread_durations(line, timed)
+            row = (stamp(time), DumpFormat.SUMMARY_DEPTH if summary else 0,
+                   symbol(name), mem)
+            if durations:
+                row += ((-1, -1) if summary else
+                        (-1 if wall is None else wall,
+                         -1 if cpu is None else cpu))
+            yield row
+
+    return (DumpStore.KIND_MEMORY_TIMED if durations else DumpStore.KIND_MEMORY,
+            memory_rows())
+
+
+def _import_parser(parser):
+    """Populates a parser with the import command options."""
+    parser.add_argument(
+        "--output", action="store", default="store",
+        help="Directory of the store, created if needed.")
+    parser.add_argument(
+        "directories", metavar="DIRECTORY", nargs="+",
+        help="Log directories or process directories to import.")
+    parser.set_defaults(process=import_dumps)
+
+
+def _common_parser(parser, function=None, suffixes=(".mem",)):
     """Populates a parser with the generic command options."""
+    parser.add_argument(
+        "--merge_pids", action="store_true", default=False,
+        help=("The FILEs are log directories: process the dumps of every "
+              "process directory under them together."))
     parser.add_argument("files", metavar="FILE", nargs="+", help="The dump files to process.")
+    parser.set_defaults(dump_suffixes=suffixes)
     if function:
         parser.set_defaults(process=function)
 
 def _time_parser(parser):
     parser.add_argument("--time_from", action="store", default=None,
-                        help="Initial time for the range passed to gnuplot.")
+                        help="Initial time of the range to process and plot.")
     parser.add_argument("--time_to", action="store", default=None,
-                        help="Final time for the range passed to gnuplot.")
+                        help="Final time of the range to process and plot.")
+
+
+def _jobs_parser(parser):
+    parser.add_argument(
+        "--jobs", action="store", default=1, type=int,
+        help="Number of processes parsing the files in parallel.")
+
+
+def _overhead_parser(parser):
+    parser.add_argument(
+        "--subtract_overhead", action="store_true", default=False,
+        help=("Subtract the estimated profiler overhead, read from the "
+              "profiler.stats file, from durations."))
 
 
 def _interleave_parser(parser):
     """Populates a parser with the memg command options."""
     _time_parser(parser)
+    parser.add_argument(
+        "--merge_tasks", action="store_true", default=False,
+        help="Show the events of asyncio tasks as events of their thread.")
     _common_parser(parser)
     parser.set_defaults(process=interleave)
 
@@ -560,10 +1288,49 @@ def _memg_parser(parser):
         help=("Prevent two peeks too close in memory to be marked. Helps keep "
               "the graphs readable."))
     _time_parser(parser)
+    _jobs_parser(parser)
     _common_parser(parser)
     parser.set_defaults(process=memg)
 
 
+def _memh_parser(parser):
+    """Populates a parser with the memh command options."""
+    _jobs_parser(parser)
+    _common_parser(parser, memh, (".mem", ".snap"))
+
+
+def _nesting_parser(parser):
+    """Populates a parser with the nesting command options."""
+    _jobs_parser(parser)
+    _common_parser(parser, nesting, (".stack",))
+
+
+def _timeh_parser(parser):
+    """Populates a parser with the timeh command options."""
+    parser.add_argument(
+        "--sort", action="store", default="wall",
+        choices=["wall", "cpu", "wait"],
+        help="Time used to rank functions.")
+    parser.add_argument(
+        "--top", action="store", default=30, type=int,
+        help="Number of functions to display.")
+    _overhead_parser(parser)
+    _common_parser(parser)
+    parser.set_defaults(process=timeh)
+
+
+def _blockh_parser(parser):
+    """Populates a parser with the blockh command options."""
+    parser.add_argument(
+        "--sort", action="store", default="off_cpu",
+        choices=["off_cpu", "wall"],
+        help="Time used to rank call sites.")
+    parser.add_argument(
+        "--top", action="store", default=30, type=int,
+        help="Number of call sites to display.")
+    _common_parser(parser, blockh, (".block",))
+
+
 def _decorate_stack_parser(parser):
     parser.add_argument(
         "--indent", action="store", default=" ",
@@ -574,6 +1341,7 @@ def _decorate_stack_parser(parser):
     parser.add_argument(
         "--reverse", action="store", default="tac",
         help="Command used to reverse useful memory file portion.")
+    _overhead_parser(parser)
     parser.add_argument("mem", action="store", help="Memory dump file.")
     parser.add_argument("stack", action="store", help="Stack dump file.")
     parser.add_argument("event", action="store", help=(
@@ -591,19 +1359,33 @@ def main():
     subparsers = parser.add_subparsers(help="Type of processing to do.")
 
     _memg_parser(subparsers.add_parser("memg", help="Graph per-thread memory profile."))
-    _common_parser(subparsers.add_parser(
+    _memh_parser(subparsers.add_parser(
         "memh", help=("Find functions with highest memory allocation and "
-                     "deallocation.")), memh)
-    _common_parser(subparsers.add_parser(
-        "nesting", help="Visualize stack trace nesting."), nesting)
+                     "deallocation.")))
+    _timeh_parser(subparsers.add_parser(
+        "timeh", help="Find functions with the highest inclusive time."))
+    _blockh_parser(subparsers.add_parser(
+        "blockh", help="Rank where each thread waits on blocking calls."))
+    _nesting_parser(subparsers.add_parser(
+        "nesting", help="Visualize stack trace nesting."))
     _interleave_parser(subparsers.add_parser(
         "interleave", help="Visualize thread interleaving."))
     _decorate_stack_parser(subparsers.add_parser(
         "decorate-stack", help=("Decorate stack traces with the help of "
                                 "memory information.")))
+    _import_parser(subparsers.add_parser(
+        "import", help="Convert dumps into a memory-mapped columnar store."))
 
     args = parser.parse_args()
     args.time = not args.no_time
+    if hasattr(args, "files"):
+        if args.merge_pids:
+            args.files = _pid_dumps(args.files, args.dump_suffixes)
+        else:
+            args.files = _logical_files(args.files)
+    if hasattr(args, "mem"):
+        args.mem = OutputStream.logical_name(args.mem)
+        args.stack = OutputStream.logical_name(args.stack)
     args.process(args)
 
 
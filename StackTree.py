@@ -28,6 +28,10 @@ class StackTree(object):
         self._value = value
         self._store = {}
 
+    def count(self):
+        """Returns the number of nodes in the tree, this one included."""
+        return 1 + sum(c.count() for c in self._children)
+
     def append(self, level, value):
         if level == self._level + 1:
             node = StackTree(level, value)
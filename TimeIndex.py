@@ -0,0 +1,228 @@
+"""
+(c) 2014 Arts Alliance Media
+
+Sparse time index of dumps, for reading only a time range of them.
+
+The index of a dump is kept in a sidecar file named after the dump stream
+with INDEX_SUFFIX appended (e.g. "Thread-1.mem.index").
+It records the timestamp and position of one record every INTERVAL
+records, a position being the index of a segment of the stream (see
+OutputStream) and an offset in its uncompressed bytes.
+The index starts with the size and modification time of each segment: it
+is built the first time a dump is read from a time and again whenever the
+dump has changed since.
+
+The sidecar file has the form:
+    INDEX_HEADER
+    segments<TAB>N
+    NAME<TAB>SIZE<TAB>MTIME_NS   (one line per segment)
+    TIME<TAB>SEGMENT<TAB>OFFSET  (one line per indexed record)
+
+Dumps without timestamps, or with timestamps out of order, and binary
+dumps with inline symbol definitions (which are needed to read the
+records after them) have an index without entries and are read from the
+start.
+"""
+
+from bisect import bisect_left
+import os
+
+import DumpFormat
+import OutputStream
+
+
+INDEX_HEADER = "#ThreadGraph time index v1"
+INDEX_SUFFIX = ".index"
+# Records between two entries of the index.
+INTERVAL = 1024
+
+_READ_CHUNK = 1024 * 1024
+
+
+class _Unindexable(Exception):
+    """Raised when a dump cannot be read from a position."""
+
+
+def _signature(segments):
+    signature = []
+    for segment in segments:
+        stat = os.stat(segment)
+        # st_mtime_ns is missing on Python 2.
+        mtime = getattr(stat, "st_mtime_ns", None)
+        if mtime is None:
+            mtime = int(stat.st_mtime * 1000000000)
+        signature.append((os.path.basename(segment), stat.st_size, mtime))
+    return signature
+
+
+def _line_time(line):
+    """Returns the timestamp of a line of a text dump."""
+    stamp = line.lstrip(b" " + DumpFormat.SUMMARY_PREFIX.encode("ascii"))
+    (stamp, separator, _) = stamp.partition(b"#")
+    if not separator:
+        raise _Unindexable()
+    return float(stamp)
+
+
+def _text_entries(segments):
+    count = 0
+    for (index, segment) in enumerate(segments):
+        offset = 0
+        with OutputStream.open_segment(segment, "rb") as f:
+            for line in f:
+                if not count % INTERVAL:
+                    yield (_line_time(line), index, offset)
+                offset += len(line)
+                count += 1
+
+
+def _binary_entries(segments, kind):
+    record = (DumpFormat.RECORD_TIMED
+              if kind in (DumpFormat.KIND_MEMORY_TIMED, DumpFormat.KIND_BLOCK)
+              else DumpFormat.RECORD)
+    count = 0
+    for (index, segment) in enumerate(segments):
+        offset = DumpFormat.HEADER.size if index == 0 else 0
+        with OutputStream.open_segment(segment, "rb") as f:
+            f.read(offset)
+            data = b""
+            while True:
+                chunk = f.read(_READ_CHUNK)
+                if not chunk:
+                    break
+                data += chunk
+                size = len(data) - len(data) % record.size
+                for start in range(0, size, record.size):
+                    fields = record.unpack_from(data, start)
+                    if fields[1] == DumpFormat.SYMBOL_DEPTH:
+                        raise _Unindexable()
+                    if not count % INTERVAL:
+                        if fields[0] != fields[0]:
+                            raise _Unindexable()
+                        yield (fields[0], index, offset)
+                    offset += record.size
+                    count += 1
+                data = data[size:]
+
+
+def _build(segments):
+    """Returns the entries of the index of a dump, [] if not indexable."""
+    with OutputStream.open_segment(segments[0], "rb") as f:
+        header = f.read(len(DumpFormat.SNAPSHOT_HEADER))
+    if DumpFormat.is_snapshot(header):
+        return []
+    header = header[:DumpFormat.HEADER.size]
+    entries = []
+    try:
+        if DumpFormat.is_binary(header):
+            (_, kind) = DumpFormat.HEADER.unpack(header)
+            for entry in _binary_entries(segments, kind):
+                entries.append(entry)
+        else:
+            for entry in _text_entries(segments):
+                entries.append(entry)
+    except (_Unindexable, ValueError):
+        return []
+    if any(entries[i][0] > entries[i + 1][0]
+           for i in range(len(entries) - 1)):
+        return []
+    return entries
+
+
+def _read(filename, signature):
+    """Reads a sidecar file, None if missing or out of date."""
+    try:
+        with open(filename) as f:
+            if f.readline().rstrip("\n") != INDEX_HEADER:
+                return None
+            count = int(f.readline().split("\t")[1])
+            stored = []
+            for _ in range(count):
+                (segment, size, mtime) = f.readline().rstrip("\n").split("\t")
+                stored.append((segment, int(size), int(mtime)))
+            if stored != signature:
+                return None
+            entries = []
+            for line in f:
+                (time, segment, offset) = line.split("\t")
+                entries.append((float(time), int(segment), int(offset)))
+            return entries
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def _write(filename, signature, entries):
+    """Writes a sidecar file, if the directory is writable."""
+    temporary = "{0}.{1}".format(filename, os.getpid())
+    try:
+        with open(temporary, "w") as f:
+            f.write(INDEX_HEADER + "\n")
+            f.write("segments\t{0}\n".format(len(signature)))
+            for entry in signature:
+                f.write("{0}\t{1}\t{2}\n".format(*entry))
+            for entry in entries:
+                f.write("{0!r}\t{1}\t{2}\n".format(*entry))
+        _replace(temporary, filename)
+    except (IOError, OSError):
+        pass
+
+
+def _replace(source, destination):
+    """os.replace, which Python 2 lacks."""
+    if hasattr(os, "replace"):
+        os.replace(source, destination)
+        return
+    try:
+        os.rename(source, destination)
+    except OSError:
+        # Windows does not rename over an existing file.
+        os.remove(destination)
+        os.rename(source, destination)
+
+
+def load(name):
+    """Returns the index of a dump, building it if needed.
+
+    Args:
+        name: the logical name of the dump stream.
+
+    Returns:
+        The list of (time, segment, offset) entries, empty if the dump
+        cannot be read from a position.
+    """
+    name = OutputStream.logical_name(name)
+    segments = OutputStream.find_segments(name)
+    signature = _signature(segments)
+    filename = name + INDEX_SUFFIX
+    entries = _read(filename, signature)
+    if entries is None:
+        entries = _build(segments)
+        _write(filename, signature, entries)
+    return entries
+
+
+def open_from(name, start):
+    """Opens a dump stream at the last indexed record before a time.
+
+    All the records of the dump from start onwards are read, preceded by
+    at most INTERVAL earlier records (more if the dump is not indexed).
+
+    Args:
+        name: the logical name of the dump stream.
+        start: the timestamp, None to read from the start.
+
+    Returns:
+        A buffered binary file object, as OutputStream.open_stream.
+    """
+    entries = load(name) if start is not None else []
+    index = bisect_left([time for (time, _, _) in entries], start) - 1
+    if index < 0:
+        return OutputStream.open_stream(name)
+    (_, segment, offset) = entries[index]
+    prefix = b""
+    if segment or offset:
+        with OutputStream.open_stream(name) as f:
+            header = f.read(DumpFormat.HEADER.size)
+        if DumpFormat.is_binary(header):
+            prefix = header
+    return OutputStream.open_stream(name, (segment, offset), prefix)
@@ -0,0 +1,160 @@
+"""
+(c) 2014 Arts Alliance Media
+
+Measures how many events per second the profiler handles.
+
+The workload mimics examples/main.py without the sleeps: a few threads
+calling small functions that allocate memory.
+Each run is profiled twice: with LegacyDispatcher, a copy of the profile
+functions of the original profiler that route every event through the
+process profiler, and with the per-thread profile functions installed by
+ProcessProfile.enable.
+Both call the same event handlers so only the cost of the dispatch
+differs.
+"""
+
+from __future__ import print_function
+
+# Fix import path to include parent dir.
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import shutil
+import tempfile
+import threading
+import time
+
+from Profiler import ProcessProfile
+from Profiler import _getProcessMemory
+
+
+THREAD_COUNT = 4
+ITERATIONS = 2000
+
+
+def allocate(count):
+    return [i % 16384 for i in range(count)]
+
+
+def doStuff():
+    nums = []
+    for i in range(ITERATIONS):
+        nums.extend(allocate(i % 32))
+        nums = nums[-1024:]
+
+
+def run():
+    threads = [threading.Thread(target=doStuff) for _ in range(THREAD_COUNT)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+
+
+class LegacyDispatcher(object):
+    """Copy of the original ProcessProfile._dispatch and ThreadProfile._dispatch.
+
+    Every event checks the pid and the process memory counter, looks up
+    the thread profiler by thread name and probes the sleep triggers
+    before the handler of the event is called.
+    """
+    def __init__(self, profiler):
+        self._profiler = profiler
+        self._main_pid = os.getpid()
+        self._locals = threading.local()
+        self._threads = {}
+        self._proc_mem_freq = None
+        self._proc_mem_check = 0
+        self._sleep_triggers = {
+            "time": set(["sleep"]),
+            "/usr/lib/python2.6/threading.py": set(["acquire"]),
+            None: set(["acquire"])
+        }
+
+    def _getThreadName(self):
+        try:
+            return self._locals.thread_name
+        except AttributeError:
+            self._locals.thread_name = threading.current_thread().name
+            return self._locals.thread_name
+
+    def _dispatch(self, frame, event, arg):
+        try:
+            if os.getpid() != self._main_pid:
+                return None
+            if self._proc_mem_freq:
+                if self._proc_mem_check == 0:
+                    _getProcessMemory()
+                self._proc_mem_check = ((self._proc_mem_check + 1) %
+                                        self._proc_mem_freq)
+            thread = self._getThreadName()
+            thread_stats = self._threads.get(thread)
+            if thread_stats is None:
+                thread_stats = (self._profiler._newThreadProfile(thread), {})
+                self._threads[thread] = thread_stats
+            self._threadDispatch(thread_stats, frame, event, arg)
+            return self._dispatch
+        except:
+            return self._dispatch
+
+    def _threadDispatch(self, thread_stats, frame, event, arg):
+        (profile, sleep_frames) = thread_stats
+        if (profile._sleep_trak and event == "c_call" and
+            arg.__module__ in self._sleep_triggers and
+            arg.__name__ in self._sleep_triggers[arg.__module__]):
+            sleep_frames[id(frame)] = profile._getMemory()
+        elif (profile._sleep_trak and (event == "c_return" or
+              event == "c_exception") and id(frame) in sleep_frames):
+            mem_before = sleep_frames.pop(id(frame))
+            profile._sleep_accounting += profile._getMemory() - mem_before
+        if event in profile._dispatcher:
+            profile._dispatcher[event](frame, event, arg)
+
+
+def countEvents():
+    """Counts the profile events generated by the workload."""
+    lock = threading.Lock()
+    events = [0]
+    def count(frame, event, arg):
+        with lock:
+            events[0] += 1
+    threading.setprofile(count)
+    sys.setprofile(count)
+    run()
+    sys.setprofile(None)
+    threading.setprofile(None)
+    return events[0]
+
+
+def profile(legacy):
+    """Runs the workload under the profiler and returns the elapsed time."""
+    path = tempfile.mkdtemp()
+    try:
+        profiler = ProcessProfile(default_log_path=path, profile="both")
+        if legacy:
+            dispatcher = LegacyDispatcher(profiler)
+            threading.setprofile(dispatcher._dispatch)
+            sys.setprofile(dispatcher._dispatch)
+        else:
+            profiler.enable()
+        start = time.time()
+        run()
+        elapsed = time.time() - start
+        sys.setprofile(None)
+        threading.setprofile(None)
+        profiler.close()
+        return elapsed
+    finally:
+        shutil.rmtree(path)
+
+
+def main():
+    events = countEvents()
+    print("{0} events per run".format(events))
+    for (label, legacy) in [("original dispatch", True),
+                            ("per-thread dispatch", False)]:
+        elapsed = profile(legacy)
+        print("{0:>25}: {1:.0f} events/s".format(label, events / elapsed))
+
+
+if __name__ == "__main__":
+    main()
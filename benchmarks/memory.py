@@ -0,0 +1,38 @@
+"""
+(c) 2014 Arts Alliance Media
+
+Measures the cost of a single memory sample for each memory source.
+"""
+
+from __future__ import print_function
+
+# Fix import path to include parent dir.
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import timeit
+
+from MemorySource import createMemorySource
+
+
+SAMPLES = 100000
+
+
+def main():
+    for (name, max_age) in [("pympler", None), ("statm", None),
+                            ("statm", 10), ("statm", 1000)]:
+        try:
+            source = createMemorySource(name, max_age)
+        except (RuntimeError, OSError) as e:
+            print("{0:>20}: unavailable ({1})".format(name, e))
+            continue
+        samples = SAMPLES // 10 if name == "pympler" else SAMPLES
+        elapsed = timeit.timeit(source.rss, number=samples)
+        label = name + (" cached {0} us".format(max_age) if max_age else "")
+        print("{0:>20}: {1:.3f} us per sample".format(
+            label, elapsed / samples * 1000000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+(c) 2014 Arts Alliance Media
+
+Tests of the registry of blocking calls.
+"""
+
+# Fix import path to include parent dir.
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import select
+import shutil
+import tempfile
+import time
+import unittest
+
+from BlockingCalls import BlockingRegistry
+from Profiler import ProcessProfile
+
+
+class PollWithoutPoll(object):
+    """A poll object without poll method, as on Python 2.7."""
+
+
+class DefaultsTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.poll = getattr(select, "poll", None)
+        select.poll = PollWithoutPoll
+
+    def tearDown(self):
+        if self.poll is None:
+            del select.poll
+        else:
+            select.poll = self.poll
+        shutil.rmtree(self.path)
+
+    def test_poll_without_poll_method(self):
+        registry = BlockingRegistry()
+        self.assertIn(time.sleep, registry._functions)
+
+    def test_profile_without_poll_method(self):
+        profiler = ProcessProfile(default_log_path=self.path)
+        profiler.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
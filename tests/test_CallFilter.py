@@ -0,0 +1,118 @@
+"""
+(c) 2014 Arts Alliance Media
+
+Tests of the selection of the functions to profile.
+"""
+
+# Fix import path to include parent dir.
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import io
+import unittest
+
+from CallFilter import CallFilter
+from Profiler import ThreadProfile
+
+
+def accepted():
+    pass
+
+
+def rejected():
+    pass
+
+
+class CountingFilter(CallFilter):
+    """Counts the functions matched against the rules."""
+    def __init__(self, *args, **kwargs):
+        super(CountingFilter, self).__init__(*args, **kwargs)
+        self.decided = []
+
+    def decide(self, code, filename, name, module):
+        self.decided.append(name)
+        return super(CountingFilter, self).decide(code, filename, name,
+                                                   module)
+
+
+class RulesTest(unittest.TestCase):
+    def decide(self, filter, filename="/app/pkg/mod.py", name="run",
+               module="pkg.mod", code=None):
+        return filter.decide(code or filename + ":" + name, filename, name,
+                             module)
+
+    def test_no_rules(self):
+        self.assertTrue(self.decide(CallFilter()))
+
+    def test_files(self):
+        filter = CallFilter(files=["/app/*"])
+        self.assertTrue(self.decide(filter))
+        self.assertFalse(self.decide(filter, filename="/usr/lib/os.py"))
+
+    def test_modules_include_submodules(self):
+        filter = CallFilter(modules=["pkg"])
+        self.assertTrue(self.decide(filter))
+        self.assertTrue(self.decide(filter, module="pkg"))
+        self.assertFalse(self.decide(filter, module="pkgother"))
+
+    def test_functions(self):
+        filter = CallFilter(functions=["handle_*"])
+        self.assertTrue(self.decide(filter, name="handle_get"))
+        self.assertFalse(self.decide(filter))
+
+    def test_any_include_rule(self):
+        filter = CallFilter(files=["/lib/*"], functions=["run"])
+        self.assertTrue(self.decide(filter))
+
+    def test_exclude_wins(self):
+        filter = CallFilter(modules=["pkg"], exclude_modules=["pkg.mod"],
+                            exclude_functions=["_*"])
+        self.assertFalse(self.decide(filter))
+        self.assertFalse(self.decide(filter, module="pkg.other", name="_x"))
+        self.assertTrue(self.decide(filter, module="pkg.other"))
+
+    def test_c_modules(self):
+        filter = CallFilter(files=["/app/*"], c_modules=["time"])
+        self.assertTrue(filter.decide(("time", "sleep"), "time", "sleep",
+                                      "time"))
+        self.assertFalse(filter.decide(("os", "stat"), "os", "stat", "os"))
+        # Python functions still use the include rules.
+        self.assertTrue(self.decide(filter))
+
+    def test_prefix(self):
+        filter = CallFilter.fromPrefix("/app/[v1]")
+        self.assertTrue(self.decide(filter, filename="/app/[v1]/mod.py"))
+        self.assertFalse(self.decide(filter, filename="/app/v/mod.py"))
+
+    def test_decisions_stored(self):
+        filter = CallFilter(functions=["run"])
+        self.decide(filter, code="run")
+        self.decide(filter, name="stop", code="stop")
+        self.assertEqual(filter.decisions, {"run": True, "stop": False})
+
+
+class CacheTest(unittest.TestCase):
+    def test_decided_once(self):
+        filter = CountingFilter(functions=["accepted"])
+        stream = io.StringIO()
+        thread_stats = ThreadProfile(
+            stream_factory=lambda stream_type, mode="w": stream,
+            profile="python", track_memory=False, track_times=False,
+            track_sleep=False)
+        thread_stats.setFilter(filter)
+        previous = sys.getprofile()
+        sys.setprofile(thread_stats._dispatch)
+        for _ in range(10):
+            accepted()
+            rejected()
+        sys.setprofile(previous)
+        self.assertEqual(filter.decided.count("accepted"), 1)
+        self.assertEqual(filter.decided.count("rejected"), 1)
+        self.assertTrue(filter.decisions[accepted.__code__])
+        self.assertFalse(filter.decisions[rejected.__code__])
+        self.assertEqual(thread_stats.filtered, 20)
+
+
+if __name__ == "__main__":
+    unittest.main()
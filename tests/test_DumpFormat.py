@@ -0,0 +1,102 @@
+"""
+(c) 2014 Arts Alliance Media
+
+Tests of the text and binary dump formats.
+"""
+
+# Fix import path to include parent dir.
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import io
+import unittest
+
+try:
+    # Python 2.7 text streams take str, not unicode.
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from DumpFormat import BinaryWriter
+from DumpFormat import KIND_BLOCK
+from DumpFormat import KIND_MEMORY
+from DumpFormat import KIND_MEMORY_TIMED
+from DumpFormat import KIND_STACK
+from DumpFormat import SymbolTable
+from DumpFormat import TextWriter
+from DumpFormat import read_binary
+
+
+MAIN = ("main", "main.py", 10, "main")
+WORK = ("work", "main.py", 20, "work")
+SLEEP = (("time", "sleep"), "time", 0, "sleep")
+
+
+def writeEvents(writer, kind):
+    """Writes the same events of a kind of dump with a writer."""
+    if kind == KIND_STACK:
+        writer.writeCall(1400000000.25, 0, *MAIN)
+        writer.writeCall(1400000000.5, 1, *WORK)
+        writer.writeCall(1400000000.75, 2, *WORK)
+        writer.writeCall(None, 3, *MAIN)
+    elif kind == KIND_BLOCK:
+        writer.writeBlock(1400000000.25, MAIN, SLEEP, 2000, 1500)
+        writer.writeBlock(1400000000.5, WORK, SLEEP, 4000, 3000)
+    else:
+        durations = (1200, 800) if kind == KIND_MEMORY_TIMED else None
+        writer.writeReturn(1400000000.25, 1, *(WORK + (4096, durations)))
+        writer.writeReturn(1400000000.5, 0, *(MAIN + (-512, durations)))
+        writer.writeSummary(1400000000.75, *(WORK + (12,)))
+        writer.writeReturn(None, 0, *(MAIN + (0, durations)))
+    writer.flush()
+
+
+class BinaryRoundTripTest(unittest.TestCase):
+    def roundTrip(self, kind, symbols=False, buffer_size=0):
+        """Returns the text lines and the lines read from the binary dump."""
+        table = SymbolTable(StringIO()) if symbols else None
+        text = StringIO()
+        writeEvents(TextWriter(text, symbols=table), kind)
+        binary = io.BytesIO()
+        writeEvents(BinaryWriter(binary, kind, buffer_size, symbols=table),
+                    kind)
+        binary.seek(0)
+        return (text.getvalue(), "".join(read_binary(binary)))
+
+    def test_memory(self):
+        (text, binary) = self.roundTrip(KIND_MEMORY)
+        self.assertEqual(binary, text)
+
+    def test_memory_durations(self):
+        (text, binary) = self.roundTrip(KIND_MEMORY_TIMED)
+        self.assertEqual(binary, text)
+        self.assertIn("=>4096;1200;800\n", binary)
+
+    def test_stack(self):
+        (text, binary) = self.roundTrip(KIND_STACK)
+        self.assertEqual(binary, text)
+
+    def test_block(self):
+        (text, binary) = self.roundTrip(KIND_BLOCK)
+        self.assertEqual(binary, text)
+
+    def test_symbol_table(self):
+        (text, binary) = self.roundTrip(KIND_MEMORY, symbols=True)
+        self.assertEqual(binary, text)
+        self.assertIn("@0=>", binary)
+
+    def test_buffered(self):
+        (text, binary) = self.roundTrip(KIND_MEMORY, buffer_size=64 * 1024)
+        self.assertEqual(binary, text)
+
+    def test_untimed(self):
+        binary = io.BytesIO()
+        writeEvents(BinaryWriter(binary, KIND_MEMORY), KIND_MEMORY)
+        binary.seek(0)
+        for line in read_binary(binary, timed=False):
+            self.assertNotIn("#", line)
+
+
+if __name__ == "__main__":
+    unittest.main()
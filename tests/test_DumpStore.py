@@ -0,0 +1,75 @@
+"""
+(c) 2014 Arts Alliance Media
+
+Tests of the columnar store written by the import command.
+"""
+
+# Fix import path to include parent dir.
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import argparse
+import re
+import shutil
+import tempfile
+import unittest
+
+import DumpFormat
+import DumpStore
+import ProfilerGraph
+
+
+STACK = (
+    "1400000000.25#main.py:10:main\n"
+    "1400000000.5#main.py:20:run\n"
+    " 1400000000.75#main.py:30:work\n"
+    "  1400000001.0#main.py:40:allocate\n"
+    "  1400000001.25#main.py:30:work\n"
+    " 1400000001.5#main.py:20:run\n"
+)
+
+MEMORY = (
+    "1400000000.25#main.py:40:allocate=>4096\n"
+    "1400000000.5#main.py:30:work=>-512\n"
+    "*1400000000.75#main.py:50:noop=>12\n"
+    "1400000001.0#main.py:20:run=>0\n"
+)
+
+
+class RoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.logs = os.path.join(self.path, "logs", "42")
+        os.makedirs(self.logs)
+        for (name, text) in [("Thread-1.stack", STACK),
+                             ("Thread-1.mem", MEMORY)]:
+            with open(os.path.join(self.logs, name), "w") as f:
+                f.write(text)
+        self.store = os.path.join(self.path, "store")
+        ProfilerGraph.import_dumps(argparse.Namespace(
+            directories=[os.path.join(self.path, "logs")],
+            output=self.store, time=True))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def read(self, name):
+        """Reads a dump of the store back as text, with resolved names."""
+        with open(os.path.join(self.store, "42", "symbols")) as f:
+            symbols = DumpFormat.read_symbols(f)
+        lines = DumpStore.read_lines(os.path.join(self.store, "42", name))
+        return "".join(re.sub("@[0-9]+", lambda m: symbols[m.group(0)], line)
+                       for line in lines)
+
+    @unittest.skipIf(DumpStore.numpy is None, "numpy is not installed")
+    def test_stack(self):
+        self.assertEqual(self.read("Thread-1.stack"), STACK)
+
+    @unittest.skipIf(DumpStore.numpy is None, "numpy is not installed")
+    def test_memory(self):
+        self.assertEqual(self.read("Thread-1.mem"), MEMORY)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+"""
+(c) 2014 Arts Alliance Media
+
+Tests of the ring buffers of queued events.
+"""
+
+# Fix import path to include parent dir.
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import threading
+import unittest
+
+from EventQueue import RingBuffer
+
+
+class RingBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+    def fill(self, ring, count):
+        for value in range(count):
+            ring.append(self.calls.append, (value,))
+
+    def test_drain_in_order(self):
+        ring = RingBuffer(4)
+        self.fill(ring, 3)
+        self.assertEqual(ring.drain(), 3)
+        self.assertEqual(self.calls, [0, 1, 2])
+        self.assertEqual(ring.drain(), 0)
+
+    def test_wraps_around(self):
+        ring = RingBuffer(4)
+        for _ in range(3):
+            self.fill(ring, 3)
+            ring.drain()
+        self.assertEqual(self.calls, [0, 1, 2] * 3)
+
+    def test_drop_when_full(self):
+        ring = RingBuffer(4)
+        self.fill(ring, 10)
+        self.assertEqual(ring.dropped, 6)
+        self.assertEqual(ring.drain(), 4)
+        self.assertEqual(self.calls, [0, 1, 2, 3])
+
+    def test_block_when_full(self):
+        ring = RingBuffer(4, block=True)
+        self.fill(ring, 4)
+        drained = threading.Event()
+
+        def consumer():
+            ring.drain()
+            drained.set()
+
+        # The producer waits for the consumer rather than dropping.
+        timer = threading.Timer(0.01, consumer)
+        timer.start()
+        self.fill(ring, 2)
+        timer.join()
+        self.assertTrue(drained.is_set())
+        ring.drain()
+        self.assertEqual(ring.dropped, 0)
+        self.assertEqual(self.calls, [0, 1, 2, 3, 0, 1])
+
+    def test_block_without_consumer(self):
+        # A blocked producer drains the buffer itself after a while.
+        ring = RingBuffer(2, block=True)
+        self.fill(ring, 5)
+        self.assertEqual(ring.dropped, 0)
+        ring.drain()
+        self.assertEqual(self.calls, [0, 1, 2, 3, 4])
+
+
+if __name__ == "__main__":
+    unittest.main()
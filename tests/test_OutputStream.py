@@ -0,0 +1,47 @@
+"""
+(c) 2014 Arts Alliance Media
+
+Tests of the rotated output streams.
+"""
+
+# Fix import path to include parent dir.
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import shutil
+import tempfile
+import unittest
+
+from OutputStream import RotatingStream
+from OutputStream import find_segments
+from OutputStream import open_stream
+
+
+class FindSegmentsTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        stream = RotatingStream(os.path.join(self.path, "Thread-1.mem"),
+                                compression="gzip", max_size=10)
+        for i in range(12):
+            stream.write("line {0}\n".format(i))
+        stream.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_segments_in_order(self):
+        segments = find_segments(os.path.join(self.path, "Thread-1.mem"))
+        self.assertEqual(
+            [os.path.basename(segment) for segment in segments],
+            ["Thread-1.mem.{0}.gz".format(i) for i in range(12)])
+
+    def test_double_slash(self):
+        name = self.path + "//Thread-1.mem.0.gz"
+        self.assertEqual(len(find_segments(name)), 12)
+        with open_stream(name) as f:
+            self.assertEqual(f.readline(), b"line 0\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+"""
+(c) 2014 Arts Alliance Media
+
+Tests of the memory deltas written by the profiler.
+"""
+
+# Fix import path to include parent dir.
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import shutil
+import tempfile
+import unittest
+
+from MemorySource import tracemalloc
+from Profiler import ProcessProfile
+
+
+def noop():
+    pass
+
+
+def allocate():
+    return [0] * 1000
+
+
+class TracemallocTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def deltas(self, function, calls):
+        """Profiles calls to function and returns their memory deltas."""
+        profiler = ProcessProfile(default_log_path=self.path)
+        profiler.useTracemalloc()
+        kept = []
+        profiler.enable()
+        for _ in range(calls):
+            kept.append(function())
+        profiler.disable()
+        profiler.close()
+        dump = os.path.join(self.path, str(os.getpid()), "MainThread.mem")
+        name = ":{0}=>".format(function.__name__)
+        with open(dump) as f:
+            return [int(line.split("=>")[1]) for line in f if name in line]
+
+    @unittest.skipIf(tracemalloc is None, "tracemalloc is not available")
+    def test_noop_has_no_delta(self):
+        deltas = self.deltas(noop, 200)
+        self.assertEqual(len(deltas), 200)
+        self.assertEqual(set(deltas), set([0]))
+
+    @unittest.skipIf(tracemalloc is None, "tracemalloc is not available")
+    def test_allocation_is_charged(self):
+        deltas = self.deltas(allocate, 20)
+        self.assertEqual(len(deltas), 20)
+        for delta in deltas:
+            self.assertTrue(8000 <= delta < 8200, delta)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+"""
+(c) 2014 Arts Alliance Media
+
+Tests of the post-processing commands.
+"""
+
+# Fix import path to include parent dir.
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import argparse
+import shutil
+import tempfile
+import unittest
+
+import ProfilerGraph
+
+
+DUMPS = {
+    "process.mem": (
+        "1400000000.0#40960000\n"
+        "1400000001.0#41984000\n"
+    ),
+    "Thread-1.mem": (
+        "1400000000.25#main.py:40:allocate=>409600\n"
+        "1400000000.5#main.py:30:work=>-512\n"
+        "1400000000.75#main.py:50:noop=>0\n"
+        "1400000001.0#main.py:20:run=>0\n"
+    ),
+    "Thread-2.mem": (
+        "1400000000.3#main.py:40:allocate=>8192\n"
+        "1400000000.6#main.py:60:free=>-409600\n"
+    ),
+    "Thread-3.mem": "",
+    "Thread-1.stack": (
+        "1400000000.25#main.py:10:main\n"
+        " 1400000000.5#main.py:20:run\n"
+        "  1400000000.75#main.py:30:work\n"
+    ),
+    "Thread-2.stack": (
+        "1400000000.3#main.py:10:main\n"
+        " 1400000000.6#main.py:20:run\n"
+    ),
+}
+
+
+class JobsTest(unittest.TestCase):
+    """Processing the dumps in a pool gives the same output as in turn."""
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.dumps = os.path.join(self.path, "42")
+        os.makedirs(self.dumps)
+        for (name, text) in DUMPS.items():
+            with open(os.path.join(self.dumps, name), "w") as f:
+                f.write(text)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def files(self, suffix):
+        return sorted(os.path.join(self.dumps, name) for name in DUMPS
+                      if name.endswith(suffix))
+
+    def read(self, data):
+        """Returns the content of a data file and removes it."""
+        if data is None:
+            return None
+        with open(data) as f:
+            content = f.read()
+        os.remove(data)
+        return content
+
+    def process(self, function, files, read, **kwargs):
+        """Returns the results of function with and without --jobs."""
+        results = []
+        for jobs in (1, 2):
+            args = argparse.Namespace(files=files, jobs=jobs, time=True,
+                                      merge_pids=False, time_from=None,
+                                      time_to=None, **kwargs)
+            results.append([read(result) for result
+                            in ProfilerGraph._map_files(function, args)])
+        return results
+
+    def test_memg(self):
+        def read(result):
+            (profile, title, data, peaks, samples) = result
+            return (profile, title, self.read(data), peaks, samples)
+
+        (serial, parallel) = self.process(
+            ProfilerGraph._memg_file, self.files(".mem"), read, cap=None,
+            peak=200, no_process=False, process_rebase=30000)
+        self.assertEqual(parallel, serial)
+        self.assertEqual(len(serial), 4)
+        self.assertEqual(len(serial[1][3]), 1)
+
+    def test_memh(self):
+        (serial, parallel) = self.process(
+            ProfilerGraph._memh_file, self.files(".mem"), lambda bins: bins)
+        self.assertEqual(parallel, serial)
+        self.assertIn(("main.py:60:free", -400.0), serial[1])
+
+    def test_nesting(self):
+        def read(result):
+            (thread, data) = result
+            return (thread, self.read(data))
+
+        (serial, parallel) = self.process(
+            ProfilerGraph._nesting_file, self.files(".stack"), read)
+        self.assertEqual(parallel, serial)
+        self.assertEqual(serial[1],
+                         ("Thread-2", "1400000000.3 0\n1400000000.6 1\n"))
+
+
+class InterleaveTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        dumps = {
+            "process.mem": "1400000000.0#40960000\n",
+            "Thread-1.mem": "".join("1400000000.{0}#a=>0\n".format(i)
+                                    for i in (1, 2, 3, 7, 8)),
+            "Thread-2.mem": "".join("1400000000.{0}#b=>0\n".format(i)
+                                    for i in (4, 5, 9)),
+            "Thread-2@Task-1.mem": "1400000000.6#c=>0\n",
+        }
+        self.files = []
+        for (name, text) in sorted(dumps.items()):
+            self.files.append(os.path.join(self.path, name))
+            with open(self.files[-1], "w") as f:
+                f.write(text)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def interleaved(self, merge_tasks=False):
+        args = argparse.Namespace(files=self.files, merge_pids=False,
+                                  merge_tasks=merge_tasks, time_from=None,
+                                  time_to=None)
+        (threads, events) = ProfilerGraph._interleaved(args)
+        return (threads, [(round(time - 1400000000, 1), thread)
+                          for (time, thread) in events])
+
+    def test_merged_in_time_order(self):
+        (threads, events) = self.interleaved()
+        self.assertEqual(threads,
+                         {"Thread-1": 0, "Thread-2": 1, "Thread-2@Task-1": 2})
+        # Only the first and last of consecutive events of a thread remain.
+        self.assertEqual(events, [
+            (0.1, "Thread-1"), (0.3, "Thread-1"),
+            (0.4, "Thread-2"), (0.5, "Thread-2"),
+            (0.6, "Thread-2@Task-1"), (0.6, "Thread-2@Task-1"),
+            (0.7, "Thread-1"), (0.8, "Thread-1"),
+            (0.9, "Thread-2"),
+        ])
+
+    def test_merge_tasks(self):
+        (threads, events) = self.interleaved(merge_tasks=True)
+        self.assertEqual(threads, {"Thread-1": 0, "Thread-2": 1})
+        self.assertEqual(events, [
+            (0.1, "Thread-1"), (0.3, "Thread-1"),
+            (0.4, "Thread-2"), (0.6, "Thread-2"),
+            (0.7, "Thread-1"), (0.8, "Thread-1"),
+            (0.9, "Thread-2"),
+        ])
+
+
+if __name__ == "__main__":
+    unittest.main()